@@ -0,0 +1,252 @@
+"""
+End-to-end benchmark of fetch_and_process_emails against local stand-in servers (see fake_servers.py).
+For each mailbox size, a synthetic mailbox is served by a fake IMAP server, replies go to an SMTP
+sink and the LLM is a mock with a fixed latency. llmail runs in its own process so its peak RSS
+isn't mixed up with the servers'.
+
+Each run has these cycles:
+1. Full sync: every email is fetched and every unanswered thread gets a reply
+2. Nothing new except the bot's own replies (which the sink adds to the mailbox)
+3. --new-threads new emails arrive and are replied to
+
+Reported for each cycle: time, IMAP commands and emails fetched, SMTP commands, LLM requests,
+replies sent and replies per second. Round-trips are all the commands and requests added up.
+
+Run with `poetry run python benchmarks/bench_cycle.py --messages 1000 10000 100000`
+(the `cryptography` package is needed for the self-signed certificate)
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BOT_EMAIL = "bot@example.com"
+SUBJECT = "llmail bench"
+CHILD_VARIABLE = "LLMAIL_BENCH_CHILD"
+
+
+def peak_rss_mb() -> float | None:
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def child():
+    """Run cycles when told to over stdin and report each one on stdout"""
+    # llmail reads its configuration (from the environment set by the parent) the first time args is used
+    sys.argv = sys.argv[:1]
+    from llmail.utils import args, llm, responding
+
+    llm.prepare()
+    for line in sys.stdin:
+        if line.strip() != "cycle":
+            break
+        start = time.perf_counter()
+        responding.fetch_and_process_emails(
+            look_for_subject=args.subject_key, alias=args.alias, system_prompt=args.system_prompt
+        )
+        print("RESULT " + json.dumps({"seconds": time.perf_counter() - start}), flush=True)
+    print("RESULT " + json.dumps({"peak_rss_mb": peak_rss_mb()}), flush=True)
+
+
+def read_result(process: subprocess.Popen) -> dict:
+    for line in process.stdout:
+        if line.startswith("RESULT "):
+            return json.loads(line.removeprefix("RESULT "))
+    raise RuntimeError(f"llmail exited with {process.wait()} (see the output above)")
+
+
+def run(options: argparse.Namespace, count: int, directory: Path, certificate: tuple[Path, Path]) -> dict:
+    import fake_servers
+
+    mailbox = fake_servers.FakeMailbox()
+    needs_reply = fake_servers.seed(
+        mailbox,
+        count,
+        SUBJECT,
+        BOT_EMAIL,
+        [int(length) for length in options.thread_lengths.split(",")],
+        options.unanswered,
+        options.noise,
+        seed=options.seed,
+    )
+    context = fake_servers.server_context(*certificate)
+    imap = fake_servers.FakeIMAPServer(mailbox, context, options.threading)
+    smtp = fake_servers.SMTPSink(mailbox, context)
+    llm = fake_servers.MockLLM(options.llm_latency, options.token_latency)
+    environment = {
+        variable: value
+        for variable, value in os.environ.items()
+        # Settings from the shell could change what's measured
+        if variable not in ("CONFIG_FILE", "WATCH_INTERVAL", "IDLE", "FOLDER")
+    }
+    environment.update(
+        {
+            CHILD_VARIABLE: "1",
+            "PYTHONPATH": os.pathsep.join(
+                filter(None, [str(Path(__file__).resolve().parent.parent), os.getenv("PYTHONPATH")])
+            ),
+            "SSL_CERT_FILE": str(certificate[0]),
+            "NO_PROXY": "127.0.0.1,localhost",
+            "IMAP_HOST": "localhost",
+            "IMAP_PORT": str(imap.port),
+            "IMAP_USERNAME": BOT_EMAIL,
+            "IMAP_PASSWORD": "bench",
+            "SMTP_HOST": "localhost",
+            "SMTP_PORT": str(smtp.port),
+            "SMTP_USERNAME": BOT_EMAIL,
+            "SMTP_PASSWORD": "bench",
+            "LLM_PROVIDER": "openai-like",
+            "LLM_BASE_URL": llm.base_url,
+            "LLM_API_KEY": "bench",
+            "LLM_MODEL": llm.model,
+            "NO_TOOLS": "true",
+            "SUBJECT_KEY": SUBJECT,
+            "FOLDER": "INBOX",
+            "STATE_FILE": str(directory / f"state-{count}.db"),
+            "LOG_LEVEL": options.log_level,
+            "MAX_CONCURRENT_REPLIES": str(options.max_concurrent_replies),
+        }
+    )
+    if options.fetch_batch_size:
+        environment["FETCH_BATCH_SIZE"] = str(options.fetch_batch_size)
+
+    process = subprocess.Popen(
+        [sys.executable, __file__],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+        env=environment,
+        # So a .env file in the repository isn't loaded
+        cwd=directory,
+    )
+    cycles = []
+    try:
+        for number in range(1, 4):
+            expected = needs_reply if number == 1 else 0
+            if number == 3:
+                expected = add_new_threads(fake_servers, mailbox, options.new_threads)
+            for server in (imap, smtp, llm):
+                server.take_stats()
+            process.stdin.write("cycle\n")
+            process.stdin.flush()
+            seconds = read_result(process)["seconds"]
+            imap_stats, smtp_stats, llm_stats = imap.take_stats(), smtp.take_stats(), llm.take_stats()
+            cycles.append(
+                {
+                    "cycle": number,
+                    "seconds": seconds,
+                    "imap_commands": imap_stats["commands"],
+                    "imap_fetched": imap_stats["messages_fetched"],
+                    "imap_bytes": imap_stats["bytes_sent"],
+                    "smtp_commands": smtp_stats["commands"],
+                    "llm_requests": llm_stats["requests"],
+                    "round_trips": imap_stats["commands"] + smtp_stats["commands"] + llm_stats["requests"],
+                    "replies": smtp_stats["emails"],
+                    "expected_replies": expected,
+                    "replies_per_second": smtp_stats["emails"] / seconds if seconds else 0,
+                }
+            )
+        process.stdin.write("exit\n")
+        process.stdin.flush()
+        peak = read_result(process)["peak_rss_mb"]
+        process.wait()
+    finally:
+        if process.poll() is None:
+            process.kill()
+        for server in (imap, smtp, llm):
+            server.shutdown()
+            server.server_close()
+    return {"messages": count, "peak_rss_mb": peak, "cycles": cycles}
+
+
+def add_new_threads(fake_servers, mailbox, count: int) -> int:
+    """Add count new emails from users, each starting a thread"""
+    for number in range(count):
+        mailbox.add(
+            fake_servers.FakeMessage(
+                message_id=f"<new-{number}@bench>",
+                sender=f"New user {number} <new{number}@example.com>",
+                recipient=BOT_EMAIL,
+                subject=SUBJECT,
+                date=fake_servers.START_DATE,
+                text=f"A new question {number}?",
+            )
+        )
+    return count
+
+
+def print_report(results: list[dict]):
+    header = (
+        f"{'messages':>9} {'cycle':>5} {'seconds':>8} {'imap cmds':>9} {'fetched':>8} "
+        f"{'round-trips':>11} {'llm':>5} {'replies':>9} {'replies/s':>9} {'peak RSS':>9}"
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        peak = f"{result['peak_rss_mb']:.1f} MB" if result["peak_rss_mb"] is not None else "n/a"
+        for cycle in result["cycles"]:
+            print(
+                f"{result['messages']:>9} {cycle['cycle']:>5} {cycle['seconds']:>8.2f} "
+                f"{cycle['imap_commands']:>9} {cycle['imap_fetched']:>8} {cycle['round_trips']:>11} "
+                f"{cycle['llm_requests']:>5} {cycle['replies']:>4}/{cycle['expected_replies']:<4} "
+                f"{cycle['replies_per_second']:>9.1f} {peak if cycle['cycle'] == 1 else '':>9}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, nargs="+", default=[1000, 10000], help="Mailbox sizes")
+    parser.add_argument(
+        "--thread-lengths",
+        default="1,2,3,5,8",
+        help="Comma-separated lengths that threads are picked from (adjusted by one so they end right)",
+    )
+    parser.add_argument("--unanswered", type=float, default=0.1, help="Share of threads that need a reply")
+    parser.add_argument("--noise", type=float, default=0.2, help="Share of emails with another subject")
+    parser.add_argument("--new-threads", type=int, default=20, help="New emails before the third cycle")
+    parser.add_argument(
+        "--threading",
+        choices=["headers", "thread", "gmail"],
+        default="headers",
+        help="Threading extension the IMAP server advertises (none, THREAD=REFERENCES or X-GM-EXT-1)",
+    )
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Seconds before the LLM answers")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Seconds between streamed words")
+    parser.add_argument("--max-concurrent-replies", type=int, default=4)
+    parser.add_argument("--fetch-batch-size", type=int, help="Passed to llmail (its default otherwise)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic mailbox")
+    parser.add_argument("--log-level", default="ERROR", help="llmail's log level")
+    parser.add_argument("--json", type=Path, help="Also write the results to this file")
+    options = parser.parse_args()
+
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    import fake_servers
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        certificate = fake_servers.make_certificate(directory)
+        for count in options.messages:
+            print(f"Running with {count} emails...", file=sys.stderr)
+            results.append(run(options, count, directory, certificate))
+    print_report(results)
+    if options.json:
+        options.json.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    if os.getenv(CHILD_VARIABLE):
+        child()
+    else:
+        main()
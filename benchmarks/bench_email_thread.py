@@ -0,0 +1,124 @@
+"""
+Micro-benchmark for building an EmailThread reply by reply.
+Compares the current EmailThread with the previous implementation, which rebuilt a list of
+Message-IDs and re-sorted every reply on each insert.
+
+Run with `poetry run python benchmarks/bench_email_thread.py`
+"""
+
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+
+# So llmail can be imported without installing it (such as outside poetry)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# llmail reads its configuration the first time args is used, which needs these to be set
+for variable in (
+    "IMAP_HOST",
+    "IMAP_PORT",
+    "IMAP_USERNAME",
+    "IMAP_PASSWORD",
+    "SMTP_HOST",
+    "SMTP_PORT",
+    "SMTP_USERNAME",
+    "SMTP_PASSWORD",
+):
+    os.environ.setdefault(variable, "bench@example.com")
+sys.argv = sys.argv[:1]
+
+from llmail.utils import tracking  # noqa: E402
+
+
+class ListEmail:
+    """The previous Email (a regular class with a __dict__)"""
+
+    def __init__(self, imap_id, message_id, subject, sender, timestamp, body, references):
+        self.imap_id = imap_id
+        self.message_id = message_id
+        self.subject = subject
+        self.sender = sender
+        self.timestamp = timestamp
+        self.body = body
+        self.references = references
+
+
+class ListEmailThread:
+    """The previous EmailThread.add_reply (without logging)"""
+
+    def __init__(self, initial_email):
+        self.initial_email = initial_email
+        self.replies = []
+
+    def add_reply(self, reply_email):
+        if (
+            reply_email.message_id not in [email.message_id for email in self.replies]
+            and reply_email.message_id != self.initial_email.message_id
+        ):
+            self.replies.append(reply_email)
+            self.replies = sorted(self.replies, key=lambda x: x.timestamp)
+
+
+def make_emails(email_class, count: int) -> list:
+    start = datetime(2024, 1, 1)
+    # Mostly in order, like emails from a scan, with some arriving late
+    offsets = sorted(range(count), key=lambda i: i + random.randint(-5, 5))
+    return [
+        email_class(
+            imap_id=i,
+            message_id=f"<{i}@bench>",
+            subject="llmail autoreply",
+            sender="user@example.com",
+            timestamp=start + timedelta(minutes=offset),
+            body="Hello " * 20,
+            references=[],
+        )
+        for i, offset in enumerate(offsets)
+    ]
+
+
+def build(thread_class, emails):
+    thread = thread_class(emails[0])
+    for email in emails[1:]:
+        thread.add_reply(email)
+    # Duplicates (such as the same email in two folders) should be ignored
+    for email in emails[1 : len(emails) // 10]:
+        thread.add_reply(email)
+    return thread
+
+
+def memory_per_email(email_class, count: int = 10_000) -> float:
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    emails = make_emails(email_class, count)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    total = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del emails
+    return total / count
+
+
+def main():
+    random.seed(0)
+    # Keep the logging in add_reply from being part of the measurement
+    tracking.logger.remove()
+    print(f"{'replies':>8} | {'previous (ms)':>14} | {'current (ms)':>13} | {'speedup':>8}")
+    for count in (10, 100, 500, 2000):
+        previous_emails = make_emails(ListEmail, count)
+        current_emails = make_emails(tracking.Email, count)
+        runs = max(1, 2000 // count)
+        previous = timeit.timeit(lambda: build(ListEmailThread, previous_emails), number=runs) / runs
+        current = timeit.timeit(lambda: build(tracking.EmailThread, current_emails), number=runs) / runs
+        print(
+            f"{count:>8} | {previous * 1000:>14.3f} | {current * 1000:>13.3f} | {previous / current:>7.1f}x"
+        )
+    print()
+    print(f"Memory per email (previous): {memory_per_email(ListEmail):.0f} bytes")
+    print(f"Memory per email (current):  {memory_per_email(tracking.Email):.0f} bytes")
+
+
+if __name__ == "__main__":
+    main()
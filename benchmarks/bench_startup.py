@@ -0,0 +1,117 @@
+"""
+Startup benchmark. Runs each scenario in a fresh interpreter with `python -X importtime` and reports
+the wall time, the time spent importing, which heavy libraries were loaded and the slowest imports.
+
+Run with `poetry run python benchmarks/bench_startup.py` (add --top 0 to only show the summary)
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Libraries that should only be loaded when they're needed
+HEAVY = ("phi", "openai", "ollama", "yagmail", "duckduckgo_search", "exa_py", "httpx", "pydantic")
+SCENARIOS = {
+    "import llmail.__main__": "import llmail.__main__",
+    "list-folders": "import llmail.__main__\nfrom imapclient import IMAPClient",
+    "check emails (no tools)": (
+        "from llmail.utils import llm, responding, cli_args\n"
+        "cli_args.set_argparse(['--no-tools'])\n"
+        "llm.prepare()\n"
+        "llm.create_assistant()"
+    ),
+    "check emails (default tools)": (
+        "from llmail.utils import llm, responding, cli_args\n"
+        "cli_args.set_argparse([])\n"
+        "llm.prepare()\n"
+        "llm.create_assistant()"
+    ),
+}
+# llmail needs these to parse its arguments, but nothing connects to them
+ENVIRONMENT = {
+    "IMAP_HOST": "localhost",
+    "IMAP_PORT": "993",
+    "IMAP_USERNAME": "bench@example.com",
+    "IMAP_PASSWORD": "bench",
+    "SMTP_HOST": "localhost",
+    "SMTP_PORT": "465",
+    "SMTP_USERNAME": "bench@example.com",
+    "SMTP_PASSWORD": "bench",
+    "LLM_BASE_URL": "http://127.0.0.1:9/v1",
+    "LLM_API_KEY": "bench",
+    "LOG_LEVEL": "ERROR",
+}
+
+
+def parse_importtime(output: str) -> list[tuple[str, int, int]]:
+    """(module, cumulative microseconds, depth) for each line of -X importtime output"""
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(cumulative), depth))
+    return imports
+
+
+def run(code: str, directory: str) -> tuple[float, list[tuple[str, int, int]]]:
+    environment = {**os.environ, **ENVIRONMENT}
+    environment["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [str(Path(__file__).resolve().parent.parent), os.getenv("PYTHONPATH")])
+    )
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=environment,
+        # So a .env file in the repository isn't loaded
+        cwd=directory,
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"{code!r} failed:\n{result.stderr[-2000:]}")
+    return elapsed, parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Runs of each scenario (the median is shown)")
+    parser.add_argument("--top", type=int, default=8, help="Slowest imports to show for each scenario")
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Once so the bytecode is compiled before timing
+        run("import llmail.__main__", directory)
+        print(f"{'scenario':<30} {'wall ms':>8} {'imports ms':>10}  heavy libraries loaded")
+        details = []
+        for name, code in SCENARIOS.items():
+            runs = [run(code, directory) for _ in range(max(options.runs, 1))]
+            wall = statistics.median(elapsed for elapsed, _ in runs)
+            imports = runs[len(runs) // 2][1]
+            total = sum(cumulative for _, cumulative, depth in imports if depth == 0)
+            loaded = sorted({module.split(".")[0] for module, _, _ in imports} & set(HEAVY))
+            print(f"{name:<30} {wall * 1000:>8.0f} {total / 1000:>10.0f}  {', '.join(loaded) or '-'}")
+            details.append((name, imports))
+
+    if options.top:
+        for name, imports in details:
+            print(f"\nSlowest imports for {name} (cumulative ms):")
+            # The llmail modules and the libraries they import directly
+            top = sorted(
+                (entry for entry in imports if entry[2] <= 1 or entry[0].startswith("llmail")),
+                key=lambda entry: entry[1],
+                reverse=True,
+            )[: options.top]
+            for module, cumulative, _ in top:
+                print(f"  {cumulative / 1000:>8.1f}  {module}")
+
+
+if __name__ == "__main__":
+    main()
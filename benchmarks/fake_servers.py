@@ -0,0 +1,942 @@
+"""
+Local stand-ins for the servers llmail talks to, for benchmarking without real accounts:
+- FakeIMAPServer: an IMAP4rev1 server (over TLS) with just the commands llmail uses, serving a
+  synthetic mailbox kept in memory
+- SMTPSink: an SMTP server (over TLS) that accepts every email and adds it to the mailbox, like
+  Gmail's All Mail, so the bot's replies are seen on the next cycle
+- MockLLM: an OpenAI-compatible chat completions endpoint that answers after a fixed latency with
+  a reply that only depends on the request
+
+Every server counts the commands (or requests) it gets, which is how round-trips are measured.
+The TLS certificate is self-signed for localhost. Point SSL_CERT_FILE at it so clients trust it.
+"""
+
+import base64
+import datetime
+import hashlib
+import json
+import random
+import re
+import socketserver
+import ssl
+import threading
+import time
+from collections import Counter
+from email import message_from_bytes
+from email.utils import format_datetime, getaddresses
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+BOUNDARY = "llmail-bench"
+START_DATE = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def make_certificate(directory: Path) -> tuple[Path, Path]:
+    """Write a self-signed certificate (and its key) for localhost and 127.0.0.1"""
+    import ipaddress
+
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName(
+                [x509.DNSName("localhost"), x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]
+            ),
+            critical=False,
+        )
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    certificate_path = directory / "cert.pem"
+    key_path = directory / "key.pem"
+    certificate_path.write_bytes(certificate.public_bytes(serialization.Encoding.PEM))
+    key_path.write_bytes(
+        key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+    )
+    return certificate_path, key_path
+
+
+def server_context(certificate_path: Path, key_path: Path) -> ssl.SSLContext:
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certificate_path, key_path)
+    return context
+
+
+# Mailbox
+
+
+class FakeMessage:
+    __slots__ = (
+        "uid",
+        "message_id",
+        "sender",
+        "recipient",
+        "subject",
+        "date",
+        "in_reply_to",
+        "references",
+        "thread_id",
+        "text",
+        "modseq",
+        "_header",
+    )
+
+    def __init__(
+        self,
+        message_id: str,
+        sender: str,
+        recipient: str,
+        subject: str,
+        date: datetime.datetime,
+        text: str,
+        in_reply_to: str | None = None,
+        references: list[str] | None = None,
+        thread_id: int = 0,
+    ):
+        self.uid = 0
+        self.message_id = message_id
+        self.sender = sender
+        self.recipient = recipient
+        self.subject = subject
+        self.date = date
+        self.text = text
+        self.in_reply_to = in_reply_to
+        self.references = references or []
+        self.thread_id = thread_id
+        self.modseq = 0
+        self._header = None
+
+    @property
+    def header(self) -> bytes:
+        if self._header is None:
+            lines = [
+                f"Message-ID: {self.message_id}",
+                f"From: {self.sender}",
+                f"To: {self.recipient}",
+                f"Subject: {self.subject}",
+                f"Date: {format_datetime(self.date)}",
+            ]
+            if self.in_reply_to:
+                lines.append(f"In-Reply-To: {self.in_reply_to}")
+            if self.references:
+                lines.append(f"References: {' '.join(self.references)}")
+            lines += [
+                "MIME-Version: 1.0",
+                f'Content-Type: multipart/alternative; boundary="{BOUNDARY}"',
+            ]
+            self._header = ("\r\n".join(lines) + "\r\n\r\n").encode()
+        return self._header
+
+    @property
+    def plain(self) -> bytes:
+        return self.text.encode()
+
+    @property
+    def html(self) -> bytes:
+        paragraphs = "".join(f"<p>{line}</p>" for line in self.text.split("\n") if line)
+        return f"<html><body>{paragraphs}</body></html>".encode()
+
+    @property
+    def body(self) -> bytes:
+        return (
+            f"--{BOUNDARY}\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n".encode()
+            + self.plain
+            + f"\r\n--{BOUNDARY}\r\nContent-Type: text/html; charset=utf-8\r\n\r\n".encode()
+            + self.html
+            + f"\r\n--{BOUNDARY}--\r\n".encode()
+        )
+
+    def header_value(self, name: str) -> str:
+        match name.lower():
+            case "message-id":
+                return self.message_id
+            case "from":
+                return self.sender
+            case "to":
+                return self.recipient
+            case "subject":
+                return self.subject
+            case "in-reply-to":
+                return self.in_reply_to or ""
+            case "references":
+                return " ".join(self.references)
+        return ""
+
+
+class Folder:
+    def __init__(self, name: str):
+        self.name = name
+        self.uidvalidity = 1
+        self.uidnext = 1
+        self.highestmodseq = 1
+        self.messages: dict[int, FakeMessage] = {}
+
+
+class FakeMailbox:
+    """Folders of synthetic emails, shared by the IMAP server and the SMTP sink"""
+
+    def __init__(self, folders: tuple[str, ...] = ("INBOX",)):
+        self.folders = {name: Folder(name) for name in folders}
+        self.lock = threading.Lock()
+        # Thread of each Message-ID, for the thread IDs of emails sent over SMTP
+        self._thread_ids: dict[str, int] = {}
+        self._last_thread_id = 0
+
+    def add(self, message: FakeMessage, folder: str = "INBOX") -> int:
+        with self.lock:
+            folder = self.folders[folder]
+            message.uid = folder.uidnext
+            folder.uidnext += 1
+            folder.highestmodseq += 1
+            message.modseq = folder.highestmodseq
+            # Like X-GM-THRID, replies get the thread ID of what they reference
+            if not message.thread_id:
+                root = message.references[0] if message.references else message.in_reply_to
+                message.thread_id = self._thread_ids.get(root) or self._last_thread_id + 1
+            self._last_thread_id = max(self._last_thread_id, message.thread_id)
+            self._thread_ids.setdefault(message.message_id, message.thread_id)
+            folder.messages[message.uid] = message
+            return message.uid
+
+    def add_raw(self, raw: bytes, folder: str = "INBOX") -> int:
+        """Add an email sent over SMTP (only the headers and text that llmail uses are kept)"""
+        parsed = message_from_bytes(raw)
+        text = ""
+        for part in parsed.walk():
+            if part.get_content_type() == "text/plain":
+                text = part.get_payload(decode=True).decode(part.get_content_charset() or "utf-8")
+                break
+        return self.add(
+            FakeMessage(
+                message_id=parsed.get("Message-ID", f"<sent-{time.monotonic_ns()}@bench>"),
+                sender=parsed.get("From", ""),
+                recipient=parsed.get("To", ""),
+                subject=parsed.get("Subject", ""),
+                date=datetime.datetime.now(datetime.timezone.utc),
+                text=text,
+                in_reply_to=parsed.get("In-Reply-To"),
+                references=parsed.get("References", "").split(),
+            ),
+            folder,
+        )
+
+    def count(self) -> int:
+        return sum(len(folder.messages) for folder in self.folders.values())
+
+
+def seed(
+    mailbox: FakeMailbox,
+    count: int,
+    subject: str,
+    bot_email: str,
+    thread_lengths: list[int],
+    unanswered: float,
+    noise: float,
+    seed: int = 0,
+    folder: str = "INBOX",
+) -> int:
+    """Fill the mailbox with count emails and return how many threads need a reply.
+
+    Threads alternate between a user and the bot, starting with the user. Their lengths are picked
+    from thread_lengths. A share of them (unanswered) end with a user email, the others with the bot.
+    A share of the emails (noise) have another subject, so they should be skipped.
+    Threads are interleaved the way they would arrive, so replies come after other threads' emails.
+    """
+    random_ = random.Random(seed)
+    date = START_DATE
+    needs_reply = 0
+    open_threads: list[list[FakeMessage]] = []
+    added = 0
+    thread_number = 0
+
+    def next_date() -> datetime.datetime:
+        nonlocal date
+        date += datetime.timedelta(seconds=random_.randint(1, 120))
+        return date
+
+    # Build the threads first, then add their emails in (roughly) chronological order
+    while added < count:
+        thread_number += 1
+        if random_.random() < noise:
+            open_threads.append(
+                [
+                    FakeMessage(
+                        message_id=f"<noise-{added}@bench>",
+                        sender=f"Someone {added} <someone{added}@example.com>",
+                        recipient=bot_email,
+                        subject=f"Newsletter {added}",
+                        date=next_date(),
+                        text=f"Unrelated email {added}",
+                        thread_id=thread_number,
+                    )
+                ]
+            )
+            added += 1
+            continue
+        length = random_.choice(thread_lengths)
+        reply = random_.random() < unanswered
+        # An even length ends with the bot, an odd one with the user
+        if (length % 2 == 1) != reply:
+            length += 1
+        length = max(min(length, count - added), 1)
+        needs_reply += length % 2
+        user = f"User {thread_number} <user{thread_number}@example.com>"
+        thread = []
+        for position in range(length):
+            from_bot = position % 2 == 1
+            message_id = f"<t{thread_number}-{position}@bench>"
+            thread.append(
+                FakeMessage(
+                    message_id=message_id,
+                    sender=f"llmail <{bot_email}>" if from_bot else user,
+                    recipient=user if from_bot else bot_email,
+                    subject=subject if position == 0 else f"Re: {subject}",
+                    date=date,
+                    text=(
+                        f"Answer {position} in thread {thread_number}"
+                        if from_bot
+                        else f"Question {position} in thread {thread_number}?\n\nThanks,\nUser {thread_number}"
+                    ),
+                    in_reply_to=thread[-1].message_id if thread else None,
+                    references=[email.message_id for email in thread],
+                    thread_id=thread_number,
+                )
+            )
+        open_threads.append(thread)
+        added += length
+
+    # Interleave the threads: emails of a thread keep their order but other threads get in between
+    queue = [list(reversed(thread)) for thread in open_threads]
+    while queue:
+        index = random_.randrange(min(len(queue), 8))
+        message = queue[index].pop()
+        message.date = next_date()
+        mailbox.add(message, folder)
+        if not queue[index]:
+            queue.pop(index)
+    return needs_reply
+
+
+# IMAP
+
+
+class IMAPSyntaxError(Exception):
+    pass
+
+
+def quote(value: str | bytes | None) -> bytes:
+    """An IMAP string (quoted if possible, otherwise a literal) or NIL"""
+    if value is None:
+        return b"NIL"
+    if isinstance(value, str):
+        value = value.encode()
+    if b"\r" in value or b"\n" in value or not value.isascii():
+        return b"{%d}\r\n" % len(value) + value
+    return b'"' + value.replace(b"\\", b"\\\\").replace(b'"', b'\\"') + b'"'
+
+
+def address_list(header: str) -> bytes:
+    addresses = getaddresses([header]) if header else []
+    if not addresses:
+        return b"NIL"
+    items = []
+    for name, email in addresses:
+        mailbox, _, host = email.partition("@")
+        items.append(b"(" + b" ".join([quote(name or None), b"NIL", quote(mailbox), quote(host)]) + b")")
+    return b"(" + b"".join(items) + b")"
+
+
+def envelope(message: FakeMessage) -> bytes:
+    sender = address_list(message.sender)
+    return b"(" + b" ".join(
+        [
+            quote(format_datetime(message.date)),
+            quote(message.subject),
+            sender,
+            sender,
+            sender,
+            address_list(message.recipient),
+            b"NIL",
+            b"NIL",
+            quote(message.in_reply_to),
+            quote(message.message_id),
+        ]
+    ) + b")"
+
+
+def bodystructure(message: FakeMessage) -> bytes:
+    def text_part(subtype: bytes, content: bytes) -> bytes:
+        return b'("TEXT" "%s" ("CHARSET" "utf-8") NIL NIL "8BIT" %d %d NIL NIL NIL NIL)' % (
+            subtype,
+            len(content),
+            content.count(b"\n") + 1,
+        )
+
+    return (
+        b"("
+        + text_part(b"PLAIN", message.plain)
+        + text_part(b"HTML", message.html)
+        + b' "ALTERNATIVE" ("BOUNDARY" "%s") NIL NIL NIL)' % BOUNDARY.encode()
+    )
+
+
+def tokenize(line: bytes, literals: list[bytes]) -> list:
+    """Split the arguments of a command into atoms, strings and (nested) lists.
+    Literals were already read and are referred to by \\x00 followed by their index.
+    """
+    tokens = []
+    stack = [tokens]
+    position = 0
+    while position < len(line):
+        character = line[position : position + 1]
+        if character == b" ":
+            position += 1
+        elif character == b"(":
+            stack.append([])
+            stack[-2].append(stack[-1])
+            position += 1
+        elif character == b")":
+            if len(stack) == 1:
+                raise IMAPSyntaxError("Unbalanced parentheses")
+            stack.pop()
+            position += 1
+        elif character == b'"':
+            end = position + 1
+            value = bytearray()
+            while line[end : end + 1] != b'"':
+                if end >= len(line):
+                    raise IMAPSyntaxError("Unterminated string")
+                if line[end : end + 1] == b"\\":
+                    end += 1
+                value += line[end : end + 1]
+                end += 1
+            stack[-1].append(value.decode())
+            position = end + 1
+        elif character == b"\x00":
+            end = line.index(b"\x01", position)
+            stack[-1].append(literals[int(line[position + 1 : end])].decode())
+            position = end + 1
+        else:
+            # An atom, which can have a section with spaces and parentheses (BODY[HEADER.FIELDS (A B)])
+            end = position
+            depth = 0
+            while end < len(line):
+                current = line[end : end + 1]
+                if current == b"[":
+                    depth += 1
+                elif current == b"]":
+                    depth -= 1
+                elif depth == 0 and current in (b" ", b"(", b")"):
+                    break
+                end += 1
+            stack[-1].append(line[position:end].decode())
+            position = end
+    return tokens
+
+
+def parse_sequence(sequence: str, uids: list[int]) -> set[int]:
+    """UIDs in a sequence set like 1,3:5,7:*"""
+    highest = uids[-1] if uids else 0
+    result = set()
+    for part in sequence.split(","):
+        start, _, end = part.partition(":")
+        start = highest if start == "*" else int(start)
+        end = start if not end else (highest if end == "*" else int(end))
+        low, high = min(start, end), max(start, end)
+        if high - low < len(uids):
+            result.update(uid for uid in range(low, high + 1))
+        else:
+            result.update(uid for uid in uids if low <= uid <= high)
+    return result
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    server: "FakeIMAPServer"
+
+    def setup(self):
+        super().setup()
+        self.folder: Folder | None = None
+
+    def send(self, data: bytes):
+        self.wfile.write(data)
+        self.server.stats["bytes_sent"] += len(data)
+
+    def read_command(self) -> tuple[bytes, list[bytes]] | None:
+        """Read a command line, with any literals in it replaced by references to them"""
+        line = b""
+        literals = []
+        while True:
+            chunk = self.rfile.readline()
+            if not chunk:
+                return None
+            chunk = chunk.rstrip(b"\r\n")
+            match = re.search(rb"\{(\d+)(\+?)\}$", chunk)
+            if not match:
+                return line + chunk, literals
+            if not match.group(2):
+                self.send(b"+ Ready for literal\r\n")
+                self.wfile.flush()
+            literals.append(self.rfile.read(int(match.group(1))))
+            line += chunk[: match.start()] + b"\x00%d\x01" % (len(literals) - 1)
+
+    def handle(self):
+        self.send(b"* OK [CAPABILITY " + self.server.capabilities + b"] llmail benchmark server ready\r\n")
+        while True:
+            command = self.read_command()
+            if command is None:
+                return
+            line, literals = command
+            tag, _, rest = line.partition(b" ")
+            name, _, arguments = rest.partition(b" ")
+            name = name.decode().upper()
+            if name == "UID":
+                sub_name, _, arguments = arguments.partition(b" ")
+                name = f"UID {sub_name.decode().upper()}"
+            self.server.stats[name] += 1
+            self.server.stats["commands"] += 1
+            try:
+                tokens = tokenize(arguments, literals)
+                finished = self.dispatch(tag, name, tokens)
+            except (IMAPSyntaxError, ValueError, IndexError, KeyError) as e:
+                self.send(tag + b" BAD " + str(e).encode() + b"\r\n")
+                finished = False
+            self.wfile.flush()
+            if finished:
+                return
+
+    def dispatch(self, tag: bytes, name: str, tokens: list) -> bool:
+        mailbox = self.server.mailbox
+        match name:
+            case "CAPABILITY":
+                self.send(b"* CAPABILITY " + self.server.capabilities + b"\r\n")
+            case "LOGIN" | "NOOP" | "CHECK" | "ENABLE" | "UNSELECT":
+                pass
+            case "LOGOUT":
+                self.send(b"* BYE Logging out\r\n" + tag + b" OK LOGOUT completed\r\n")
+                return True
+            case "CLOSE":
+                self.folder = None
+            case "LIST" | "LSUB":
+                for folder in mailbox.folders:
+                    self.send(b'* %s (\\HasNoChildren) "/" %s\r\n' % (name.encode(), quote(folder)))
+            case "SELECT" | "EXAMINE":
+                self.folder = mailbox.folders.get(tokens[0])
+                if self.folder is None:
+                    self.send(tag + b" NO No such folder\r\n")
+                    return False
+                with mailbox.lock:
+                    self.send(
+                        b"* %d EXISTS\r\n* 0 RECENT\r\n* OK [UIDVALIDITY %d]\r\n* OK [UIDNEXT %d]\r\n"
+                        b"* OK [HIGHESTMODSEQ %d]\r\n* FLAGS (\\Seen \\Answered)\r\n"
+                        % (
+                            len(self.folder.messages),
+                            self.folder.uidvalidity,
+                            self.folder.uidnext,
+                            self.folder.highestmodseq,
+                        )
+                    )
+                access = b"READ-ONLY" if name == "EXAMINE" else b"READ-WRITE"
+                self.send(tag + b" OK [" + access + b"] " + name.encode() + b" completed\r\n")
+                return False
+            case "STATUS":
+                folder = mailbox.folders.get(tokens[0])
+                if folder is None:
+                    self.send(tag + b" NO No such folder\r\n")
+                    return False
+                values = {
+                    "MESSAGES": len(folder.messages),
+                    "UIDNEXT": folder.uidnext,
+                    "UIDVALIDITY": folder.uidvalidity,
+                    "UNSEEN": 0,
+                    "RECENT": 0,
+                    "HIGHESTMODSEQ": folder.highestmodseq,
+                }
+                items = " ".join(f"{item.upper()} {values[item.upper()]}" for item in tokens[1])
+                self.send(b"* STATUS " + quote(tokens[0]) + b" (" + items.encode() + b")\r\n")
+            case "UID SEARCH" | "SEARCH":
+                uids = self.search(tokens)
+                self.send(b"* SEARCH" + b"".join(b" %d" % uid for uid in uids) + b"\r\n")
+            case "UID THREAD" | "THREAD":
+                # The algorithm and charset aren't needed since the threads are known
+                uids = self.search(tokens[2:])
+                threads: dict[int, list[int]] = {}
+                for uid in uids:
+                    threads.setdefault(self.folder.messages[uid].thread_id, []).append(uid)
+                response = b"".join(
+                    b"(" + b" ".join(b"%d" % uid for uid in thread) + b")" for thread in threads.values()
+                )
+                self.send(b"* THREAD " + response + b"\r\n")
+            case "UID FETCH" | "FETCH":
+                self.fetch(tokens[0], tokens[1] if isinstance(tokens[1], list) else tokens[1:])
+            case _:
+                self.send(tag + b" BAD Unknown command " + name.encode() + b"\r\n")
+                return False
+        self.send(tag + b" OK " + name.encode() + b" completed\r\n")
+        return False
+
+    def search(self, criteria: list) -> list[int]:
+        if self.folder is None:
+            raise IMAPSyntaxError("No folder selected")
+        if criteria and isinstance(criteria[0], str) and criteria[0].upper() == "CHARSET":
+            criteria = criteria[2:]
+        with self.server.mailbox.lock:
+            messages = list(self.folder.messages.values())
+        uids = [message.uid for message in messages]
+        return [
+            message.uid
+            for message in messages
+            if self.matches(list(criteria), message, uids)
+        ]
+
+    def matches(self, criteria: list, message: FakeMessage, uids: list[int]) -> bool:
+        """Whether the message matches all the criteria (consumed from the list)"""
+        result = True
+        while criteria:
+            result = self.match_one(criteria, message, uids) and result
+        return result
+
+    def match_one(self, criteria: list, message: FakeMessage, uids: list[int]) -> bool:
+        key = criteria.pop(0)
+        if isinstance(key, list):
+            return self.matches(key, message, uids)
+        key = key.upper()
+        match key:
+            case "ALL" | "SEEN":
+                return True
+            case "UNSEEN":
+                return False
+            case "OR":
+                first = self.match_one(criteria, message, uids)
+                second = self.match_one(criteria, message, uids)
+                return first or second
+            case "NOT":
+                return not self.match_one(criteria, message, uids)
+            case "UID":
+                return message.uid in self._sequence(criteria.pop(0), uids)
+            case "SUBJECT" | "FROM" | "TO":
+                return criteria.pop(0).lower() in message.header_value(key).lower()
+            case "HEADER":
+                name = criteria.pop(0)
+                return criteria.pop(0).lower() in message.header_value(name).lower()
+            case "X-GM-THRID":
+                return message.thread_id == int(criteria.pop(0))
+        if re.fullmatch(r"[\d:*,]+", key):
+            return message.uid in self._sequence(key, uids)
+        raise IMAPSyntaxError(f"Unsupported search key {key}")
+
+    def _sequence(self, sequence: str, uids: list[int]) -> set[int]:
+        # Searches check every message, so the parsed set is reused for all of them
+        cache = getattr(self, "_sequence_cache", None)
+        if cache is None or cache[0] != (sequence, len(uids)):
+            cache = ((sequence, len(uids)), parse_sequence(sequence, uids))
+            self._sequence_cache = cache
+        return cache[1]
+
+    def fetch(self, sequence: str, items: list[str]):
+        if self.folder is None:
+            raise IMAPSyntaxError("No folder selected")
+        with self.server.mailbox.lock:
+            messages = dict(self.folder.messages)
+        uids = list(messages)
+        for sequence_number, uid in enumerate(sorted(parse_sequence(sequence, uids)), start=1):
+            message = messages.get(uid)
+            if message is None:
+                continue
+            self.server.stats["messages_fetched"] += 1
+            parts = [b"UID %d" % uid]
+            for item in items:
+                parts.append(self.fetch_item(item, message))
+            self.send(b"* %d FETCH (" % sequence_number + b" ".join(parts) + b")\r\n")
+
+    def fetch_item(self, item: str, message: FakeMessage) -> bytes:
+        upper = item.upper()
+        match upper:
+            case "UID":
+                return b"UID %d" % message.uid
+            case "ENVELOPE":
+                return b"ENVELOPE " + envelope(message)
+            case "BODYSTRUCTURE" | "BODY":
+                return upper.encode() + b" " + bodystructure(message)
+            case "FLAGS":
+                return b"FLAGS (\\Seen)"
+            case "RFC822.SIZE":
+                return b"RFC822.SIZE %d" % (len(message.header) + len(message.body))
+            case "INTERNALDATE":
+                return b"INTERNALDATE " + quote(message.date.strftime("%d-%b-%Y %H:%M:%S %z"))
+            case "X-GM-THRID":
+                return b"X-GM-THRID %d" % message.thread_id
+            case "MODSEQ":
+                return b"MODSEQ (%d)" % message.modseq
+            case "RFC822.HEADER":
+                return b"RFC822.HEADER " + quote(message.header)
+            case "RFC822":
+                return b"RFC822 " + quote(message.header + message.body)
+        match = re.fullmatch(r"BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?", upper)
+        if not match:
+            raise IMAPSyntaxError(f"Unsupported fetch item {item}")
+        section, offset, length = match.groups()
+        content = {
+            "": message.header + message.body,
+            "HEADER": message.header,
+            "TEXT": message.body,
+            "1": message.plain,
+            "2": message.html,
+        }.get(section)
+        if content is None:
+            raise IMAPSyntaxError(f"Unsupported section {section}")
+        key = f"BODY[{section}]".encode()
+        if offset is not None:
+            content = content[int(offset) : int(offset) + int(length)]
+            key += f"<{offset}>".encode()
+        return key + b" " + quote(content)
+
+
+class _TLSServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, context: ssl.SSLContext, handler):
+        self.context = context
+        self.stats = Counter()
+        super().__init__(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True).start()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def get_request(self):
+        connection, address = super().get_request()
+        # The handshake is done in the handler's thread instead of the one accepting connections
+        return self.context.wrap_socket(connection, server_side=True, do_handshake_on_connect=False), address
+
+    def finish_request(self, request, client_address):
+        try:
+            request.do_handshake()
+        except (ssl.SSLError, OSError):
+            return
+        super().finish_request(request, client_address)
+
+    def take_stats(self) -> Counter:
+        """Return the counts since the last call and reset them"""
+        stats = self.stats
+        self.stats = Counter()
+        return stats
+
+
+class FakeIMAPServer(_TLSServer):
+    """IMAP server for a FakeMailbox. threading is "headers", "thread" or "gmail", which decides
+    which threading extension is advertised (and so which one llmail uses)
+    """
+
+    def __init__(self, mailbox: FakeMailbox, context: ssl.SSLContext, threading_backend: str = "headers"):
+        self.mailbox = mailbox
+        capabilities = ["IMAP4rev1", "LITERAL+", "CONDSTORE", "UIDPLUS", "AUTH=PLAIN"]
+        if threading_backend == "thread":
+            capabilities.append("THREAD=REFERENCES")
+        elif threading_backend == "gmail":
+            capabilities.append("X-GM-EXT-1")
+        self.capabilities = " ".join(capabilities).encode()
+        super().__init__(context, IMAPHandler)
+
+
+# SMTP
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    server: "SMTPSink"
+
+    def reply(self, line: str):
+        self.wfile.write(f"{line}\r\n".encode())
+        self.wfile.flush()
+
+    def handle(self):
+        self.reply("220 localhost llmail benchmark sink")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").strip()
+            verb = command.split(" ", 1)[0].upper()
+            self.server.stats[verb] += 1
+            self.server.stats["commands"] += 1
+            match verb:
+                case "EHLO":
+                    self.wfile.write(b"250-localhost\r\n250-AUTH PLAIN LOGIN\r\n250-8BITMIME\r\n250 SIZE 52428800\r\n")
+                    self.wfile.flush()
+                case "HELO":
+                    self.reply("250 localhost")
+                case "AUTH":
+                    if command.upper().startswith("AUTH LOGIN"):
+                        # Username and password are each sent on their own line
+                        self.reply("334 " + base64.b64encode(b"Username:").decode())
+                        self.rfile.readline()
+                        self.reply("334 " + base64.b64encode(b"Password:").decode())
+                        self.rfile.readline()
+                    self.reply("235 Authenticated")
+                case "MAIL" | "RCPT" | "RSET" | "NOOP":
+                    self.reply("250 OK")
+                case "DATA":
+                    self.reply("354 End data with <CR><LF>.<CR><LF>")
+                    lines = []
+                    while (data_line := self.rfile.readline()) not in (b".\r\n", b".\n", b""):
+                        # Dot-stuffing
+                        lines.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                    self.server.received(b"".join(lines))
+                    self.reply("250 Queued")
+                case "QUIT":
+                    self.reply("221 Bye")
+                    return
+                case _:
+                    self.reply("502 Not implemented")
+
+
+class SMTPSink(_TLSServer):
+    """SMTP server (with implicit TLS) that adds every email it gets to the mailbox"""
+
+    def __init__(self, mailbox: FakeMailbox, context: ssl.SSLContext, folder: str = "INBOX"):
+        self.mailbox = mailbox
+        self.folder = folder
+        super().__init__(context, SMTPHandler)
+
+    def received(self, raw: bytes):
+        self.stats["emails"] += 1
+        self.mailbox.add_raw(raw, self.folder)
+
+
+# LLM
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    server: "MockLLM"
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        # Such as GET /v1/models
+        self.send_json({"object": "list", "data": [{"id": self.server.model, "object": "model"}]})
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        self.server.count("requests")
+        messages = request.get("messages", [])
+        last = messages[-1].get("content", "") if messages else ""
+        # The same conversation always gets the same reply
+        digest = hashlib.sha256(json.dumps(messages, sort_keys=True).encode()).hexdigest()[:12]
+        reply = f"This is reply {digest} to: {str(last)[:80]}"
+        words = reply.split(" ")
+        prompt_tokens = sum(len(str(message.get("content", "")).split()) for message in messages)
+        self.server.count("prompt_tokens", prompt_tokens)
+        self.server.count("completion_tokens", len(words))
+        time.sleep(self.server.latency)
+        common = {"id": f"chatcmpl-{digest}", "created": int(time.time()), "model": self.server.model}
+        if not request.get("stream"):
+            self.send_json(
+                {
+                    **common,
+                    "object": "chat.completion",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": reply},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": len(words),
+                        "total_tokens": prompt_tokens + len(words),
+                    },
+                }
+            )
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for number, word in enumerate(words):
+            delta = {"content": word if number == 0 else f" {word}"}
+            if number == 0:
+                delta["role"] = "assistant"
+            self.send_event(
+                {
+                    **common,
+                    "object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+                }
+            )
+            if self.server.token_latency:
+                time.sleep(self.server.token_latency)
+        self.send_event(
+            {
+                **common,
+                "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            }
+        )
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def send_event(self, data: dict):
+        self.wfile.write(b"data: " + json.dumps(data).encode() + b"\n\n")
+        self.wfile.flush()
+
+    def send_json(self, data: dict):
+        content = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format: str, *log_args):
+        pass
+
+
+class MockLLM(ThreadingHTTPServer):
+    """OpenAI-compatible endpoint (at /v1) that answers every request after latency seconds,
+    plus token_latency seconds for each streamed word
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.0, token_latency: float = 0.0, model: str = "bench-model"):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.model = model
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), MockLLMHandler)
+        threading.Thread(target=self.serve_forever, name="MockLLM", daemon=True).start()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def count(self, name: str, amount: int = 1):
+        with self._stats_lock:
+            self.stats[name] += amount
+
+    def take_stats(self) -> Counter:
+        with self._stats_lock:
+            stats = self.stats
+            self.stats = Counter()
+        return stats
+
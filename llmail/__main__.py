@@ -1,21 +1,49 @@
 import time
-from imapclient import IMAPClient
-from llmail.utils import logger, args, responding
+from llmail.utils import logger, args
+from llmail.utils.cli_args import set_argparse
 
 
-def main():
+def main(argv: list[str] | None = None):
     """Main entry point for the script."""
+    set_argparse(argv)
+    # The modules for each subcommand are imported when it runs, so list-folders doesn't have to
+    # load the LLM and email-sending libraries
     match args.subcommand:
         case "list-folders":
-            with IMAPClient(args.imap_host) as client:
+            from imapclient import IMAPClient
+
+            with IMAPClient(args.imap_host, port=int(args.imap_port)) as client:
                 client.login(args.imap_username, args.imap_password)
                 folders = client.list_folders()
                 for folder in folders:
                     print(folder[2])
+        case None if args.config:
+            from llmail.utils import scheduler
+
+            logger.debug(args)
+            scheduler.serve(args.config)
         case None:
+            from llmail.utils import idle, llm, metrics, responding
+
             logger.debug(args)
             logger.info(f'Looking for emails that match the subject key "{args.subject_key}"')
-            if args.watch_interval:
+            if args.metrics_port:
+                metrics.serve(args.metrics_host, args.metrics_port)
+            # Set up the LLM client and tools once instead of for every reply
+            llm.prepare()
+            if args.idle:
+                # IDLE needs a selected folder so all folders can't be watched like with polling
+                folders = args.folder if args.folder else ["INBOX"]
+                logger.info(f"Watching {', '.join(folders)} for new emails with IMAP IDLE")
+                idle.watch(
+                    lambda: responding.fetch_and_process_emails(
+                        look_for_subject=args.subject_key,
+                        alias=args.alias,
+                        system_prompt=args.system_prompt,
+                    ),
+                    folders,
+                )
+            elif args.watch_interval:
                 logger.info(f"Watching for new emails every {args.watch_interval} seconds")
                 while True:
                     responding.fetch_and_process_emails(
@@ -23,9 +51,8 @@ def main():
                         alias=args.alias,
                         system_prompt=args.system_prompt,
                     )
+                    # Threads are kept between cycles since only new emails are fetched
                     time.sleep(args.watch_interval)
-                    # **EMPTY THREADS**
-                    responding.email_threads = {}
             else:
                 responding.fetch_and_process_emails(
                     look_for_subject=args.subject_key,
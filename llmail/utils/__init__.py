@@ -1,5 +1,13 @@
 from llmail.utils.logging import set_primary_logger, logger
-from llmail.utils.cli_args import args, bot_email
+from llmail.utils.cli_args import args
+
+
+def __getattr__(name: str):
+    # bot_email is only known once the arguments are parsed
+    if name == "bot_email":
+        return args.bot_email
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 # https://stackoverflow.com/a/31079085
-__all__ = ["set_primary_logger", "logger", "args", bot_email]
+__all__ = ["set_primary_logger", "logger", "args", "bot_email"]
@@ -0,0 +1,239 @@
+"""
+Fetching only the text of an email instead of the whole message.
+The BODYSTRUCTURE (fetched with the headers) says which section holds the text and how it's encoded,
+so only that section is fetched, up to a byte limit. Attachments are never downloaded.
+The cleaned up text is cached by Message-ID (or a hash of the section), so an email that was already
+seen isn't fetched or converted again.
+"""
+
+import base64
+import binascii
+import hashlib
+import quopri
+import threading
+from collections import OrderedDict
+from typing import Iterator
+
+from imapclient import IMAPClient
+from imapclient.response_types import BodyData
+
+from llmail.utils import logger
+from llmail.utils.cli_args import args
+from llmail.utils.state import StateStore, get_store
+from llmail.utils.utils import clean_text, decode_text, fetch_in_batches
+
+# Order in which parts are picked if there isn't a text/plain part
+TEXT_TYPES = ("text/plain", "text/html")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS body_cache (
+    key TEXT PRIMARY KEY,
+    text TEXT NOT NULL
+);
+"""
+
+
+class TextPart:
+    """The section of an email that holds its text and what's needed to decode it"""
+
+    __slots__ = ("section", "content_type", "encoding", "charset", "size")
+
+    def __init__(self, section: str, content_type: str, encoding: str, charset: str, size: int):
+        self.section = section
+        self.content_type = content_type
+        self.encoding = encoding
+        self.charset = charset
+        self.size = size
+
+    def __repr__(self):
+        return f"TextPart(section={self.section}, content_type={self.content_type}, size={self.size})"
+
+
+def _decode_atom(value) -> str:
+    if isinstance(value, bytes):
+        return value.decode("ascii", errors="replace")
+    return str(value) if value is not None else ""
+
+
+def _parameters(value) -> dict[str, str]:
+    """Turn a parameter list from BODYSTRUCTURE ((key, value, key, value...)) into a dict"""
+    if not isinstance(value, tuple):
+        return {}
+    return {
+        _decode_atom(value[i]).lower(): _decode_atom(value[i + 1])
+        for i in range(0, len(value) - 1, 2)
+    }
+
+
+def _is_attachment(part: BodyData, content_type: str) -> bool:
+    # The disposition comes after the MD5 in the extension data, which comes after the line count for text
+    disposition_index = 9 if content_type.startswith("text/") else 8
+    if len(part) <= disposition_index or not isinstance(part[disposition_index], tuple):
+        return False
+    return _decode_atom(part[disposition_index][0]).lower() == "attachment"
+
+
+def _text_parts(bodystructure: BodyData, section: str = "") -> Iterator[TextPart]:
+    """Yield the text parts in the order they appear in the email"""
+    if bodystructure.is_multipart:
+        for number, part in enumerate(bodystructure[0], start=1):
+            yield from _text_parts(part, f"{section}.{number}" if section else str(number))
+        return
+    content_type = f"{_decode_atom(bodystructure[0])}/{_decode_atom(bodystructure[1])}".lower()
+    if content_type not in TEXT_TYPES or _is_attachment(bodystructure, content_type):
+        return
+    yield TextPart(
+        # A message that isn't multipart still has a part 1, which is the whole body
+        section=section or "1",
+        content_type=content_type,
+        encoding=_decode_atom(bodystructure[5]).lower(),
+        charset=_parameters(bodystructure[2]).get("charset", "utf-8"),
+        size=bodystructure[6] if isinstance(bodystructure[6], int) else 0,
+    )
+
+
+def find_text_part(bodystructure: BodyData) -> TextPart | None:
+    """Find the part with the text of the email, preferring text/plain over text/html"""
+    parts = list(_text_parts(bodystructure))
+    for content_type in TEXT_TYPES:
+        for part in parts:
+            if part.content_type == content_type:
+                return part
+    return None
+
+
+def decode_part(raw: bytes, part: TextPart) -> str:
+    """Decode the (possibly truncated) section with its transfer encoding and charset"""
+    match part.encoding:
+        case "base64":
+            raw = b"".join(raw.split())
+            # If only the start of the section was fetched, the last group of 4 might be incomplete
+            raw = raw[: len(raw) - len(raw) % 4]
+            try:
+                raw = base64.b64decode(raw)
+            except binascii.Error:
+                logger.debug("Failed to decode base64 in section {}", part.section)
+                raw = b""
+        case "quoted-printable":
+            raw = quopri.decodestring(raw)
+    return decode_text(raw, part.charset)
+
+
+def _section_data(data: dict) -> bytes:
+    # The server answers BODY.PEEK[1]<0.100> with BODY[1]<0> so the key is found by its prefix
+    for key, value in data.items():
+        if isinstance(key, bytes) and key.startswith(b"BODY[") and value is not None:
+            return value
+    return b""
+
+
+def fetch_texts(
+    client: IMAPClient,
+    emails: dict[int, tuple[BodyData, str | None]],
+    max_bytes: int,
+    batch_size: int = 100,
+) -> dict[int, str]:
+    """Fetch the cleaned up text of each email without its attachments.
+
+    emails maps UIDs to (BODYSTRUCTURE, Message-ID). Emails in the cache aren't fetched.
+    The rest are grouped by section so each group can be fetched in batches with a single data item.
+    If max_bytes is set, at most that many bytes of each section are fetched.
+    """
+    cache = get_cache()
+    texts = {}
+    sections: dict[str, list[tuple[int, TextPart]]] = {}
+    for msg_id, (bodystructure, message_id) in emails.items():
+        if message_id and (text := cache.get(message_id)) is not None:
+            texts[msg_id] = text
+            continue
+        part = find_text_part(bodystructure)
+        if part is None:
+            logger.debug("Email with UID {} has no text part", msg_id)
+            texts[msg_id] = ""
+            continue
+        sections.setdefault(part.section, []).append((msg_id, part))
+
+    for section, section_emails in sections.items():
+        # PEEK so that reading the email doesn't mark it as read
+        item = f"BODY.PEEK[{section}]" + (f"<0.{max_bytes}>" if max_bytes else "")
+        parts = dict(section_emails)
+        for msg_id, data in fetch_in_batches(client, list(parts), [item], batch_size):
+            part = parts[msg_id]
+            if max_bytes and part.size > max_bytes:
+                logger.debug(
+                    "Only fetched {} of {} bytes of the text of email with UID {}", max_bytes, part.size, msg_id
+                )
+            raw = _section_data(data)
+            message_id = emails[msg_id][1]
+            # Emails without a Message-ID are cached by their content, which at least skips the conversion
+            key = message_id or hashlib.sha256(part.content_type.encode() + raw).hexdigest()
+            text = cache.get(key)
+            if text is None:
+                text = clean_text(decode_part(raw, part), part.content_type)
+                cache.set(key, text)
+            texts[msg_id] = text
+    return texts
+
+
+class TextCache:
+    """Bounded LRU cache of the cleaned up text of emails.
+    If a store is given, the texts are also saved there so they survive restarts (with the same bound).
+    """
+
+    def __init__(self, size: int, store: StateStore | None = None):
+        self.size = max(size, 0)
+        self.store = store
+        self._texts: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        if self.store is not None:
+            self.store.ensure_schema(SCHEMA)
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            if key in self._texts:
+                self._texts.move_to_end(key)
+                return self._texts[key]
+        if self.store is None:
+            return None
+        rows = self.store.execute("SELECT text FROM body_cache WHERE key = ?", (key,))
+        if not rows:
+            return None
+        self._remember(key, rows[0][0])
+        return rows[0][0]
+
+    def set(self, key: str, text: str):
+        self._remember(key, text)
+        if self.store is None:
+            return
+        self.store.execute("INSERT OR REPLACE INTO body_cache (key, text) VALUES (?, ?)", (key, text))
+        self._writes += 1
+        # Trimming the table takes a scan, so it's only done every so often
+        if self._writes % 100 == 0:
+            self.store.execute(
+                "DELETE FROM body_cache WHERE rowid NOT IN "
+                "(SELECT rowid FROM body_cache ORDER BY rowid DESC LIMIT ?)",
+                (self.size,),
+            )
+
+    def _remember(self, key: str, text: str):
+        with self._lock:
+            self._texts[key] = text
+            self._texts.move_to_end(key)
+            while len(self._texts) > self.size:
+                self._texts.popitem(last=False)
+
+
+_caches: dict[tuple, TextCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache() -> TextCache:
+    """Get the text cache for the configured size (saved in the state file if --persist-body-cache is set)"""
+    key = (args.body_cache_size, args.persist_body_cache and args.state_file)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = TextCache(
+                args.body_cache_size, get_store() if args.persist_body_cache else None
+            )
+        return _caches[key]
@@ -1,6 +1,9 @@
 import argparse
+import contextvars
 import os
 import sys
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 
 import dotenv
@@ -14,8 +17,69 @@ For reference, Gmail's IMAP settings are:
 """
 
 
-def set_argparse():
-    global args
+class Args:
+    """The parsed arguments. Values can be overridden for the current context (such as the settings of
+    one mailbox when running several with --config) so everything that reads args gets those values.
+    main parses the arguments with set_argparse. Otherwise (such as in worker processes or benchmarks)
+    they're parsed from sys.argv the first time one is read.
+    """
+
+    def __init__(self):
+        self._namespace = argparse.Namespace()
+        self._parsed = False
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        self._ensure_parsed()
+        overrides = _overrides.get()
+        if overrides is not None and name in overrides:
+            return overrides[name]
+        return getattr(self._namespace, name)
+
+    def __repr__(self):
+        self._ensure_parsed()
+        return repr(argparse.Namespace(**{**vars(self._namespace), **(_overrides.get() or {})}))
+
+    def names(self) -> set[str]:
+        """Names of all the arguments"""
+        self._ensure_parsed()
+        return set(vars(self._namespace))
+
+    def _ensure_parsed(self):
+        if not self._parsed:
+            with self._lock:
+                if not self._parsed:
+                    set_argparse()
+
+
+_overrides: contextvars.ContextVar[dict | None] = contextvars.ContextVar("overrides", default=None)
+
+
+@contextmanager
+def override(values: dict):
+    """Override arguments for the code run in the with block (and threads started with its context)"""
+    token = _overrides.set({**(_overrides.get() or {}), **values})
+    try:
+        yield
+    finally:
+        _overrides.reset(token)
+
+
+args = Args()
+
+
+def __getattr__(name: str):
+    # Setting bot_email instead of using imap_username directly in case support is needed for imap_username and bot_email being different
+    # It's read from args so it's only available once the arguments are parsed (and follows overrides)
+    if name == "bot_email":
+        return args.bot_email
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def set_argparse(argv: list[str] | None = None):
+    """Load .env and parse the arguments (from sys.argv if argv isn't given), then set up logging"""
 
     if Path(".env").is_file():
         dotenv.load_dotenv()
@@ -45,6 +109,64 @@ def set_argparse():
         type=int,
         default=(int(os.getenv("WATCH_INTERVAL")) if os.getenv("WATCH_INTERVAL") else None),
     )
+    argparser.add_argument(
+        "--idle",
+        help="Use IMAP IDLE to get notified of new emails instead of checking every --watch-interval seconds. "
+        "Watches the folders set with --folder (or INBOX). Falls back to polling if the server doesn't support IDLE",
+        action="store_true",
+        default=(
+            True
+            if (
+                os.getenv("IDLE")
+                and os.getenv("IDLE").lower() == "true"
+                and os.getenv("IDLE").lower() != "false"
+            )
+            else False
+        ),
+    )
+    argparser.add_argument(
+        "--config",
+        help="JSON file listing several mailboxes to serve from this process (see README). "
+        "Each mailbox can set any of the other options, which are used as defaults",
+        default=os.getenv("CONFIG_FILE") if os.getenv("CONFIG_FILE") else None,
+    )
+    argparser.add_argument(
+        "--mailbox-workers",
+        help="With --config, number of mailboxes that can be checked at the same time",
+        type=int,
+        default=(int(os.getenv("MAILBOX_WORKERS")) if os.getenv("MAILBOX_WORKERS") else 4),
+    )
+    argparser.add_argument(
+        "--processes",
+        help="With --config, number of worker processes to split the mailboxes between",
+        type=int,
+        default=(int(os.getenv("PROCESSES")) if os.getenv("PROCESSES") else 1),
+    )
+    argparser.add_argument(
+        "--state-file",
+        help="SQLite file used to remember the last seen UID in each folder between runs",
+        default=os.getenv("STATE_FILE") if os.getenv("STATE_FILE") else "llmail.db",
+    )
+    argparser.add_argument(
+        "--body-cache-size",
+        help="Number of email texts (after converting and removing quotes and signatures) to keep in memory",
+        type=int,
+        default=(int(os.getenv("BODY_CACHE_SIZE")) if os.getenv("BODY_CACHE_SIZE") else 1000),
+    )
+    argparser.add_argument(
+        "--persist-body-cache",
+        help="Also save the email texts in --state-file so they don't have to be fetched again after a restart",
+        action="store_true",
+        default=(
+            True
+            if (
+                os.getenv("PERSIST_BODY_CACHE")
+                and os.getenv("PERSIST_BODY_CACHE").lower() == "true"
+                and os.getenv("PERSIST_BODY_CACHE").lower() != "false"
+            )
+            else False
+        ),
+    )
     # OpenAI-compatible API arguments
     ai_api = argparser.add_argument_group("OpenAI-compatible API")
     ai_api.add_argument(
@@ -70,8 +192,66 @@ def set_argparse():
             else "mistralai/mistral-7b-instruct:free"
         ),
     )
+    ai_api.add_argument(
+        "--max-concurrent-llm-requests",
+        help="Maximum number of requests sent to the LLM provider at once. "
+        "Defaults to 1 for Ollama and --max-concurrent-replies for other providers",
+        type=int,
+        default=(
+            int(os.getenv("MAX_CONCURRENT_LLM_REQUESTS"))
+            if os.getenv("MAX_CONCURRENT_LLM_REQUESTS")
+            else None
+        ),
+    )
     # AI-related arguments
     ai = argparser.add_argument_group("AI")
+    ai.add_argument(
+        "--max-concurrent-replies",
+        help="Number of threads to generate and send replies for at the same time",
+        type=int,
+        default=(
+            int(os.getenv("MAX_CONCURRENT_REPLIES")) if os.getenv("MAX_CONCURRENT_REPLIES") else 1
+        ),
+    )
+    ai.add_argument(
+        "--reply-timeout",
+        help="Seconds to wait for a reply to be generated (including tool calls and summarizing the thread) before giving up on it (0 for no limit)",
+        type=int,
+        default=(int(os.getenv("REPLY_TIMEOUT")) if os.getenv("REPLY_TIMEOUT") else 300),
+    )
+    ai.add_argument(
+        "--timeout-reply",
+        help="Reply to send if generating a reply times out. If not set, the email is tried again next time",
+        default=os.getenv("TIMEOUT_REPLY") if os.getenv("TIMEOUT_REPLY") else None,
+    )
+    ai.add_argument(
+        "--max-output-tokens",
+        help="Maximum number of tokens the LLM can generate for a reply",
+        type=int,
+        default=(int(os.getenv("MAX_OUTPUT_TOKENS")) if os.getenv("MAX_OUTPUT_TOKENS") else None),
+    )
+    ai.add_argument(
+        "--context-token-budget",
+        help="Maximum number of tokens of the thread to send to the LLM. "
+        "Older emails in longer threads are replaced with a summary (0 to always send the whole thread)",
+        type=int,
+        default=(
+            int(os.getenv("CONTEXT_TOKEN_BUDGET")) if os.getenv("CONTEXT_TOKEN_BUDGET") else 8000
+        ),
+    )
+    ai.add_argument(
+        "--response-cache-ttl",
+        help="Reuse the response to an identical thread for this many seconds instead of asking the LLM again. "
+        "Responses are saved in --state-file (0 to disable)",
+        type=int,
+        default=(int(os.getenv("RESPONSE_CACHE_TTL")) if os.getenv("RESPONSE_CACHE_TTL") else 0),
+    )
+    ai.add_argument(
+        "--response-cache-size",
+        help="Maximum number of responses to cache. The least recently used are removed first",
+        type=int,
+        default=(int(os.getenv("RESPONSE_CACHE_SIZE")) if os.getenv("RESPONSE_CACHE_SIZE") else 1000),
+    )
     argparser.add_argument(
         "--exa-api-key",
         help="Exa API key for searching with Exa (disables DuckDuckGo)",
@@ -97,12 +277,46 @@ def set_argparse():
             else False
         ),
     )
+    ai.add_argument(
+        "--tool-cache-size",
+        help="Number of tool results (web pages and searches) to reuse between conversations (0 to disable)",
+        type=int,
+        default=(int(os.getenv("TOOL_CACHE_SIZE")) if os.getenv("TOOL_CACHE_SIZE") else 256),
+    )
     ai.add_argument(
         "--system-prompt",
         help="Prepend this to the message history sent to the LLM as a message from the system role",
         default=os.getenv("SYSTEM_PROMPT") if os.getenv("SYSTEM_PROMPT") else None,
     )
 
+    # Rate limiting arguments
+    # Replies that would go over a limit wait in the queue and are sent as soon as there's room
+    limits = argparser.add_argument_group("Rate limiting")
+    limits.add_argument(
+        "--llm-requests-per-minute",
+        help="Maximum number of requests sent to the LLM provider per minute",
+        type=int,
+        default=(int(os.getenv("LLM_REQUESTS_PER_MINUTE")) if os.getenv("LLM_REQUESTS_PER_MINUTE") else None),
+    )
+    limits.add_argument(
+        "--llm-tokens-per-minute",
+        help="Maximum number of tokens (sent and generated) per minute for the LLM provider",
+        type=int,
+        default=(int(os.getenv("LLM_TOKENS_PER_MINUTE")) if os.getenv("LLM_TOKENS_PER_MINUTE") else None),
+    )
+    limits.add_argument(
+        "--smtp-sends-per-hour",
+        help="Maximum number of replies sent per hour",
+        type=int,
+        default=(int(os.getenv("SMTP_SENDS_PER_HOUR")) if os.getenv("SMTP_SENDS_PER_HOUR") else None),
+    )
+    limits.add_argument(
+        "--sender-replies-per-hour",
+        help="Maximum number of replies sent to the same person per hour. Their other emails are replied to later",
+        type=int,
+        default=(int(os.getenv("SENDER_REPLIES_PER_HOUR")) if os.getenv("SENDER_REPLIES_PER_HOUR") else None),
+    )
+
     # Email arguments
     email = argparser.add_argument_group("Email")
     email.add_argument(
@@ -137,6 +351,30 @@ def set_argparse():
         help="IMAP server password",
         default=os.getenv("IMAP_PASSWORD"),
     )
+    imap.add_argument(
+        "--imap-pool-size",
+        help="Number of IMAP connections to keep open. More than 1 lets folders be scanned in parallel",
+        type=int,
+        default=(int(os.getenv("IMAP_POOL_SIZE")) if os.getenv("IMAP_POOL_SIZE") else 1),
+    )
+    imap.add_argument(
+        "--folder-cache-ttl",
+        help="How long (in seconds) to reuse the list of folders before asking the server again",
+        type=int,
+        default=(int(os.getenv("FOLDER_CACHE_TTL")) if os.getenv("FOLDER_CACHE_TTL") else 600),
+    )
+    imap.add_argument(
+        "--fetch-batch-size",
+        help="Maximum number of emails to request in a single IMAP FETCH command",
+        type=int,
+        default=(int(os.getenv("FETCH_BATCH_SIZE")) if os.getenv("FETCH_BATCH_SIZE") else 100),
+    )
+    imap.add_argument(
+        "--max-body-bytes",
+        help="Maximum number of bytes of the text of each email to fetch (0 for no limit). Attachments are never fetched",
+        type=int,
+        default=(int(os.getenv("MAX_BODY_BYTES")) if os.getenv("MAX_BODY_BYTES") else 65536),
+    )
     smtp = email.add_argument_group("SMTP")
     smtp.add_argument("--smtp-host", help="SMTP server hostname", default=os.getenv("SMTP_HOST"))
     smtp.add_argument("--smtp-port", help="SMTP server port", default=os.getenv("SMTP_PORT"))
@@ -164,6 +402,12 @@ def set_argparse():
         help="Log level",
         default=os.getenv("LOG_LEVEL") if os.getenv("LOG_LEVEL") else "INFO",
     )
+    debug.add_argument(
+        "--log-format",
+        help="Format of the log lines. json writes one JSON object per line, for log shippers",
+        choices=["text", "json"],
+        default=os.getenv("LOG_FORMAT") if os.getenv("LOG_FORMAT") else "text",
+    )
     debug.add_argument(
         "--redact-email-addresses",
         help="Replace email addresses with '[redacted]' in logs",
@@ -178,6 +422,18 @@ def set_argparse():
             else False
         ),
     )
+    debug.add_argument(
+        "--metrics-port",
+        help="Serve metrics in the Prometheus text format on this port (at /metrics). "
+        "With --processes, worker n uses this port plus n",
+        type=int,
+        default=(int(os.getenv("METRICS_PORT")) if os.getenv("METRICS_PORT") else None),
+    )
+    debug.add_argument(
+        "--metrics-host",
+        help="Address to serve the metrics on. Use 0.0.0.0 to make them reachable from outside (such as from Docker)",
+        default=os.getenv("METRICS_HOST") if os.getenv("METRICS_HOST") else "127.0.0.1",
+    )
     debug.add_argument(
         "--show-tool-calls",
         help="Pass show_tool_calls=True to phidata",
@@ -206,39 +462,42 @@ def set_argparse():
             else False
         ),
     )
-    check_required_args(
-        [
-            "imap_host",
-            "imap_port",
-            "imap_username",
-            "imap_password",
-            "smtp_host",
-            "smtp_port",
-            "smtp_username",
-            "smtp_password",
-            # "llm_api_key",
-            # "llm_base_url",
-        ],
-        argparser,
-    )
-    args = argparser.parse_args()
-    # Setting bot_email instead of using imap_username directly in case support is needed for imap_username and bot_email being different
-    global bot_email
-    bot_email = args.imap_username
+    namespace = argparser.parse_args(argv)
+    # With --config, the account details are in the file
+    if namespace.config is None:
+        check_required_args(REQUIRED_ARGS, namespace)
+    # Also available as cli_args.bot_email
+    namespace.bot_email = namespace.imap_username
+    args._namespace = namespace
+    args._parsed = True
+
+    # Imported here since logging is what's configured with the arguments
+    from llmail.utils.logging import set_primary_logger
+
+    set_primary_logger(namespace.log_level, namespace.redact_email_addresses, namespace.log_format)
+
 
+REQUIRED_ARGS = [
+    "imap_host",
+    "imap_port",
+    "imap_username",
+    "imap_password",
+    "smtp_host",
+    "smtp_port",
+    "smtp_username",
+    "smtp_password",
+    # "llm_api_key",
+    # "llm_base_url",
+]
 
-def check_required_args(required_args: list[str], argparser: argparse.ArgumentParser):
+
+def check_required_args(required_args: list[str], namespace: argparse.Namespace):
     """
     Check if required arguments are set
     Useful if using enviroment variables with argparse as default and required are mutually exclusive
     """
     for arg in required_args:
-        args = argparser.parse_args()
-        if getattr(args, arg) is None:
+        if getattr(namespace, arg) is None:
             # raise ValueError(f"{arg} is required")
             print(f"{arg} is required")
             sys.exit(1)
-
-
-# This will run when this file is imported
-set_argparse()
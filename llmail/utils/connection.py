@@ -0,0 +1,143 @@
+import imaplib
+import queue
+import socket
+import ssl
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from imapclient import IMAPClient
+
+from llmail.utils import logger
+from llmail.utils.cli_args import args
+
+# Errors that mean the connection is gone (as opposed to a command failing)
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, socket.error, ssl.SSLError, EOFError)
+# If a connection hasn't been used for this long, NOOP is sent to check that it's still alive
+LIVENESS_CHECK_SECONDS = 30
+
+
+class IMAPConnection:
+    """An authenticated IMAP session that is kept alive between cycles and reconnects when it's dropped"""
+
+    def __init__(self, host: str, username: str, password: str, port: int | None = None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self._client: IMAPClient | None = None
+        self._last_used = 0.0
+
+    def get(self) -> IMAPClient:
+        """Return a logged-in client, reconnecting if the connection was dropped"""
+        if self._client is not None and time.monotonic() - self._last_used > LIVENESS_CHECK_SECONDS:
+            try:
+                self._client.noop()
+            except CONNECTION_ERRORS + (imaplib.IMAP4.error,) as e:
+                logger.info(f"IMAP connection was dropped ({e}). Reconnecting...")
+                self.discard()
+        if self._client is None:
+            logger.debug(f"Connecting to {self.host}")
+            client = IMAPClient(self.host, port=self.port)
+            client.login(self.username, self.password)
+            self._client = client
+        self._last_used = time.monotonic()
+        return self._client
+
+    def discard(self):
+        """Drop the connection so the next get() reconnects"""
+        if self._client is not None:
+            try:
+                self._client.logout()
+            except Exception:
+                # The connection is probably already gone, which is fine
+                pass
+        self._client = None
+
+    @contextmanager
+    def session(self) -> Iterator[IMAPClient]:
+        """Use the connection, discarding it if it's dropped while being used"""
+        try:
+            yield self.get()
+        except CONNECTION_ERRORS:
+            self.discard()
+            raise
+        finally:
+            self._last_used = time.monotonic()
+
+
+class IMAPPool:
+    """A small pool of long-lived connections. IMAPClient isn't thread-safe, so each thread borrows its own"""
+
+    def __init__(self, size: int, host: str, username: str, password: str, port: int | None = None):
+        self.size = max(size, 1)
+        self._connections: queue.Queue[IMAPConnection] = queue.Queue()
+        for _ in range(self.size):
+            self._connections.put(IMAPConnection(host, username, password, port))
+
+    @contextmanager
+    def connection(self) -> Iterator[IMAPClient]:
+        """Borrow a connection from the pool, waiting for one to be returned if they're all in use"""
+        imap_connection = self._connections.get()
+        try:
+            with imap_connection.session() as client:
+                yield client
+        finally:
+            self._connections.put(imap_connection)
+
+    def close(self):
+        while not self._connections.empty():
+            self._connections.get_nowait().discard()
+
+
+_pools: dict[tuple, IMAPPool] = {}
+_folder_cache: dict[tuple, tuple[float, list[str]]] = {}
+_lock = threading.Lock()
+
+
+def get_pool() -> IMAPPool:
+    """Get the connection pool for the configured IMAP account"""
+    key = (args.imap_host, args.imap_port, args.imap_username)
+    with _lock:
+        if key not in _pools:
+            _pools[key] = IMAPPool(
+                args.imap_pool_size,
+                args.imap_host,
+                args.imap_username,
+                args.imap_password,
+                port=int(args.imap_port),
+            )
+        return _pools[key]
+
+
+def list_folder_names(client: IMAPClient) -> list[str]:
+    """Return the names of all folders, only asking the server again every --folder-cache-ttl seconds"""
+    key = (args.imap_host, args.imap_username)
+    cached = _folder_cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < args.folder_cache_ttl:
+        return cached[1]
+    folders = [folder[2] for folder in client.list_folders()]
+    _folder_cache[key] = (time.monotonic(), folders)
+    return folders
+
+
+def get_folder_status(client: IMAPClient, folder: str) -> dict[str, int] | None:
+    """Ask for the folder's UIDVALIDITY, UIDNEXT, MESSAGES and (with CONDSTORE) HIGHESTMODSEQ in one STATUS command.
+    If any of them changed since the folder was last scanned, it has new emails (or emails were removed or changed).
+    None if the server refused the command
+    """
+    items = ["UIDVALIDITY", "UIDNEXT", "MESSAGES"]
+    if client.has_capability("CONDSTORE"):
+        items.append("HIGHESTMODSEQ")
+    try:
+        response = client.folder_status(folder, items)
+    except imaplib.IMAP4.error as e:
+        logger.debug(f"Failed to get the status of folder {folder} ({e})")
+        return None
+    return {item.decode(): int(value) for item, value in response.items()}
+
+
+def invalidate_folder_cache():
+    """Forget the cached folder list, such as after a folder couldn't be selected"""
+    _folder_cache.pop((args.imap_host, args.imap_username), None)
@@ -0,0 +1,153 @@
+"""
+Fitting the history of a thread into a token budget.
+The newest emails are kept as they are and the older ones are replaced by a summary.
+The summary is saved per thread, and when the thread grows only the emails that weren't summarized yet
+are added to it, so it's never regenerated from scratch unless the thread changed under it.
+"""
+
+import threading
+from typing import Callable
+
+from llmail.utils import logger
+from llmail.utils.state import StateStore, get_store
+
+try:
+    import tiktoken
+except ImportError:
+    # Without tiktoken, tokens are estimated from the length of the text
+    tiktoken = None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS thread_summaries (
+    thread_key TEXT PRIMARY KEY,
+    covered INTEGER NOT NULL,
+    last_message_id TEXT NOT NULL,
+    summary TEXT NOT NULL
+);
+"""
+# UTF-8 bytes per token, which is roughly right for English with most tokenizers
+BYTES_PER_TOKEN = 4
+# Tokens added by the chat format for each message
+MESSAGE_OVERHEAD_TOKENS = 4
+# Part of the budget that is left for the summary
+SUMMARY_SHARE = 0.25
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def count_tokens(text: str) -> int:
+    """Count the tokens in the text with tiktoken if it's installed, otherwise estimate them"""
+    global _encoding
+    if tiktoken is not None:
+        with _encoding_lock:
+            if _encoding is None:
+                _encoding = tiktoken.get_encoding("cl100k_base")
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text.encode()) // BYTES_PER_TOKEN + 1
+
+
+def message_tokens(message: dict) -> int:
+    return count_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+
+class SummaryStore:
+    """Summaries of the beginning of threads.
+    Each one records how many emails of the thread it covers and the Message-ID of the last one,
+    so it can be extended with newer emails as long as the beginning of the thread is the same.
+    """
+
+    def __init__(self, store: StateStore):
+        self.store = store
+        self.store.ensure_schema(SCHEMA)
+
+    def get(self, thread_key: str) -> tuple[int, str, str] | None:
+        """Return (number of emails covered, Message-ID of the last one, summary)"""
+        rows = self.store.execute(
+            "SELECT covered, last_message_id, summary FROM thread_summaries WHERE thread_key = ?",
+            (thread_key,),
+        )
+        return rows[0] if rows else None
+
+    def set(self, thread_key: str, covered: int, last_message_id: str, summary: str):
+        self.store.execute(
+            "INSERT OR REPLACE INTO thread_summaries (thread_key, covered, last_message_id, summary) "
+            "VALUES (?, ?, ?, ?)",
+            (thread_key, covered, last_message_id, summary),
+        )
+
+
+def build_context(
+    thread_key: str,
+    history: list[dict],
+    budget: int,
+    summarize: Callable[[str | None, list[dict]], str],
+    summaries: SummaryStore | None = None,
+) -> list[dict]:
+    """Fit the history (oldest first, as from tracking.get_thread_history) into budget tokens.
+
+    The newest emails are kept as long as they fit in the budget (minus a share for the summary).
+    The emails before them are summarized with summarize(previous summary, emails to add).
+    If there's a summary that covers more emails than needs to be summarized, it's used as is.
+    The summary is returned as a system message at the start of the history.
+    """
+    if not budget or not history:
+        return history
+    if sum(message_tokens(email) for email in history) <= budget:
+        return history
+
+    # Keep the newest emails that fit (the newest is always kept since it's what's being replied to)
+    verbatim_budget = budget - int(budget * SUMMARY_SHARE)
+    used = 0
+    split = len(history)
+    while split > 1 and used + message_tokens(history[split - 1]) <= verbatim_budget:
+        used += message_tokens(history[split - 1])
+        split -= 1
+    if split == len(history):
+        split -= 1
+
+    summaries = summaries if summaries is not None else SummaryStore(get_store())
+    cached = summaries.get(thread_key)
+    previous_summary = None
+    covered = 0
+    if cached is not None:
+        cached_covered, last_message_id, cached_summary = cached
+        # Only use the summary if the emails it covers are still the beginning of the history
+        if (
+            0 < cached_covered < len(history)
+            and str(history[cached_covered - 1].get("message_id")) == last_message_id
+        ):
+            previous_summary = cached_summary
+            covered = cached_covered
+        else:
+            logger.debug(f"Summary of thread for email {thread_key} is out of date. Summarizing again")
+
+    if covered < split:
+        logger.debug(
+            f"Summarizing emails {covered + 1} to {split} of thread for email {thread_key}"
+        )
+        previous_summary = summarize(previous_summary, history[covered:split])
+        covered = split
+        summaries.set(
+            thread_key, covered, str(history[covered - 1].get("message_id")), previous_summary
+        )
+
+    context = [
+        {
+            "role": "system",
+            "content": f"Summary of the earlier emails in this thread:\n{previous_summary}",
+        },
+        *history[covered:],
+    ]
+    # The newest email on its own can still be over the budget
+    newest = context[-1]
+    if message_tokens(newest) > verbatim_budget:
+        max_bytes = verbatim_budget * BYTES_PER_TOKEN
+        logger.warning(
+            f"Newest email in thread for email {thread_key} is over the token budget. Truncating it"
+        )
+        context[-1] = {
+            **newest,
+            "content": newest["content"].encode()[:max_bytes].decode(errors="ignore"),
+        }
+    return context
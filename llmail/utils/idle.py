@@ -0,0 +1,105 @@
+import contextvars
+import imaplib
+import threading
+import time
+from typing import Callable
+
+from imapclient import IMAPClient
+
+from llmail.utils import jobs, logger
+from llmail.utils.cli_args import args
+
+# RFC 2177 says the server may drop a client that has been idle for 30 minutes
+# so IDLE is re-issued well before the 29 minute limit
+IDLE_REARM_SECONDS = 25 * 60
+# How long a single idle_check waits so the thread can notice when it's stopped
+IDLE_CHECK_TIMEOUT = 30
+# Used when the server doesn't support IDLE and --watch-interval isn't set
+FALLBACK_POLL_INTERVAL = 300
+
+
+class FolderWatcher(threading.Thread):
+    """Keep a connection in IDLE on a folder and set new_mail when the server reports new emails.
+    If the server doesn't support IDLE, new_mail is set every poll_interval seconds instead.
+    """
+
+    def __init__(self, folder: str, new_mail: threading.Event, poll_interval: int):
+        super().__init__(name=f"idle-{folder}", daemon=True)
+        self.folder = folder
+        self.new_mail = new_mail
+        self.poll_interval = poll_interval
+        self.stopped = threading.Event()
+        # Run with the args (such as the mailbox's settings) of where the watcher was created
+        self.context = contextvars.copy_context()
+
+    def run(self):
+        self.context.run(self._watch)
+
+    def _watch(self):
+        idle_supported = True
+        while idle_supported and not self.stopped.is_set():
+            try:
+                with IMAPClient(args.imap_host, port=int(args.imap_port)) as client:
+                    client.login(args.imap_username, args.imap_password)
+                    idle_supported = client.has_capability("IDLE")
+                    if not idle_supported:
+                        continue
+                    # Read-only so watching doesn't change any flags
+                    client.select_folder(self.folder, readonly=True)
+                    logger.debug(f"Waiting for new emails in {self.folder} with IDLE")
+                    while not self.stopped.is_set():
+                        self._idle(client)
+            except (imaplib.IMAP4.error, OSError) as e:
+                logger.warning(f"IDLE connection for {self.folder} failed ({e}). Reconnecting...")
+                # Emails might have arrived while the connection was down
+                self.new_mail.set()
+                self.stopped.wait(IDLE_CHECK_TIMEOUT)
+        if not idle_supported:
+            logger.warning(
+                f"Server doesn't support IDLE. Polling {self.folder} every {self.poll_interval} seconds instead"
+            )
+            while not self.stopped.wait(self.poll_interval):
+                self.new_mail.set()
+
+    def _idle(self, client: IMAPClient):
+        """Stay in IDLE until it needs to be re-issued"""
+        client.idle()
+        started = time.monotonic()
+        try:
+            while (
+                time.monotonic() - started < IDLE_REARM_SECONDS and not self.stopped.is_set()
+            ):
+                responses = client.idle_check(timeout=IDLE_CHECK_TIMEOUT)
+                # Responses look like (2, b"EXISTS")
+                if any(
+                    len(response) > 1 and response[1] in (b"EXISTS", b"RECENT")
+                    for response in responses
+                ):
+                    logger.debug(f"New email in {self.folder}")
+                    self.new_mail.set()
+        finally:
+            client.idle_done()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def watch(process: Callable[[], None], folders: list[str]):
+    """Call process once and then every time one of the folders gets a new email.
+    Also when a reply that was put off (such as by a rate limit) is ready, since no email might arrive until then
+    """
+    new_mail = threading.Event()
+    poll_interval = args.watch_interval if args.watch_interval else FALLBACK_POLL_INTERVAL
+    watchers = [FolderWatcher(folder, new_mail, poll_interval) for folder in folders]
+    for watcher in watchers:
+        watcher.start()
+    try:
+        # Catch up on anything that arrived while the program wasn't running
+        process()
+        while True:
+            new_mail.wait(timeout=jobs.get_queue().next_ready())
+            new_mail.clear()
+            process()
+    finally:
+        for watcher in watchers:
+            watcher.stop()
@@ -0,0 +1,247 @@
+"""
+Durable queue of replies that need to be sent, kept in the state file.
+Scanning adds a job for each email that needs a reply and the reply workers claim jobs with a lease.
+There's only ever one job per email (the Message-ID is the key) and a job is marked as sending before
+the email is sent. If the process crashes while sending, or sending fails in a way that doesn't rule out
+that the server got the email, the job is never sent again, so an email can't get two replies.
+Jobs that fail are retried with exponential backoff.
+Jobs are claimed round-robin by sender (whoever was replied to longest ago goes first), so one
+person sending a lot of emails doesn't hold up everyone else.
+"""
+
+import os
+import socket
+import threading
+import time
+
+from llmail.utils import logger
+from llmail.utils.state import StateStore, get_store
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reply_jobs (
+    message_id TEXT PRIMARY KEY,
+    thread_key TEXT NOT NULL,
+    sender TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    lease_owner TEXT,
+    lease_expires REAL,
+    reply_message_id TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reply_jobs_status ON reply_jobs (status, available_at);
+"""
+# After the sender column is added to queues from older versions
+SENDER_INDEX = "CREATE INDEX IF NOT EXISTS reply_jobs_sender ON reply_jobs (sender, updated);"
+# Statuses
+PENDING = "pending"
+CLAIMED = "claimed"
+SENDING = "sending"
+DONE = "done"
+FAILED = "failed"
+
+# Backoff after a failure is BACKOFF_SECONDS * 2 ** (attempts - 1), up to MAX_BACKOFF_SECONDS
+BACKOFF_SECONDS = 30
+MAX_BACKOFF_SECONDS = 60 * 60
+# After this many failures the job is given up on
+MAX_ATTEMPTS = 8
+# --sender-replies-per-hour counts the replies sent in this many seconds
+SENDER_QUOTA_SECONDS = 60 * 60
+# Shortest wait before checking again for jobs that were put off. Jobs held back by the per-sender
+# quota are ready but can't be claimed, so without it they would be checked over and over
+MIN_RETRY_WAIT_SECONDS = 30
+
+
+class LeaseLost(Exception):
+    """The job's lease ran out and another worker might have claimed it"""
+
+
+class Job:
+    __slots__ = ("message_id", "thread_key", "attempts")
+
+    def __init__(self, message_id: str, thread_key: str, attempts: int):
+        self.message_id = message_id
+        self.thread_key = thread_key
+        self.attempts = attempts
+
+    def __repr__(self):
+        return f"Job(message_id={self.message_id}, thread_key={self.thread_key}, attempts={self.attempts})"
+
+
+class JobQueue:
+    def __init__(self, store: StateStore):
+        self.store = store
+        self.store.ensure_schema(SCHEMA)
+        self.store.add_column("reply_jobs", "sender", "TEXT")
+        self.store.ensure_schema(SENDER_INDEX)
+
+    def enqueue(self, thread_key: str, message_id: str, sender: str | None = None) -> bool:
+        """Add a job to reply to the email. Returns False if there already is one for it"""
+        now = time.time()
+        rows = self.store.execute(
+            "INSERT INTO reply_jobs (message_id, thread_key, sender, available_at, created, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(message_id) DO NOTHING RETURNING message_id",
+            (message_id, thread_key, sender, now, now, now),
+        )
+        return bool(rows)
+
+    def claim(self, owner: str, lease_seconds: float, sender_quota: int | None = None) -> Job | None:
+        """Claim a job that's ready (or whose lease ran out before it was sent).
+        The job is from the sender that was replied to (or is being replied to) longest ago, oldest first.
+        With sender_quota, senders who were sent that many replies in the last SENDER_QUOTA_SECONDS
+        are skipped, so their jobs wait for a later cycle
+        """
+        now = time.time()
+        # A single statement, so two workers (or processes) can't claim the same job
+        rows = self.store.execute(
+            "UPDATE reply_jobs SET status = ?, lease_owner = ?, lease_expires = ?, updated = ? "
+            "WHERE message_id = ("
+            "    SELECT message_id FROM reply_jobs AS job"
+            "    WHERE ((status = ? AND available_at <= ?) OR (status = ? AND lease_expires < ?))"
+            "    AND (? IS NULL OR ("
+            "        SELECT COUNT(*) FROM reply_jobs AS sent"
+            "        WHERE sent.sender = job.sender AND sent.reply_message_id IS NOT NULL AND sent.updated > ?"
+            "    ) < ?)"
+            "    ORDER BY ("
+            "        SELECT MAX(updated) FROM reply_jobs AS served"
+            "        WHERE served.sender = job.sender"
+            "        AND (served.status IN (?, ?) OR served.reply_message_id IS NOT NULL)"
+            # Never replied to (NULL) sorts first
+            "    ), available_at LIMIT 1"
+            ") RETURNING message_id, thread_key, attempts",
+            (
+                CLAIMED,
+                owner,
+                now + lease_seconds,
+                now,
+                PENDING,
+                now,
+                CLAIMED,
+                now,
+                sender_quota,
+                now - SENDER_QUOTA_SECONDS,
+                sender_quota,
+                CLAIMED,
+                SENDING,
+            ),
+        )
+        return Job(*rows[0]) if rows else None
+
+    def release(self, message_id: str, delay: float = 0):
+        """Put a claimed job back without counting an attempt, such as when a rate limit was hit.
+        Also for a job that was being sent if the server refused the email, since it wasn't sent
+        """
+        now = time.time()
+        self.store.execute(
+            "UPDATE reply_jobs SET status = ?, available_at = ?, reply_message_id = NULL, lease_owner = NULL, "
+            "updated = ? WHERE message_id = ? AND status IN (?, ?)",
+            (PENDING, now + delay, now, message_id, CLAIMED, SENDING),
+        )
+
+    def mark_sending(self, message_id: str, owner: str, reply_message_id: str) -> bool:
+        """Record that the reply is about to be sent. Returns False if the lease was lost"""
+        rows = self.store.execute(
+            "UPDATE reply_jobs SET status = ?, reply_message_id = ?, updated = ? "
+            "WHERE message_id = ? AND status = ? AND lease_owner = ? RETURNING message_id",
+            (SENDING, reply_message_id, time.time(), message_id, CLAIMED, owner),
+        )
+        return bool(rows)
+
+    def complete(self, message_id: str, note: str | None = None):
+        self.store.execute(
+            "UPDATE reply_jobs SET status = ?, error = ?, lease_owner = NULL, updated = ? WHERE message_id = ?",
+            (DONE, note, time.time(), message_id),
+        )
+
+    def fail(self, message_id: str, error: str):
+        """Try the job again later, unless it failed too many times"""
+        now = time.time()
+        rows = self.store.execute(
+            "SELECT attempts FROM reply_jobs WHERE message_id = ?", (message_id,)
+        )
+        attempts = (rows[0][0] if rows else 0) + 1
+        if attempts >= MAX_ATTEMPTS:
+            status, available_at = FAILED, now
+        else:
+            status = PENDING
+            available_at = now + min(BACKOFF_SECONDS * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS)
+        self.store.execute(
+            "UPDATE reply_jobs SET status = ?, attempts = ?, available_at = ?, error = ?, "
+            "lease_owner = NULL, updated = ? WHERE message_id = ?",
+            (status, attempts, available_at, error, now, message_id),
+        )
+        if status == FAILED:
+            logger.error(f"Giving up on replying to email {message_id} after {attempts} attempts: {error}")
+        else:
+            logger.info(
+                f"Retrying reply to email {message_id} in {available_at - now:.0f} seconds (attempt {attempts})"
+            )
+
+    def recover(self) -> int:
+        """Jobs that were being sent when their worker stopped might have been sent, so they're never
+        sent again. They're marked as done and logged so they can be checked by hand
+        """
+        now = time.time()
+        rows = self.store.execute(
+            "UPDATE reply_jobs SET status = ?, error = ?, lease_owner = NULL, updated = ? "
+            "WHERE status = ? AND lease_expires < ? RETURNING message_id, reply_message_id",
+            (DONE, "Stopped while sending", now, SENDING, now),
+        )
+        for message_id, reply_message_id in rows:
+            logger.warning(
+                f"Reply {reply_message_id} to email {message_id} was being sent when the worker stopped. Not sending it again"
+            )
+        return len(rows)
+
+    def next_ready(self) -> float | None:
+        """Seconds until a job that was put off (by a backoff, a rate limit or a lease that runs out) is ready.
+        At least MIN_RETRY_WAIT_SECONDS. None if there are no such jobs
+        """
+        rows = self.store.execute(
+            "SELECT MIN(CASE status WHEN ? THEN available_at ELSE lease_expires END) FROM reply_jobs "
+            "WHERE status IN (?, ?)",
+            (PENDING, PENDING, CLAIMED),
+        )
+        if not rows or rows[0][0] is None:
+            return None
+        return max(rows[0][0] - time.time(), MIN_RETRY_WAIT_SECONDS)
+
+    def status(self, message_id: str) -> str | None:
+        rows = self.store.execute("SELECT status FROM reply_jobs WHERE message_id = ?", (message_id,))
+        return rows[0][0] if rows else None
+
+    def counts(self) -> dict[str, int]:
+        rows = self.store.execute("SELECT status, COUNT(*) FROM reply_jobs GROUP BY status")
+        return dict(rows)
+
+
+_queues: dict[str, JobQueue] = {}
+_queues_lock = threading.Lock()
+
+
+def get_queue() -> JobQueue:
+    """Get the job queue stored in the configured state file"""
+    store = get_store()
+    with _queues_lock:
+        if store.path not in _queues:
+            _queues[store.path] = JobQueue(store)
+        return _queues[store.path]
+
+
+def total_counts() -> dict[str, int]:
+    """Number of jobs with each status in all the queues this process uses"""
+    with _queues_lock:
+        queues = list(_queues.values())
+    totals = dict.fromkeys((PENDING, CLAIMED, SENDING, DONE, FAILED), 0)
+    for queue in queues:
+        for status, count in queue.counts().items():
+            totals[status] = totals.get(status, 0) + count
+    return totals
+
+
+def worker_name() -> str:
+    """Name of the current process, used as the owner of the jobs it claims"""
+    return f"{socket.gethostname()}-{os.getpid()}"
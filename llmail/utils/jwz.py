@@ -0,0 +1,91 @@
+"""
+Message threading based on Jamie Zawinski's algorithm (https://www.jwz.org/doc/threading.html)
+Only the parts that matter here are implemented: building the container tree from Message-ID,
+In-Reply-To and References. Grouping by subject isn't needed since emails are already grouped into threads.
+"""
+
+
+class Container:
+    """A node in the thread tree. The email is None if it's only known because something referenced it"""
+
+    __slots__ = ("message_id", "email", "parent", "children")
+
+    def __init__(self, message_id: str):
+        self.message_id = message_id
+        self.email = None
+        self.parent: Container | None = None
+        self.children: list[Container] = []
+
+    def is_ancestor_of(self, other: "Container") -> bool:
+        while other is not None:
+            if other is self:
+                return True
+            other = other.parent
+        return False
+
+    def set_parent(self, parent: "Container | None"):
+        if self.parent is not None:
+            self.parent.children.remove(self)
+        self.parent = parent
+        if parent is not None:
+            parent.children.append(self)
+
+    def __repr__(self):
+        return f"Container(message_id={self.message_id}, email={self.email})"
+
+
+def references_of(email) -> list[str]:
+    """The ancestors of an email, oldest first (References plus In-Reply-To if it isn't the last reference)"""
+    references = [str(m_id) for m_id in email.references]
+    in_reply_to = getattr(email, "in_reply_to", None)
+    if in_reply_to and (not references or references[-1] != in_reply_to):
+        references.append(str(in_reply_to))
+    return references
+
+
+def build_tree(emails) -> dict[str, Container]:
+    """Build the container tree for the emails in a single pass. Returns all containers by Message-ID"""
+    containers: dict[str, Container] = {}
+
+    def get_container(message_id: str) -> Container:
+        if message_id not in containers:
+            containers[message_id] = Container(message_id)
+        return containers[message_id]
+
+    for email in emails:
+        container = get_container(str(email.message_id))
+        # A duplicate (such as the same email in two folders) is only added once
+        if container.email is not None:
+            continue
+        container.email = email
+        references = references_of(email)
+        # Link the references together in order, unless they're already linked (or it would make a loop)
+        parent = None
+        for reference in references:
+            reference_container = get_container(reference)
+            if (
+                parent is not None
+                and reference_container.parent is None
+                and not reference_container.is_ancestor_of(parent)
+            ):
+                reference_container.set_parent(parent)
+            parent = reference_container
+        # The last reference is the parent of this email, no matter what was assumed before
+        if parent is not None and container.is_ancestor_of(parent):
+            parent = None
+        container.set_parent(parent)
+    return containers
+
+
+def branch(containers: dict[str, Container], message_id: str) -> list:
+    """Return the emails from the root of the tree down to the email with the Message-ID.
+    Containers without an email (referenced but never seen) are skipped.
+    """
+    container = containers.get(str(message_id))
+    emails = []
+    while container is not None:
+        if container.email is not None:
+            emails.append(container.email)
+        container = container.parent
+    emails.reverse()
+    return emails
@@ -0,0 +1,314 @@
+import contextvars
+import threading
+from typing import TYPE_CHECKING, Callable, Iterator
+
+# phidata, the provider clients and the tools take a while to import, so they're imported where
+# they're used. Only the provider and tools that are configured are loaded
+if TYPE_CHECKING:
+    from phi.assistant import Assistant
+    from phi.llm.base import LLM
+
+# from phi.knowledge.website import WebsiteKnowledgeBase
+# from phi.knowledge.combined import CombinedKnowledgeBase
+
+from llmail.utils import context, logger, metrics, ratelimit, tool_cache
+from llmail.utils.cli_args import args
+
+# Default number of requests that are sent to each provider at once (otherwise --max-concurrent-replies)
+# Ollama only works on one request at a time unless OLLAMA_NUM_PARALLEL is set
+PROVIDER_CONCURRENCY = {"ollama": 1}
+SUMMARY_PROMPT = (
+    "You summarize email threads so the conversation can be continued without the full history. "
+    "Keep the questions that were asked, the answers that were given, and any names, numbers, links "
+    "and decisions. Reply with only the summary, in at most {words} words."
+)
+
+
+class GenerationTimeout(Exception):
+    """The reply wasn't generated before the deadline. partial is what was generated until then"""
+
+    def __init__(self, timeout: float, partial: str):
+        super().__init__(f"No complete reply after {timeout:.3g} seconds")
+        self.partial = partial
+
+
+# Everything here is built once per configuration and shared by all conversations
+_clients: dict[tuple, object] = {}
+_tools: dict[tuple, list] = {}
+_slots: dict[tuple, threading.Semaphore] = {}
+_tool_caches: dict[int, tool_cache.ToolCache] = {}
+_lock = threading.Lock()
+
+
+def provider_key() -> tuple:
+    return (args.llm_provider, args.llm_base_url, args.llm_api_key, args.llm_model, args.reply_timeout)
+
+
+def prepare():
+    """Create the provider client and make sure the model is available. Meant to be called at startup"""
+    get_client()
+    get_tools()
+
+
+def get_client():
+    """Get the (cached) client for the provider. For Ollama, the model is pulled if it isn't downloaded yet"""
+    key = provider_key()
+    with _lock:
+        if key in _clients:
+            return _clients[key]
+        # Chose how to send the request to the provider
+        match args.llm_provider:
+            case "openai-like":
+                from phi.llm.openai.like import OpenAILike
+
+                # The OpenAI client keeps a connection pool so it's shared by all conversations
+                client = OpenAILike(
+                    model=args.llm_model,
+                    api_key=args.llm_api_key,
+                    base_url=args.llm_base_url,
+                    # So a request that hangs doesn't keep a connection forever after the deadline
+                    timeout=args.reply_timeout or None,
+                ).get_client()
+                if args.reply_timeout:
+                    # A retry after a timeout would hold the provider's slot for several deadlines.
+                    # phidata ignores max_retries=0, so it's set on the client
+                    client = client.with_options(max_retries=0)
+            case "ollama":
+                import ollama
+
+                # Like the OpenAI client, a request that hangs is dropped after the deadline
+                client = ollama.Client(host=args.llm_base_url, timeout=args.reply_timeout or None)
+                for model in client.list()["models"]:
+                    if model["name"] == args.llm_model:
+                        logger.debug(f"{args.llm_model} is already downloaded")
+                        break
+                else:
+                    logger.info(f"Downloading {args.llm_model}")
+                    # Downloading can take much longer than a reply, so it doesn't get the timeout
+                    ollama.Client(host=args.llm_base_url).pull(model=args.llm_model)
+            case _:
+                raise ValueError(f"Unknown LLM provider {args.llm_provider}")
+        _clients[key] = client
+        return client
+
+
+def create_llm() -> "LLM":
+    """Create an LLM for a single conversation. It's cheap since the client is shared"""
+    client = get_client()
+    match args.llm_provider:
+        case "openai-like":
+            from phi.llm.openai.like import OpenAILike
+
+            return OpenAILike(
+                model=args.llm_model,
+                api_key=args.llm_api_key,
+                base_url=args.llm_base_url,
+                client=client,
+                max_tokens=args.max_output_tokens,
+            )
+        case "ollama":
+            from phi.llm.ollama import Ollama
+
+            return Ollama(
+                model=args.llm_model,
+                host=args.llm_base_url,
+                ollama_client=client,
+                options={"num_predict": args.max_output_tokens} if args.max_output_tokens else None,
+            )
+
+
+def get_tools() -> list:
+    """Get the (cached) tools the assistant can use"""
+    key = (args.no_tools, args.exa_api_key, args.tool_cache_size)
+    with _lock:
+        if key in _tools:
+            return _tools[key]
+        # Select tools
+        # website_knowledge_base = WebsiteKnowledgeBase(
+        #     urls=args.scrapable_url if args.scrapable_url else []
+        # )
+        tools = []
+        if not args.no_tools:
+            from phi.tools.website import WebsiteTools
+
+            tools = [
+                # Giving WebsiteTools the knowledge base seems to allow it to add URLs to the knowledge base
+                # WebsiteTools(knowledge_base=website_knowledge_base),
+                WebsiteTools(),
+            ]
+            if args.exa_api_key is not None:
+                from phi.tools.exa import ExaTools
+
+                tools.append(ExaTools(api_key=args.exa_api_key, highlights=True, num_results=10))
+                logger.info("Using Exa instead of DuckDuckGo due to Exa being enabled")
+            else:
+                from phi.tools.duckduckgo import DuckDuckGo
+
+                tools.append(DuckDuckGo(search=True, news=True))
+        for tool in tools:
+            metrics.time_toolkit(tool)
+        # The same pages and searches are often needed by several conversations
+        if args.tool_cache_size:
+            if args.tool_cache_size not in _tool_caches:
+                _tool_caches[args.tool_cache_size] = tool_cache.ToolCache(args.tool_cache_size)
+            for tool in tools:
+                tool_cache.cache_toolkit(tool, _tool_caches[args.tool_cache_size])
+        _tools[key] = tools
+        return tools
+
+
+def tool_names() -> tuple[str, ...]:
+    """Names of the tools the assistant can use (for telling configurations apart)"""
+    return tuple(type(tool).__name__ for tool in get_tools())
+
+
+def create_assistant() -> "Assistant":
+    """Create an assistant for a single conversation with the configured LLM and tools"""
+    from phi.assistant import Assistant
+
+    return Assistant(
+        llm=create_llm(),
+        # Copied since the assistant adds the tools to its own LLM
+        tools=list(get_tools()),
+        show_tool_calls=args.show_tool_calls,
+        # additional_messages=[
+        #     {
+        #         "role": "system",
+        #         "content": "Functions generally need arguments. Only provide your final iteration to the user. For example, if you're searching for a website, don't tell the user that you're searching for the website. Just provide the final result. Remember, the user is only going to see the final response, not the steps you took to get there. Only provide the final result. Try to use the most appropriate tool for the task. For example, if the user asks about a website, try searching for it and scraping it too. For URLs, ensure the protocol is included (e.g. https://). Use the functions to ensure that the information is accurate and up-to-date",
+        #     },
+        # ],
+        tool_call_limit=10,
+        debug_mode=args.phidata_debug,
+        prevent_hallucinations=True,
+        # knowledge_base=CombinedKnowledgeBase(
+        #     sources=[
+        #         website_knowledge_base,
+        #     ]
+        # ),
+    )
+
+
+def get_slots() -> threading.Semaphore:
+    """Semaphore limiting how many requests are sent to the LLM provider at once"""
+    key = provider_key()
+    with _lock:
+        if key not in _slots:
+            limit = args.max_concurrent_llm_requests or PROVIDER_CONCURRENCY.get(
+                args.llm_provider, args.max_concurrent_replies
+            )
+            _slots[key] = threading.Semaphore(max(limit, 1))
+        return _slots[key]
+
+
+def summarize(
+    previous_summary: str | None, emails: list[dict], max_words: int = 300, timeout: float | None = None
+) -> str:
+    """Summarize emails (as from tracking.get_thread_history), continuing the previous summary if there is one.
+    Like generate, gives up after timeout seconds (raising GenerationTimeout) and doesn't start once it's 0
+    """
+    if timeout is not None and timeout <= 0:
+        raise GenerationTimeout(timeout, "")
+    thread = "\n\n".join(f"From {email['sender']}:\n{email['content']}" for email in emails)
+    if previous_summary:
+        content = f"Summary so far:\n{previous_summary}\n\nNewer emails to add to it:\n{thread}"
+    else:
+        content = f"Emails:\n{thread}"
+    from phi.llm.message import Message
+
+    messages = [
+        Message(role="system", content=SUMMARY_PROMPT.format(words=max_words)),
+        Message(role="user", content=content),
+    ]
+    summary = []
+    error = []
+
+    def request():
+        try:
+            summary.append(create_llm().response(messages=messages).strip())
+        except Exception as e:
+            error.append(e)
+
+    # Replies reserve their request before they start, summaries are counted as they happen
+    ratelimit.charge_llm(0, requests=1)
+    with metrics.stage_duration.time(stage="summarize"):
+        finished = run_in_slot(request, "summarize").wait(timeout)
+    prompt = [message.to_dict() for message in messages]
+    if not finished:
+        record_tokens(prompt, "")
+        raise GenerationTimeout(timeout, "")
+    if error:
+        raise error[0]
+    record_tokens(prompt, summary[0])
+    return summary[0]
+
+
+def record_tokens(messages: list[dict], response: str):
+    """Add the tokens of a request to the metrics and the rate limit (only the messages, not the tools or tool calls)"""
+    input_tokens = sum(context.message_tokens(message) for message in messages)
+    output_tokens = context.count_tokens(response)
+    metrics.llm_tokens.inc(input_tokens, direction="input")
+    metrics.llm_tokens.inc(output_tokens, direction="output")
+    ratelimit.charge_llm(input_tokens + output_tokens)
+
+
+def run_in_slot(work: Callable[[], None], name: str) -> threading.Event:
+    """Run work in its own thread with one of the provider's slots (get_slots) and return an event
+    that's set when it's done. The slot is given back when the work is really done, so requests that
+    are still running after the caller stopped waiting for them count too
+    """
+    done = threading.Event()
+
+    def run():
+        try:
+            work()
+        finally:
+            done.set()
+            slots.release()
+
+    slots = get_slots()
+    slots.acquire()
+    try:
+        # The context is copied so the thread sees the same args (such as the mailbox's settings)
+        threading.Thread(target=contextvars.copy_context().run, args=(run,), name=name, daemon=True).start()
+    except BaseException:
+        slots.release()
+        raise
+    return done
+
+
+def generate(assistant: "Assistant", messages: list[dict], timeout: float | None) -> str:
+    """Stream the reply from the assistant and give up after timeout seconds (including tool calls).
+
+    The stream is read in its own thread (see run_in_slot), so even a request that's stuck waiting on
+    the provider can't hold up the caller past the deadline. After the deadline, the stream is closed
+    as soon as the next chunk arrives. Raises GenerationTimeout with what was generated so far.
+    """
+    chunks = []
+    cancelled = threading.Event()
+    error = []
+
+    def consume():
+        try:
+            stream: Iterator[str] = assistant.run(messages=messages, stream=True)
+            try:
+                for chunk in stream:
+                    if cancelled.is_set():
+                        break
+                    chunks.append(chunk)
+            finally:
+                # Closing the generator stops phidata from reading (and requesting) any more
+                if hasattr(stream, "close"):
+                    stream.close()
+        except Exception as e:
+            error.append(e)
+
+    with metrics.stage_duration.time(stage="llm"):
+        finished = run_in_slot(consume, "generate").wait(timeout)
+    if not finished:
+        cancelled.set()
+        record_tokens(messages, "".join(chunks))
+        raise GenerationTimeout(timeout, "".join(chunks))
+    if error:
+        raise error[0]
+    record_tokens(messages, "".join(chunks))
+    return "".join(chunks)
@@ -1,27 +1,87 @@
+import json
+import queue
 import re
+import threading
+import traceback
 from sys import stderr
 
 from loguru import logger
 
-from llmail.utils.cli_args import args
-
 logging_file = stderr
+# Compiled once instead of on every line
+EMAIL_PATTERN = re.compile(r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b")
+# Lines waiting to be written. If the stream stays blocked, logging waits instead of using more memory
+MAX_QUEUED_LINES = 10000
+# Fields of a record that are in every JSON line. Anything passed with logger.bind() is added to them
+JSON_FIELDS = ("time", "level", "name", "function", "line", "message")
 
 
 def redact_email_sink(message: str):
     """Custom sink function that redacts email addresses before logging."""
-    email_pattern = r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b"
-    redacted_message = re.sub(email_pattern, "[redacted]", message)
-    print(redacted_message, file=logging_file)
+    logging_file.write(EMAIL_PATTERN.sub("[redacted]", message))
+
+
+def stream_sink(message: str):
+    logging_file.write(message)
+
+
+class BackgroundSink:
+    """Sink that hands lines to a thread which writes them, so logging doesn't wait on the stream.
+    loguru's enqueue does the same through a multiprocessing queue, which costs more per line than it saves
+    """
+
+    def __init__(self, write):
+        self._write = write
+        self._queue = queue.Queue(maxsize=MAX_QUEUED_LINES)
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, message: str):
+        self._queue.put(message)
 
+    def _run(self):
+        while (message := self._queue.get()) is not None:
+            self._write(message)
+            if self._queue.empty():
+                logging_file.flush()
 
-def set_primary_logger(log_level, redact_email_addresses):
-    """Set up the primary logger with the specified log level. Output to stderr and use the format specified."""
+    def stop(self):
+        """Write what's left. loguru calls this when the sink is removed, including at exit"""
+        self._queue.put(None)
+        self._thread.join()
+
+
+def format_json(record: dict) -> str:
+    """Format a record as a single line of JSON, for log shippers"""
+    entry = {
+        "time": record["time"].isoformat(),
+        "level": record["level"].name,
+        "name": record["name"],
+        "function": record["function"],
+        "line": record["line"],
+        "message": record["message"],
+        **{
+            key: value
+            for key, value in record["extra"].items()
+            if key not in JSON_FIELDS and not key.startswith("_")
+        },
+    }
+    if record["exception"] is not None:
+        entry["exception"] = "".join(traceback.format_exception(*record["exception"]))
+    # loguru formats the string that's returned, so the JSON (and any braces in it) goes in extra
+    record["extra"]["_json"] = json.dumps(entry, default=str)
+    return "{extra[_json]}\n"
+
+
+def set_primary_logger(log_level, redact_email_addresses, log_format: str = "text"):
+    """Set up the primary logger with the specified log level. Output to stderr and use the format specified.
+    Lines are redacted and written by a background thread so logging doesn't wait on stderr
+    """
     logger.remove()
+    sink = BackgroundSink(redact_email_sink if redact_email_addresses else stream_sink)
+    if log_format == "json":
+        logger.add(sink=sink, format=format_json, colorize=False, level=log_level)
+        return
     # ^10 is a formatting directive to center with a padding of 10
     logger_format = "<green>{time:YYYY-MM-DD HH:mm:ss}</green> |<level>{level: ^10}</level>| <level>{message}</level>"
-    sink = redact_email_sink if redact_email_addresses else stderr
     logger.add(sink=sink, format=logger_format, colorize=True, level=log_level)
-
-
-set_primary_logger(args.log_level, args.redact_email_addresses)
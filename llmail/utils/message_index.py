@@ -0,0 +1,141 @@
+import threading
+from email.message import Message
+
+from llmail.utils.state import StateStore, get_store
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS message_index (
+    folder TEXT NOT NULL,
+    uid INTEGER NOT NULL,
+    message_id TEXT,
+    in_reply_to TEXT,
+    sender TEXT,
+    thread_key TEXT,
+    PRIMARY KEY (folder, uid)
+);
+CREATE INDEX IF NOT EXISTS message_index_message_id ON message_index (message_id);
+CREATE INDEX IF NOT EXISTS message_index_in_reply_to ON message_index (in_reply_to);
+CREATE TABLE IF NOT EXISTS message_references (
+    folder TEXT NOT NULL,
+    uid INTEGER NOT NULL,
+    referenced_id TEXT NOT NULL,
+    PRIMARY KEY (folder, uid, referenced_id)
+);
+CREATE INDEX IF NOT EXISTS message_references_referenced_id ON message_references (referenced_id);
+"""
+# Created after the column is added to indexes from before thread keys were stored
+THREAD_KEY_INDEX = "CREATE INDEX IF NOT EXISTS message_index_thread_key ON message_index (thread_key);"
+
+
+class MessageIndex:
+    """Local index of Message-ID, In-Reply-To and References -> (folder, UID).
+    It's filled from the headers of the emails that are fetched anyway, so looking up where an
+    email is (or whether it was replied to) doesn't need a SEARCH in every folder.
+    """
+
+    def __init__(self, store: StateStore):
+        self.store = store
+        self.store.ensure_schema(SCHEMA)
+        self.store.add_column("message_index", "thread_key", "TEXT")
+        self.store.ensure_schema(THREAD_KEY_INDEX)
+
+    def add(
+        self,
+        folder: str,
+        uid: int,
+        message: Message,
+        sender: str | None = None,
+        thread_key: str | None = None,
+    ):
+        """Index an email from its (already parsed) headers"""
+        self.add_many(folder, [(uid, message, sender, thread_key)])
+
+    def add_many(self, folder: str, emails: list[tuple[int, Message, str | None, str | None]]):
+        """Index emails in the folder from their (already parsed) headers.
+        Each one is (UID, headers, sender, thread key). A batch costs the same as a single email
+        """
+        rows = []
+        references = []
+        for uid, message, sender, thread_key in emails:
+            rows.append(
+                (
+                    folder,
+                    uid,
+                    (message.get("Message-ID") or "").strip() or None,
+                    (message.get("In-Reply-To") or "").strip() or None,
+                    sender,
+                    thread_key,
+                )
+            )
+            references.extend(
+                (folder, uid, referenced_id.strip())
+                for referenced_id in message.get("References", "").split()
+                if referenced_id.strip()
+            )
+        if not rows:
+            return
+        self.store.executemany(
+            "INSERT OR REPLACE INTO message_index (folder, uid, message_id, in_reply_to, sender, thread_key) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        self.store.executemany(
+            "INSERT OR IGNORE INTO message_references (folder, uid, referenced_id) VALUES (?, ?, ?)",
+            references,
+        )
+
+    def forget_folder(self, folder: str):
+        """Remove a folder from the index, such as when its UIDVALIDITY changes"""
+        self.store.execute("DELETE FROM message_index WHERE folder = ?", (folder,))
+        self.store.execute("DELETE FROM message_references WHERE folder = ?", (folder,))
+
+    def locate(self, message_id: str) -> list[tuple[str, int]]:
+        """Return the (folder, UID) of every copy of the email with the Message-ID"""
+        return self.store.execute(
+            "SELECT folder, uid FROM message_index WHERE message_id = ? ORDER BY folder, uid",
+            (message_id,),
+        )
+
+    def is_known(self, message_id: str) -> bool:
+        return bool(self.locate(message_id))
+
+    def find_thread(self, thread_key: str) -> dict[str, list[int]]:
+        """Return the UIDs of the emails in the thread in every folder they're in (like the bot's replies in Sent)"""
+        rows = self.store.execute(
+            "SELECT folder, uid FROM message_index WHERE thread_key = ? OR message_id = ? "
+            "UNION SELECT folder, uid FROM message_references WHERE referenced_id = ?",
+            (thread_key, thread_key, thread_key),
+        )
+        folders = {}
+        for folder, uid in sorted(rows):
+            folders.setdefault(folder, []).append(uid)
+        return folders
+
+    def get_thread_key(self, folder: str, uid: int) -> str | None:
+        """Return the thread key that was stored for the email, if it has been indexed"""
+        rows = self.store.execute(
+            "SELECT thread_key FROM message_index WHERE folder = ? AND uid = ?", (folder, uid)
+        )
+        return rows[0][0] if rows else None
+
+    def has_reply(self, message_id: str, sender: str | None = None) -> bool:
+        """Check if any indexed email is a reply to the Message-ID (optionally only from sender)"""
+        query = "SELECT 1 FROM message_index WHERE in_reply_to = ?"
+        parameters = [message_id]
+        if sender is not None:
+            query += " AND sender = ?"
+            parameters.append(sender)
+        return bool(self.store.execute(query + " LIMIT 1", tuple(parameters)))
+
+
+_indexes: dict[str, MessageIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index() -> MessageIndex:
+    """Get the message index stored in the configured state file"""
+    store = get_store()
+    with _indexes_lock:
+        if store.path not in _indexes:
+            _indexes[store.path] = MessageIndex(store)
+        return _indexes[store.path]
@@ -0,0 +1,213 @@
+"""
+Counters and histograms served over HTTP in the Prometheus text format (--metrics-port).
+Everything is kept in memory for the whole process, so with --config the numbers are for all mailboxes.
+Only the standard library is used, so there's nothing extra to install.
+"""
+
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING, Callable
+
+from llmail.utils import logger
+from llmail.utils.toolkits import wrap_toolkit
+
+if TYPE_CHECKING:
+    from phi.tools.toolkit import Toolkit
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds. Most IMAP and SMTP calls take well under a second, LLM replies can take minutes
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_registry: list["Metric"] = []
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values))
+    return f"{{{pairs}}}"
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes the labels {self.labels}, not {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> list[tuple[str, tuple[str, ...], tuple[str, ...], float]]:
+        """(name, label names, label values, value) of each sample"""
+        with self._lock:
+            return [(self.name, self.labels, key, value) for key, value in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for name, label_names, label_values, value in self.samples():
+            lines.append(f"{name}{_format_labels(label_names, label_values)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                # Count per bucket (the last one is +Inf), then the sum
+                self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts, _ = self._values[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key][1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the with block (or decorated function) takes, even if it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list[tuple[str, tuple[str, ...], tuple[str, ...], float]]:
+        samples = []
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            # Prometheus buckets are cumulative
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                samples.append(
+                    (f"{self.name}_bucket", (*self.labels, "le"), (*key, _format_value(bound)), cumulative)
+                )
+            samples.append((f"{self.name}_sum", self.labels, key, total))
+            samples.append((f"{self.name}_count", self.labels, key, cumulative))
+        return samples
+
+
+messages_scanned = Counter(
+    "llmail_messages_scanned_total", "Emails whose headers were fetched while scanning folders"
+)
+folders_unchanged = Counter(
+    "llmail_folders_unchanged_total", "Folders that weren't searched because their STATUS didn't change"
+)
+threads_found = Counter("llmail_threads_found_total", "New threads started by a user email")
+threads = Gauge("llmail_threads", "Threads being tracked")
+replies_sent = Counter("llmail_replies_sent_total", "Replies sent")
+replies_failed = Counter(
+    "llmail_replies_failed_total", "Replies that failed and were retried or given up on", ("reason",)
+)
+replies_deferred = Counter(
+    "llmail_replies_deferred_total",
+    "Times replies were put off by a rate limit or because the LLM or SMTP server was rate limiting",
+    ("limit",),
+)
+llm_tokens = Counter(
+    "llmail_llm_tokens_total",
+    "Tokens sent to and generated by the LLM (counted with tiktoken if it's installed, otherwise estimated)",
+    ("direction",),
+)
+cycle_duration = Histogram("llmail_cycle_duration_seconds", "Time taken to check a mailbox once")
+stage_duration = Histogram(
+    "llmail_stage_duration_seconds",
+    "Time taken by each stage of a cycle (IMAP status, search and fetch, threading, LLM, tools, SMTP)",
+    ("stage",),
+)
+tool_calls = Counter("llmail_tool_calls_total", "Calls to the assistant's tools", ("tool",))
+reply_jobs = Gauge("llmail_reply_jobs", "Reply jobs in the queue", ("status",))
+
+
+def time_toolkit(toolkit: "Toolkit") -> "Toolkit":
+    """Count and time the calls to every function of the toolkit. The toolkit is changed in place"""
+    return wrap_toolkit(toolkit, _time_function, "is_timed")
+
+
+def _time_function(entrypoint: Callable, name: str) -> Callable:
+    def timed(*call_args, **kwargs):
+        tool_calls.inc(tool=name)
+        with stage_duration.time(stage="tool"):
+            return entrypoint(*call_args, **kwargs)
+
+    return timed
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        content = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format: str, *log_args):
+        # Scrapes would fill the log otherwise
+        pass
+
+
+def serve(host: str, port: int) -> ThreadingHTTPServer:
+    """Serve the metrics on http://host:port/metrics from a daemon thread"""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
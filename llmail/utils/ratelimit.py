@@ -0,0 +1,155 @@
+"""
+Rate limits for the LLM provider (requests and tokens per minute) and for sending (emails per hour).
+Each limit is a token bucket shared by everything in the process that uses the same account, so with
+--config, mailboxes that use the same provider or SMTP account share its limits.
+A reply is only started once there's room for its LLM request and its email. Otherwise it's left in
+the queue, which is also what happens when the provider or the SMTP server says to slow down.
+The per-sender limit is checked when a job is claimed (see jobs.JobQueue.claim).
+"""
+
+import smtplib
+import threading
+import time
+
+from llmail.utils import logger
+from llmail.utils.cli_args import args
+
+# How long to hold off after a 429 or a temporary SMTP error if the server doesn't say
+THROTTLED_SECONDS = 60
+
+
+class TokenBucket:
+    """Holds up to capacity tokens and gains capacity tokens every period seconds, so a burst of up to
+    capacity is allowed after a quiet spell but the average never goes over the rate.
+    Taking more tokens than there are (like tokens counted after a request) leaves a debt that's paid back first
+    """
+
+    def __init__(self, capacity: float, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, amount: float = 1) -> float:
+        """Seconds until amount tokens are available (0 if they are now)"""
+        with self._lock:
+            self._refill()
+            # More than the capacity would never be available, so the bucket only has to be full
+            missing = min(amount, self.capacity) - self._tokens
+            return max(missing, 0) / self.rate
+
+    def take(self, amount: float = 1):
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+
+    def give_back(self, amount: float = 1):
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+    def pause(self, seconds: float):
+        """Empty the bucket so the next token is only available in seconds"""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 1 - seconds * self.rate)
+
+
+_buckets: dict[tuple, TokenBucket] = {}
+_lock = threading.Lock()
+
+
+def _bucket(kind: str, account: tuple, capacity: float | None, period: float) -> TokenBucket | None:
+    if not capacity:
+        return None
+    key = (kind, *account)
+    with _lock:
+        if key not in _buckets:
+            _buckets[key] = TokenBucket(capacity, period)
+        return _buckets[key]
+
+
+def _llm_account() -> tuple:
+    return (args.llm_provider, args.llm_base_url, args.llm_api_key, args.llm_model)
+
+
+def _smtp_account() -> tuple:
+    return (args.smtp_host, args.smtp_username)
+
+
+def llm_requests() -> TokenBucket | None:
+    return _bucket("llm_requests", _llm_account(), args.llm_requests_per_minute, 60)
+
+
+def llm_tokens() -> TokenBucket | None:
+    return _bucket("llm_tokens", _llm_account(), args.llm_tokens_per_minute, 60)
+
+
+def smtp_sends() -> TokenBucket | None:
+    return _bucket("smtp_sends", _smtp_account(), args.smtp_sends_per_hour, 60 * 60)
+
+
+def reserve_reply() -> tuple[float, str | None]:
+    """Take what a reply needs (an LLM request and an email) if all of it is available.
+    Otherwise take nothing and return how many seconds to wait and which limit was hit
+    """
+    buckets = {"llm_requests": llm_requests(), "llm_tokens": llm_tokens(), "smtp_sends": smtp_sends()}
+    buckets = {name: bucket for name, bucket in buckets.items() if bucket is not None}
+    # The lock keeps two workers from both seeing room for one more reply
+    with _lock:
+        delays = {name: bucket.delay() for name, bucket in buckets.items()}
+        name, delay = max(delays.items(), key=lambda item: item[1], default=(None, 0))
+        if delay > 0:
+            return delay, name
+        for name, bucket in buckets.items():
+            # Tokens are only known after the request, so they're counted then (see charge_llm)
+            if name != "llm_tokens":
+                bucket.take()
+    return 0, None
+
+
+def release_reply():
+    """Give back what reserve_reply took, such as when the job turned out not to need a reply"""
+    for bucket in (llm_requests(), smtp_sends()):
+        if bucket is not None:
+            bucket.give_back()
+
+
+def charge_llm(tokens: int, requests: int = 0):
+    """Count tokens (and requests that weren't reserved, like summaries) against the LLM limits"""
+    if requests and (bucket := llm_requests()) is not None:
+        bucket.take(requests)
+    if tokens and (bucket := llm_tokens()) is not None:
+        bucket.take(tokens)
+
+
+def throttled(error: Exception) -> tuple[float, str] | None:
+    """If the error means the provider or the SMTP server wants fewer requests, hold off on it and
+    return for how many seconds and which server it was. None for other errors
+    """
+    if isinstance(error, smtplib.SMTPResponseException) and 400 <= error.smtp_code < 500:
+        # 4xx replies are temporary. Some servers use them for sending limits
+        seconds, bucket, limit, option = THROTTLED_SECONDS, smtp_sends(), "smtp", "--smtp-sends-per-hour"
+    elif getattr(error, "status_code", None) == 429:
+        # Both openai's and ollama's errors have status_code
+        response = getattr(error, "response", None)
+        retry_after = getattr(response, "headers", {}).get("retry-after")
+        try:
+            seconds = float(retry_after) if retry_after else THROTTLED_SECONDS
+        except ValueError:
+            # It can also be an HTTP date
+            seconds = THROTTLED_SECONDS
+        bucket, limit, option = llm_requests() or llm_tokens(), "llm", "--llm-requests-per-minute"
+    else:
+        return None
+    if bucket is not None:
+        bucket.pause(seconds)
+    else:
+        logger.warning(f"Rate limited by the {limit.upper()} server. Set {option} to stay under its limit")
+    return seconds, limit
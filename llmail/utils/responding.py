@@ -1,299 +1,690 @@
+import contextvars
 import imaplib
 import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from email import message_from_bytes
 from email.utils import make_msgid
-from ssl import SSLError
+from typing import TYPE_CHECKING, Callable
 
-import yagmail
 from imapclient import IMAPClient
-from phi.assistant import Assistant
-from phi.llm.openai.like import OpenAILike
-from phi.tools.duckduckgo import DuckDuckGo
-from phi.llm.ollama import Ollama
-from phi.tools.exa import ExaTools
-from phi.tools.website import WebsiteTools
-# from phi.knowledge.website import WebsiteKnowledgeBase
-# from phi.knowledge.combined import CombinedKnowledgeBase
-import ollama
 
 # Uses utils/__init__.py to import from utils/logging.py and utils/cli_args.py respectively
-from llmail.utils import logger, args, bot_email
+from llmail.utils import logger, args
 
 # Import files from utils/
-from llmail.utils import tracking
+from llmail.utils import (
+    body,
+    connection,
+    context,
+    jobs,
+    llm,
+    message_index,
+    metrics,
+    ratelimit,
+    response_cache,
+    sending,
+    state,
+    threads,
+    tracking,
+)
 
 # Import utilites from utils/utils.py
-from llmail.utils.utils import get_plain_email_content
+from llmail.utils.utils import fetch_in_batches
 
-email_threads = {}
+if TYPE_CHECKING:
+    from phi.assistant import Assistant
 
+# Lease on a reply job when there's no --reply-timeout (and extra time for sending it)
+JOB_LEASE_SECONDS = 600
+# If a rate limit has room again within this many seconds, the cycle waits for it.
+# Otherwise the rest of the replies are left for the next cycle so new emails are still checked
+RATE_LIMIT_WAIT_SECONDS = 30
 
+
+class Mailbox:
+    """The threads being tracked for a mailbox"""
+
+    def __init__(self):
+        self.email_threads = {}
+        self.email_threads_lock = threading.Lock()
+
+
+_mailboxes: dict[tuple, Mailbox] = {}
+_mailboxes_lock = threading.Lock()
+
+
+def get_mailbox() -> Mailbox:
+    """Get the threads for the configured account and subject (there can be several with --config)"""
+    key = (args.imap_host, args.imap_username, args.subject_key)
+    with _mailboxes_lock:
+        if key not in _mailboxes:
+            _mailboxes[key] = Mailbox()
+        return _mailboxes[key]
+
+
+@metrics.cycle_duration.time()
 def fetch_and_process_emails(
     look_for_subject: str,
     alias: str = None,
     system_prompt: str = None,
 ):
     """Fetch and process emails from the IMAP server."""
-    global email_threads
-    with IMAPClient(args.imap_host) as client:
-        client.login(args.imap_username, args.imap_password)
-
-        email_threads = {}
-        folders = args.folder if args.folder else [folder[2] for folder in client.list_folders()]
-        # for folder in client.list_folders():
-        # Disabling fetching from all folders due it not being inefficient
-        # Instead, just fetch from INBOX and get the threads later
-        for folder in folders:
+    email_threads = get_mailbox().email_threads
+    store = state.get_store()
+    pool = connection.get_pool()
+    # The connections are kept open between cycles. If one was dropped mid-scan, try again with a new one
+    try:
+        updated_threads, high_water_marks, folder_statuses = scan_folders(pool, store, look_for_subject)
+    except connection.CONNECTION_ERRORS as e:
+        logger.warning(f"Lost the IMAP connection ({e}). Reconnecting and trying again...")
+        updated_threads, high_water_marks, folder_statuses = scan_folders(pool, store, look_for_subject)
+
+    # Formatting every thread is only worth it when debug logs are on
+    logger.opt(lazy=True).debug("{}", lambda: email_threads)
+    # Check if there are any emails wherein the last email in the thread is a user email
+    # If so, queue a reply. The queue is saved, so the reply isn't lost if the program stops before sending it
+    queue = jobs.get_queue()
+    for message_id in updated_threads:
+        email_thread = email_threads[message_id]
+        # Reply to the newest user email, unless the bot already replied to it
+        # Which email the bot replied to comes from the thread tree, so it doesn't depend on timestamps
+        last_email = email_thread.latest_user_email()
+        if last_email is None or email_thread.is_answered(last_email):
+            logger.debug("Newest user email in thread for email {} was replied to by the bot", message_id)
+            continue
+        logger.debug("Newest email in thread for email {} is from {}", message_id, last_email.sender)
+        # There's only one job per email, so scanning it again doesn't queue another reply
+        if queue.enqueue(message_id, str(last_email.message_id), last_email.sender):
+            logger.debug("Queued a reply to email {}", last_email.message_id)
+
+    # The emails that need replies are in the queue, so the folders don't need to be scanned again
+    for folder, (uidvalidity, last_uid) in high_water_marks.items():
+        store.set_folder_state(folder, uidvalidity, last_uid)
+    for folder, status in folder_statuses.items():
+        store.set_folder_status(folder, status)
+    logger.info(f"Current number of email threads: {len(email_threads.keys())}")
+    with _mailboxes_lock:
+        metrics.threads.set(sum(len(mailbox.email_threads) for mailbox in _mailboxes.values()))
+    process_jobs(pool, store, look_for_subject, system_prompt)
+
+
+def process_jobs(
+    pool: connection.IMAPPool, store: state.StateStore, look_for_subject: str, system_prompt: str
+):
+    """Send the replies in the queue that are ready, --max-concurrent-replies at a time and within the rate limits"""
+    queue = jobs.get_queue()
+    queue.recover()
+    owner = jobs.worker_name()
+    # Long enough for the reply to be generated and sent
+    lease_seconds = (args.reply_timeout or JOB_LEASE_SECONDS) + JOB_LEASE_SECONDS
+    workers = max(args.max_concurrent_replies, 1)
+    completed = 0
+    # Seconds until a rate limit has room for another reply, and whether to stop claiming jobs this cycle
+    pause = 0
+    deferred = False
+    # Generating a reply mostly waits on the LLM, so threads are replied to in parallel
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="reply") as executor:
+        futures: dict[Future, jobs.Job] = {}
+        while True:
+            # Jobs are only claimed when there's a worker for them so the leases don't run out while waiting
+            while (
+                not deferred
+                and not pause
+                and len(futures) < workers
+                and (job := queue.claim(owner, lease_seconds, args.sender_replies_per_hour)) is not None
+            ):
+                pause, limit = ratelimit.reserve_reply()
+                if pause:
+                    queue.release(job.message_id)
+                    metrics.replies_deferred.inc(limit=limit)
+                    if pause > RATE_LIMIT_WAIT_SECONDS:
+                        logger.info(
+                            f"Reached the {limit} limit. Leaving the rest of the replies for a later cycle ({pause:.0f} seconds until there's room)"
+                        )
+                        deferred = True
+                    else:
+                        logger.debug(f"Reached the {limit} limit. Waiting {pause:.1f} seconds")
+                    break
+                reply = prepare_reply(pool, store, queue, job, owner, look_for_subject, system_prompt)
+                if reply is None:
+                    ratelimit.release_reply()
+                    continue
+                # The context is copied so the workers see the same args (such as the mailbox's settings)
+                futures[executor.submit(contextvars.copy_context().run, reply_to_thread, **reply)] = job
+            if not futures:
+                if not pause or deferred:
+                    break
+                time.sleep(pause)
+                pause = 0
+                continue
+            # Wakes up when a reply is done or when the rate limit has room again
+            done, _ = wait(futures, timeout=pause or None, return_when=FIRST_COMPLETED)
+            pause = 0
+            for future in done:
+                job = futures.pop(future)
+                completed += 1
+                try:
+                    future.result()
+                    queue.complete(job.message_id)
+                    metrics.replies_sent.inc()
+                    logger.info(f"Replied to thread for email {job.thread_key} ({completed} this cycle)")
+                except jobs.LeaseLost:
+                    logger.warning(f"Lost the lease on the reply to email {job.message_id}. Not sending it")
+                except llm.GenerationTimeout as e:
+                    logger.warning(f"{e} for thread for email {job.thread_key}")
+                    queue.fail(job.message_id, str(e))
+                    metrics.replies_failed.inc(reason="timeout")
+                except Exception as e:
+                    if (throttled := ratelimit.throttled(e)) is not None:
+                        # Not the reply's fault, so it doesn't count as an attempt
+                        seconds, server = throttled
+                        logger.warning(
+                            f"Rate limited by the {server.upper()} server ({e}). Trying the reply to thread for email {job.thread_key} again in {seconds:.0f} seconds"
+                        )
+                        queue.release(job.message_id, seconds)
+                        metrics.replies_deferred.inc(limit=f"{server}_throttled")
+                        deferred = True
+                        continue
+                    if queue.status(job.message_id) == jobs.SENDING and not isinstance(
+                        e, sending.NOT_SENT_ERRORS
+                    ):
+                        # Like recover(), a reply that might have been sent is never sent again
+                        logger.opt(exception=e).error(
+                            f"Failed while sending the reply to thread for email {job.thread_key}. It might have been sent, so it won't be sent again"
+                        )
+                        queue.complete(job.message_id, f"Failed while sending: {e!r}")
+                        metrics.replies_failed.inc(reason="unknown")
+                        continue
+                    # Try again later instead of stopping the other replies
+                    logger.exception(f"Failed to reply to thread for email {job.thread_key}")
+                    queue.fail(job.message_id, repr(e))
+                    metrics.replies_failed.inc(reason="error")
+    for status, count in jobs.total_counts().items():
+        metrics.reply_jobs.set(count, status=status)
+
+
+def prepare_reply(
+    pool: connection.IMAPPool,
+    store: state.StateStore,
+    queue: jobs.JobQueue,
+    job: jobs.Job,
+    owner: str,
+    look_for_subject: str,
+    system_prompt: str,
+) -> dict | None:
+    """Get what's needed to reply for a job. Returns None (and finishes the job) if it doesn't need a reply"""
+    email_threads = get_mailbox().email_threads
+    if job.thread_key not in email_threads:
+        # Such as a job left from before a restart
+        load_thread(pool, store, job, look_for_subject)
+    email_thread = email_threads.get(job.thread_key)
+    if email_thread is None:
+        queue.fail(job.message_id, "Couldn't find the thread")
+        return None
+    last_email = email_thread.latest_user_email()
+    if last_email is None or str(last_email.message_id) != job.message_id:
+        queue.complete(job.message_id, "A newer email in the thread is replied to instead")
+        return None
+    if email_thread.is_answered(last_email):
+        queue.complete(job.message_id, "Already replied to")
+        return None
+
+    def before_send(reply_message_id: str):
+        if not queue.mark_sending(job.message_id, owner, reply_message_id):
+            raise jobs.LeaseLost(job.message_id)
+
+    return dict(
+        thread_id=job.thread_key,
+        # The history is built here since the workers shouldn't touch IMAP or email_threads
+        thread=tracking.get_thread_history(None, email_thread),
+        subject=email_thread.initial_email.subject,
+        msg_id=last_email.imap_id,
+        message_id=last_email.message_id,
+        references_ids=last_email.references,
+        system_prompt=system_prompt,
+        before_send=before_send,
+    )
+
+
+def load_thread(
+    pool: connection.IMAPPool, store: state.StateStore, job: jobs.Job, look_for_subject: str
+):
+    """Add the thread of a job to email_threads, starting from the folder the email is in
+    (backfill_threads also adds the emails of the thread in other folders)
+    """
+    for folder, _ in message_index.get_index().locate(job.message_id):
+        with pool.connection() as client:
             try:
                 client.select_folder(folder)
-            # If the error is imaplib.IMAP4.error: select failed:...
             except imaplib.IMAP4.error:
-                logger.debug(f"Failed to select folder {folder[2]}. Skipping...")
+                logger.debug(f"Failed to select folder {folder}. Skipping...")
                 continue
-            # Might be smart to also search for forwarded emails
-            messages = client.search(
-                [
-                    "OR",
-                    "SUBJECT",
-                    look_for_subject,
-                    "SUBJECT",
-                    f"Re: {look_for_subject}",
-                ]
-            )
-            for msg_id in messages:
-                # If an email is deleted while the bot is running it will sometimes throw a key error
-                msg_data = client.fetch([msg_id], ["ENVELOPE", "BODY[]", "RFC822.HEADER"])
-                envelope = msg_data[msg_id][b"ENVELOPE"]
-                subject = envelope.subject.decode()
-                # Use regex to verify that the subject optionally starts with "Fwd: " or "Re: " and then the intended subject (nothing case-sensitive)
-                # re.escape is used to escape any special characters in the subject
-                if not re.match(
-                    r"^(Fwd: ?|Re: ?)*" + re.escape(look_for_subject) + r"$",
-                    subject,
-                    re.IGNORECASE,
-                ):
-                    logger.warning(
-                        f"Skipping email with subject '{subject}' as it does not match the intended subject"
-                    )
-                    continue
-                timestamp = envelope.date
-                # Parse the headers from the email data
-                message = message_from_bytes(msg_data[msg_id][b"RFC822.HEADER"])
-                sender = tracking.get_sender(message)["email"]
-                headers = dict(message.items())
-                # Extract references from the email
-                references_header = headers.get("References", "")
-                references_ids = [
-                    m_id.strip() for m_id in references_header.split() if m_id.strip()
-                ]
-                # Extract the Message-ID header
-                message_id_header = headers.get("Message-ID")
-                # If the Message-ID header doesn't exist, fallback to the IMAP message ID
-                message_id = message_id_header if message_id_header else msg_id
-
-                # Check if the email is new (not replied to by the bot yet)
-                # if is_uid_user_email(client, msg_id, sender):
-                if True:
-                    logger.debug(
-                        f"On email from {sender} sent at {timestamp} with subject {subject}"
-                    )
-                    # Put this as message_id so the key for email_threads is the top-level if this email is top-level
-                    parent_email_id = tracking.get_top_level_email(client, msg_id, message_id)
-
-                    # Unless EmailThread is being used for threads, this is mainly useful for debugging
-                    if parent_email_id in email_threads:
-                        # Add the reply to the existing thread
-                        email_threads[parent_email_id].add_reply(
-                            tracking.Email(
-                                imap_id=msg_id,
-                                message_id=message_id,
-                                subject=subject,
-                                sender=sender,
-                                timestamp=timestamp,
-                                # Get just the normal email content
-                                body=get_plain_email_content(
-                                    message_from_bytes(msg_data[msg_id][b"BODY[]"])
-                                ),
-                                references=references_ids,
-                            )
-                        )
-                        # logger.debug(f"Added message {message_id} to existing thread for email {parent_email_id}")
-                    else:
-                        # Create a new thread for the email, unless it's a bot email
-                        if sender != bot_email:
-                            email_thread = tracking.EmailThread(
-                                tracking.Email(
-                                    imap_id=msg_id,
-                                    message_id=message_id,
-                                    subject=subject,
-                                    sender=sender,
-                                    timestamp=timestamp,
-                                    # Get just the normal email content
-                                    body=get_plain_email_content(
-                                        message_from_bytes(msg_data[msg_id][b"BODY[]"])
-                                    ),
-                                    references=references_ids,
-                                )
-                            )
-                            email_threads[parent_email_id] = email_thread
-                            logger.debug(
-                                f"Created new thread for email {message_id} sent at {timestamp}"
-                            )
-
-        logger.debug(email_threads)
-        # Check if there are any emails wherein the last email in the thread is a user email
-        # If so, send a reply
-        for message_id, email_thread in email_threads.items():
-            # Check if the email only has an initial email
-            # If it does, then there won't be any replies and an index error will occur
-            if len(email_thread.replies) == 0:
-                logger.debug(f"No replies in thread for email {message_id}")
-                message_id = email_thread.initial_email.message_id
-                msg_id = email_thread.initial_email.imap_id
-                references_ids = email_thread.initial_email.references
-            elif len(email_thread.replies) > 0 and email_thread.replies[-1].sender != bot_email:
+            _, last_uid = store.get_folder_state(folder)
+            backfill_threads(client, folder, {job.thread_key}, look_for_subject, last_uid)
+        if job.thread_key in get_mailbox().email_threads:
+            return
+
+
+def scan_folders(
+    pool: connection.IMAPPool, store: state.StateStore, look_for_subject: str
+) -> tuple[set[str], dict[str, tuple[int, int]], dict[str, dict[str, int]]]:
+    """Add new emails from all folders to email_threads.
+    Folders whose STATUS is the same as when they were last scanned aren't selected or searched, so a
+    cycle with no new emails only costs one command per folder.
+    Return the keys of the threads that changed, the new high-water mark of each folder and the
+    STATUS of each folder that was scanned.
+    """
+    with pool.connection() as client:
+        folders = args.folder if args.folder else connection.list_folder_names(client)
+    # for folder in client.list_folders():
+    # Disabling fetching from all folders due it not being inefficient
+    # Instead, just fetch from INBOX and get the threads later
+
+    def scan_with_pool(folder: str):
+        with pool.connection() as client:
+            # The status is from before the folder is searched, so emails that arrive in between
+            # make it look changed next cycle
+            with metrics.stage_duration.time(stage="imap_status"):
+                status = connection.get_folder_status(client, folder)
+            if status is not None and status == store.get_folder_status(folder):
+                logger.debug(f"Nothing changed in {folder} since it was last scanned. Skipping...")
+                metrics.folders_unchanged.inc()
+                return folder, None, None
+            return folder, scan_folder(client, folder, store, look_for_subject), status
+
+    # email_threads is kept between cycles so only new messages need to be fetched
+    # Only threads that got a new message this cycle can need a reply
+    updated_threads = set()
+    # The high-water marks are only saved once the cycle is done so a crash doesn't skip emails
+    high_water_marks = {}
+    folder_statuses = {}
+    if pool.size > 1 and len(folders) > 1:
+        # Each folder is scanned on its own connection
+        with ThreadPoolExecutor(max_workers=pool.size) as executor:
+            futures = [
+                executor.submit(contextvars.copy_context().run, scan_with_pool, folder)
+                for folder in folders
+            ]
+            results = [future.result() for future in futures]
+    else:
+        results = [scan_with_pool(folder) for folder in folders]
+    for folder, result, status in results:
+        if result is None:
+            continue
+        folder_updated_threads, high_water_marks[folder] = result
+        updated_threads |= folder_updated_threads
+        if status is not None:
+            folder_statuses[folder] = status
+    return updated_threads, high_water_marks, folder_statuses
+
+
+def scan_folder(
+    client: IMAPClient, folder: str, store: state.StateStore, look_for_subject: str
+) -> tuple[set[str], tuple[int, int]] | None:
+    """Add the new emails in a folder to email_threads.
+    Return the keys of the threads that changed and the folder's new UIDVALIDITY and high-water mark.
+    """
+    try:
+        select_info = client.select_folder(folder)
+    # If the error is imaplib.IMAP4.error: select failed:...
+    except imaplib.IMAP4.error:
+        logger.debug(f"Failed to select folder {folder}. Skipping...")
+        # The folder might have been deleted or renamed
+        connection.invalidate_folder_cache()
+        return None
+    uidvalidity = select_info.get(b"UIDVALIDITY")
+    known_uidvalidity, last_uid = store.get_folder_state(folder)
+    if known_uidvalidity != uidvalidity:
+        if known_uidvalidity is not None:
+            logger.info(f"UIDVALIDITY of {folder} changed. Doing a full resync")
+            # The UIDs in the index don't mean anything anymore
+            message_index.get_index().forget_folder(folder)
+        last_uid = 0
+    # Might be smart to also search for forwarded emails
+    criteria = subject_criteria(look_for_subject)
+    if last_uid:
+        criteria = ["UID", f"{last_uid + 1}:*", *criteria]
+    # "n:*" always matches the highest UID, even if it's lower than n, so filter again
+    with metrics.stage_duration.time(stage="imap_search"):
+        messages = sorted(msg_id for msg_id in client.search(criteria) if msg_id > last_uid)
+    logger.debug("Found {} new matching emails in {}", len(messages), folder)
+    updated_threads = process_emails(
+        client, folder, messages, look_for_subject, backfill_before=last_uid
+    )
+    uid_next = select_info.get(b"UIDNEXT")
+    return updated_threads, (
+        uidvalidity,
+        max([last_uid, *messages, *([uid_next - 1] if uid_next else [])]),
+    )
+
+
+def subject_criteria(look_for_subject: str) -> list:
+    """IMAP SEARCH criteria for emails with the subject (or a reply to it)"""
+    return [
+        "OR",
+        "SUBJECT",
+        look_for_subject,
+        "SUBJECT",
+        f"Re: {look_for_subject}",
+    ]
+
+
+def process_emails(
+    client: IMAPClient,
+    folder: str,
+    msg_ids: list[int],
+    look_for_subject: str,
+    backfill_before: int = 0,
+) -> set[str]:
+    """Fetch emails and add them to the threads they belong to. Return the keys of the threads that were changed.
+
+    The envelopes, headers and body structures are fetched first (in batches of --fetch-batch-size).
+    Only the text part of the emails with a matching subject is fetched after that (up to --max-body-bytes).
+    If backfill_before is set and an email belongs to a thread that isn't known yet, the older
+    emails (UIDs up to backfill_before) in the thread are added first so the thread is complete.
+    """
+    mailbox = get_mailbox()
+    email_threads = mailbox.email_threads
+    index = message_index.get_index()
+    backend = threads.get_backend(client)
+    matching_emails = {}
+    scanned = 0
+    # The time includes parsing the headers, which is small next to the round-trips
+    with metrics.stage_duration.time(stage="imap_fetch"):
+        # If an email is deleted while the bot is running it won't be in the response, so it's skipped
+        for msg_id, data in fetch_in_batches(
+            client,
+            sorted(msg_ids),
+            ["ENVELOPE", "RFC822.HEADER", "BODYSTRUCTURE", *threads.fetch_items(backend)],
+            args.fetch_batch_size,
+        ):
+            scanned += 1
+            envelope = data[b"ENVELOPE"]
+            subject = envelope.subject.decode()
+            # Use regex to verify that the subject optionally starts with "Fwd: " or "Re: " and then the intended subject (nothing case-sensitive)
+            # re.escape is used to escape any special characters in the subject
+            if not re.match(
+                r"^(Fwd: ?|Re: ?)*" + re.escape(look_for_subject) + r"$",
+                subject,
+                re.IGNORECASE,
+            ):
+                # SUBJECT searches for a substring, so this is common in a busy mailbox
                 logger.debug(
-                    f"Last email in thread for email {message_id} is from {email_thread.replies[-1].sender}"
+                    "Skipping email with subject '{}' as it does not match the intended subject", subject
                 )
-                message_id = email_thread.replies[-1].message_id
-                msg_id = email_thread.replies[-1].imap_id
-                references_ids = email_thread.replies[-1].references
-            elif len(email_thread.replies) > 0 and email_thread.replies[-1].sender == bot_email:
-                logger.debug(f"Last email in thread for email {message_id} is from the bot")
                 continue
+            # Parse the headers from the email data
+            message = message_from_bytes(data[b"RFC822.HEADER"])
+            # Extract the Message-ID header
+            message_id_header = message.get("Message-ID")
+            # If the Message-ID header doesn't exist, fallback to the IMAP message ID
+            message_id = message_id_header if message_id_header else msg_id
+            matching_emails[msg_id] = (message, message_id, data)
+    metrics.messages_scanned.inc(scanned)
+
+    # The key for email_threads is the top-level email (or the server's thread ID)
+    with metrics.stage_duration.time(stage="threading"):
+        thread_keys = threads.get_thread_keys(
+            client, folder, backend, matching_emails, subject_criteria(look_for_subject)
+        )
+    # The headers are already here, so keeping the index up to date is free
+    index.add_many(
+        folder,
+        [
+            (msg_id, message, tracking.get_sender(message)["email"], thread_keys[msg_id])
+            for msg_id, (message, _, _) in matching_emails.items()
+        ],
+    )
+
+    if backfill_before:
+        unknown_threads = {
+            parent_email_id
+            for parent_email_id in thread_keys.values()
+            if parent_email_id not in email_threads
+        }
+        if unknown_threads:
+            backfill_threads(client, folder, unknown_threads, look_for_subject, backfill_before)
+
+    # Bot emails are only added to threads that exist (or are created from this batch), so the
+    # text of the others isn't needed
+    user_threads = {
+        thread_keys[msg_id]
+        for msg_id, (message, _, _) in matching_emails.items()
+        if tracking.get_sender(message)["email"] != args.bot_email
+    }
+    with metrics.stage_duration.time(stage="imap_fetch_body"):
+        texts = body.fetch_texts(
+            client,
+            {
+                msg_id: (data[b"BODYSTRUCTURE"], message.get("Message-ID"))
+                for msg_id, (message, _, data) in matching_emails.items()
+                if thread_keys[msg_id] in user_threads or thread_keys[msg_id] in email_threads
+            },
+            args.max_body_bytes,
+            args.fetch_batch_size,
+        )
+    updated_threads = set()
+    for msg_id, (message, message_id, data) in matching_emails.items():
+        if msg_id not in texts:
+            continue
+        envelope = data[b"ENVELOPE"]
+        parent_email_id = thread_keys[msg_id]
+        sender = tracking.get_sender(message)["email"]
+        timestamp = envelope.date
+        # Extract references from the email
+        references_header = message.get("References", "")
+        references_ids = [m_id.strip() for m_id in references_header.split() if m_id.strip()]
+        # The arguments are only formatted if debug logs are on, which matters for every email in a big sync
+        logger.debug("On email from {} sent at {} with subject {}", sender, timestamp, envelope.subject)
+        email = tracking.Email(
+            imap_id=msg_id,
+            message_id=message_id,
+            subject=envelope.subject.decode(),
+            sender=sender,
+            timestamp=timestamp,
+            # Get just the normal email content
+            body=texts[msg_id],
+            references=references_ids,
+            in_reply_to=message.get("In-Reply-To", "").strip() or None,
+        )
+        # Folders can be scanned in parallel
+        with mailbox.email_threads_lock:
+            # Unless EmailThread is being used for threads, this is mainly useful for debugging
+            if parent_email_id in email_threads:
+                # Add the reply to the existing thread
+                email_threads[parent_email_id].add_reply(email)
+                # logger.debug(f"Added message {message_id} to existing thread for email {parent_email_id}")
+            # Create a new thread for the email, unless it's a bot email
+            elif sender != args.bot_email:
+                email_threads[parent_email_id] = tracking.EmailThread(email)
+                metrics.threads_found.inc()
+                logger.debug("Created new thread for email {} sent at {}", message_id, timestamp)
             else:
-                ValueError("Invalid email thread")
-            # Select tools
-            # website_knowledge_base = WebsiteKnowledgeBase(
-            #     urls=args.scrapable_url if args.scrapable_url else []
-            # )
-            tools = [
-                # Giving WebsiteTools the knowledge base seems to allow it to add URLs to the knowledge base
-                # WebsiteTools(knowledge_base=website_knowledge_base),
-                WebsiteTools(),
-                DuckDuckGo(search=True, news=True),
+                continue
+        updated_threads.add(parent_email_id)
+    return updated_threads
+
+
+def backfill_threads(
+    client: IMAPClient,
+    folder: str,
+    top_level_email_ids: set[str],
+    look_for_subject: str,
+    before_uid: int,
+):
+    """Add the already-seen emails of threads to email_threads (such as after a restart).
+    The emails can be in any folder (like the bot's replies in Sent). Only the emails up to a folder's
+    high-water mark (before_uid for this folder) are added since the newer ones are added when the
+    folder is scanned. The client is left with folder selected
+    """
+    logger.debug("Backfilling threads for emails {}", top_level_email_ids)
+    index = message_index.get_index()
+    store = state.get_store()
+    older_messages: dict[str, set[int]] = {folder: set()}
+    # Folders with the top-level emails are done first, since bot emails are only added to threads that exist
+    top_level_folders = set()
+    # Threads that aren't in the index (such as ones from before it existed) are searched for instead
+    unindexed_threads = []
+    for top_level_email_id in top_level_email_ids:
+        indexed_messages = index.find_thread(top_level_email_id)
+        if not indexed_messages:
+            unindexed_threads.append(top_level_email_id)
+            continue
+        for member_folder, uids in indexed_messages.items():
+            last_uid = before_uid if member_folder == folder else store.get_folder_state(member_folder)[1]
+            older_messages.setdefault(member_folder, set()).update(uid for uid in uids if uid <= last_uid)
+        top_level_folders.update(member_folder for member_folder, _ in index.locate(top_level_email_id))
+    if unindexed_threads:
+        # Match any email in one of the threads
+        thread_criteria = []
+        for top_level_email_id in unindexed_threads:
+            thread_criteria = [
+                *(["OR"] if thread_criteria else []),
+                *thread_criteria,
+                *threads.search_criteria(top_level_email_id),
             ]
-            if args.exa_api_key is not None:
-                tools.append(ExaTools(api_key=args.exa_api_key, highlights=True, num_results=10))
-                tools = [tool for tool in tools if not isinstance(tool, DuckDuckGo)]
-                logger.info("Removed DuckDuckGo from tools due to Exa being enabled")
-            if args.no_tools:
-                tools = []
-            # Chose how to send the request to the provider
-            match args.llm_provider:
-                case "openai-like":
-                    llm = OpenAILike(
-                        model=args.llm_model,
-                        api_key=args.llm_api_key,
-                        base_url=args.llm_base_url,
-                    )
-                case "ollama":
-                    ollama_client = ollama.Client(host=args.llm_base_url)
-                    for model in ollama_client.list()["models"]:
-                        if model["name"] == args.llm_model:
-                            logger.debug(f"{args.llm_model} is already downloaded")
-                            break
-                    else:
-                        logger.info(f"Downloading {args.llm_model}")
-                        ollama_client.pull(model=args.llm_model)
-                    llm = Ollama(
-                        model=args.llm_model,
-                        host=args.llm_base_url,
-                    )
-            assistant = Assistant(
-                llm=llm,
-                tools=tools,
-                show_tool_calls=args.show_tool_calls,
-                # additional_messages=[
-                #     {
-                #         "role": "system",
-                #         "content": "Functions generally need arguments. Only provide your final iteration to the user. For example, if you're searching for a website, don't tell the user that you're searching for the website. Just provide the final result. Remember, the user is only going to see the final response, not the steps you took to get there. Only provide the final result. Try to use the most appropriate tool for the task. For example, if the user asks about a website, try searching for it and scraping it too. For URLs, ensure the protocol is included (e.g. https://). Use the functions to ensure that the information is accurate and up-to-date",
-                #     },
-                # ],
-                tool_call_limit=10,
-                debug_mode=args.phidata_debug,
-                prevent_hallucinations=True,
-                # knowledge_base=CombinedKnowledgeBase(
-                #     sources=[
-                #         website_knowledge_base,
-                #     ]
-                # ),
-            )
-            send_reply(
-                thread=tracking.get_thread_history(client, email_thread),
-                subject=subject,
-                alias=args.alias,
-                client=client,
-                msg_id=msg_id,
-                message_id=message_id,
-                references_ids=references_ids,
-                assistant=assistant,
-                system_prompt=system_prompt,
+        older_messages[folder].update(
+            client.search(
+                ["UID", f"1:{before_uid}", *thread_criteria, *subject_criteria(look_for_subject)]
             )
+        )
+    selected = folder
+    for member_folder in sorted(
+        older_messages, key=lambda name: (name not in top_level_folders, name != folder, name)
+    ):
+        if not older_messages[member_folder]:
+            continue
+        if member_folder != selected:
+            try:
+                client.select_folder(member_folder)
+            except imaplib.IMAP4.error:
+                logger.debug(f"Failed to select folder {member_folder}. Skipping...")
+                continue
+            selected = member_folder
+        process_emails(client, member_folder, sorted(older_messages[member_folder]), look_for_subject)
+    if selected != folder:
+        # The caller carries on with the emails in folder
+        client.select_folder(folder)
 
-        logger.info(f"Current number of email threads: {len(email_threads.keys())}")
+
+def reply_to_thread(
+    thread_id: str,
+    thread: list[dict],
+    subject: str,
+    msg_id: int,
+    message_id: str,
+    references_ids: list[str],
+    system_prompt: str,
+    before_send: Callable[[str], None] | None = None,
+):
+    """Generate and send a reply to the last email in a thread. Runs in a worker thread"""
+    logger.debug("Generating a reply for thread for email {}", thread_id)
+    send_reply(
+        thread=thread,
+        thread_id=thread_id,
+        subject=subject,
+        alias=args.alias,
+        msg_id=msg_id,
+        message_id=message_id,
+        references_ids=references_ids,
+        assistant=llm.create_assistant(),
+        system_prompt=system_prompt,
+        before_send=before_send,
+    )
 
 
 def send_reply(
     thread: list[dict],
     subject: str,
     alias: str,
-    client: IMAPClient,
     msg_id: int,
     message_id: str,
     references_ids: list[str],
-    assistant: Assistant,
+    assistant: "Assistant",
     system_prompt: str,
+    before_send: Callable[[str], None] | None = None,
+    thread_id: str | None = None,
 ):
-    """Send a reply to the email with the specified message ID."""
-    # Set roles deletes the sender key so we need to store the sender before calling it
+    """Send a reply to the email with the specified message ID.
+    before_send is called with the Message-ID of the reply right before it's sent.
+    With thread_id, older emails in long threads are summarized first (see context.build_context).
+    The summary and the reply share the --reply-timeout deadline.
+    """
+    # Started before the summary, so a long thread can't take more than --reply-timeout altogether
+    deadline = time.monotonic() + args.reply_timeout if args.reply_timeout else None
+
+    def time_left() -> float | None:
+        return max(deadline - time.monotonic(), 0) if deadline is not None else None
+
+    # The last email is always from the user, never the summary of the thread
     sender = thread[-1]["sender"]
-    thread = set_roles(thread)
-    if system_prompt:
-        thread.insert(0, {"role": "system", "content": system_prompt})
-    references_ids.append(message_id)
-    generated_response = assistant.run(messages=thread, stream=False)
-    logger.debug(f"Generated response: {generated_response}")
-    yag = yagmail.SMTP(
-        user={args.smtp_username: alias} if alias else args.smtp_username,
-        password=args.smtp_password,
-        host=args.smtp_host,
-        port=int(args.smtp_port),
+    # Copy the references so the ones stored in the thread aren't modified
+    references_ids = [*references_ids, message_id]
+    # The same question (like a resent email) gets the same answer without asking the LLM again.
+    # It's looked up before the thread is summarized, since that's a request to the LLM too
+    cache = response_cache.get_cache()
+    cache_key = (
+        response_cache.make_key(
+            (args.llm_provider, args.llm_base_url, args.llm_model),
+            system_prompt,
+            (*llm.tool_names(), args.show_tool_calls),
+            [
+                {
+                    "role": "assistant" if email["sender"] == args.bot_email else "user",
+                    "content": email["content"],
+                }
+                for email in thread
+            ],
+        )
+        if cache is not None
+        else None
     )
-    try:
-        yag.send(
+    generated_response = cache.get(cache_key) if cache is not None else None
+    if generated_response is not None:
+        logger.info(f"Using cached response for email {message_id} ({cache.stats()})")
+    else:
+        try:
+            if thread_id is not None:
+                # Older emails in long threads are replaced with a summary to stay within the budget
+                thread = context.build_context(
+                    thread_id,
+                    thread,
+                    args.context_token_budget,
+                    lambda previous_summary, emails: llm.summarize(
+                        previous_summary, emails, timeout=time_left()
+                    ),
+                )
+            # Set roles deletes the sender key, which is why the sender is stored first
+            thread = set_roles(thread)
+            if system_prompt:
+                thread.insert(0, {"role": "system", "content": system_prompt})
+            # generate takes one of the provider's slots itself
+            generated_response = llm.generate(assistant, thread, time_left())
+        except llm.GenerationTimeout:
+            # Without a fallback reply, the thread is tried again next cycle
+            if not args.timeout_reply:
+                raise
+            logger.warning(f"Timed out generating a reply to email {message_id}. Sending the fallback reply")
+            generated_response = args.timeout_reply
+        else:
+            if cache is not None and generated_response:
+                cache.set(cache_key, generated_response)
+    logger.debug("Generated response: {}", generated_response)
+    reply_message_id = make_msgid(domain=args.message_id_domain if args.message_id_domain else "llmail")
+    if before_send is not None:
+        before_send(reply_message_id)
+    # The SMTP connection is reused between replies
+    with metrics.stage_duration.time(stage="smtp_send"):
+        sending.get_mailer(alias).send(
             to=sender,
             subject=f"Re: {subject}" if not subject.startswith("Re: ") else subject,
             # subject=f"Re: {subject}",
             headers={"In-Reply-To": message_id, "References": " ".join(references_ids)},
             contents=generated_response,
-            message_id=make_msgid(
-                domain=args.message_id_domain if args.message_id_domain else "llmail"
-            ),
+            message_id=reply_message_id,
         )
-    except SSLError as e:
-        if "WRONG_VERSION_NUMBER" in str(e):
-            logger.info("SSL error occurred. Trying to connect with starttls=True instead.")
-            yag = yagmail.SMTP(
-                user={args.smtp_username: alias} if alias else args.smtp_username,
-                password=args.smtp_password,
-                host=args.smtp_host,
-                port=int(args.smtp_port),
-                smtp_starttls=True,
-                smtp_ssl=False,
-            )
-            yag.send(
-                to=sender,
-                subject=f"Re: {subject}" if not subject.startswith("Re: ") else subject,
-                # subject=f"Re: {subject}",
-                headers={"In-Reply-To": message_id, "References": " ".join(references_ids)},
-                contents=generated_response,
-                message_id=make_msgid(
-                    domain=args.message_id_domain if args.message_id_domain else "llmail"
-                ),
-            )
-        else:
-            raise e
     # thread_from_msg_id = get_thread_history(client, msg_id)
     # logger.debug(f"Thread history (message_identifier): {thread_from_msg_id}")
     # logger.debug(f"Thread history length (message_identifier): {len(thread_from_msg_id)}")
@@ -301,24 +692,29 @@ def send_reply(
     # logger.debug(f"Thread history (EmailThread object): {thread_from_object}")
     # logger.debug(f"Thread history length (EmailThread object): {len(thread_from_object)}")
     logger.info(f"Sending reply to email {message_id} to {sender}")
-    logger.debug(f"Thread history: {thread}")
-    logger.debug(f"Thread history length: {len(thread)}")
+    logger.debug("Thread history: {}", thread)
+    logger.debug("Thread history length: {}", len(thread))
 
 
 def set_roles(thread_history: list[dict]) -> list[dict]:
     """Change all email senders to roles (assistant or user)"""
     # Change email senders to roles
     for email in thread_history:
-        if email["sender"] == bot_email:
+        # Such as the summary of the earlier emails
+        if "sender" not in email:
+            continue
+        if email["sender"] == args.bot_email:
             email["role"] = "assistant"
         else:
             email["role"] = "user"
     # Delete the sender key
     for email in thread_history:
-        del email["sender"]
-    # Delete timestamp key
+        email.pop("sender", None)
+    # Delete timestamp and Message-ID keys
     for email in thread_history:
         if "timestamp" in email:
             del email["timestamp"]
+        if "message_id" in email:
+            del email["message_id"]
 
     return thread_history
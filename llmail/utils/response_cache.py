@@ -0,0 +1,106 @@
+import hashlib
+import json
+import re
+import threading
+import time
+
+from llmail.utils import logger
+from llmail.utils.cli_args import args
+from llmail.utils.state import StateStore, get_store
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS response_cache (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS response_cache_last_used ON response_cache (last_used);
+"""
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize(text: str | None) -> str:
+    """Collapse whitespace so emails that only differ in line breaks or spacing get the same key"""
+    return WHITESPACE_PATTERN.sub(" ", text or "").strip()
+
+
+def make_key(model: tuple, system_prompt: str | None, tools: tuple, messages: list[dict]) -> str:
+    """Hash everything that affects the response"""
+    data = {
+        "model": list(model),
+        "system_prompt": normalize(system_prompt),
+        "tools": list(tools),
+        "messages": [
+            [message.get("role"), normalize(message.get("content"))] for message in messages
+        ],
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+class ResponseCache:
+    """LLM responses saved in the state store, so the same prompt isn't sent to the LLM twice.
+    Entries expire after ttl seconds. If there are more than size entries, the least recently used are removed.
+    """
+
+    def __init__(self, store: StateStore, ttl: int, size: int):
+        self.store = store
+        self.ttl = ttl
+        self.size = max(size, 1)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.store.ensure_schema(SCHEMA)
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        rows = self.store.execute(
+            "SELECT response, created FROM response_cache WHERE key = ?", (key,)
+        )
+        if rows and now - rows[0][1] < self.ttl:
+            self.store.execute("UPDATE response_cache SET last_used = ? WHERE key = ?", (now, key))
+            with self._lock:
+                self.hits += 1
+            return rows[0][0]
+        if rows:
+            self.store.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key: str, response: str):
+        now = time.time()
+        self.store.execute(
+            "INSERT OR REPLACE INTO response_cache (key, response, created, last_used) VALUES (?, ?, ?, ?)",
+            (key, response, now, now),
+        )
+        self.store.execute("DELETE FROM response_cache WHERE created <= ?", (now - self.ttl,))
+        self.store.execute(
+            "DELETE FROM response_cache WHERE key NOT IN "
+            "(SELECT key FROM response_cache ORDER BY last_used DESC LIMIT ?)",
+            (self.size,),
+        )
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+_caches: dict[tuple, ResponseCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache() -> ResponseCache | None:
+    """Get the response cache, or None if it's disabled (--response-cache-ttl is 0)"""
+    if not args.response_cache_ttl:
+        return None
+    key = (args.state_file, args.response_cache_ttl, args.response_cache_size)
+    with _caches_lock:
+        if key not in _caches:
+            logger.debug(
+                f"Caching LLM responses for {args.response_cache_ttl} seconds (up to {args.response_cache_size})"
+            )
+            _caches[key] = ResponseCache(
+                get_store(), args.response_cache_ttl, args.response_cache_size
+            )
+        return _caches[key]
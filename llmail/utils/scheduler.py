@@ -0,0 +1,284 @@
+"""
+Serving several mailboxes from one process (--config).
+Each mailbox is checked on a shared pool of worker threads with its own settings (through
+cli_args.override), so it has its own IMAP connections, SMTP session, state file and threads.
+With --processes, the mailboxes are split between worker processes. A process only checks a mailbox
+while it holds the lease for it (kept in --state-file), so two processes never check the same mailbox.
+"""
+
+import json
+import math
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from llmail.utils import idle, jobs, llm, logger, metrics, responding
+from llmail.utils.cli_args import REQUIRED_ARGS, args, override
+from llmail.utils.state import StateStore, get_store
+
+# A lease that isn't renewed for this long is considered abandoned (such as by a crashed process)
+LEASE_SECONDS = 120
+# How often the scheduler checks which mailboxes are due and renews its leases
+TICK_SECONDS = 1
+# Used for mailboxes without --watch-interval or --idle
+DEFAULT_INTERVAL = 60
+# Settings that only make sense for the whole process
+PROCESS_ARGS = {
+    "config",
+    "mailbox_workers",
+    "processes",
+    "subcommand",
+    "log_level",
+    "log_format",
+    "redact_email_addresses",
+    "metrics_port",
+    "metrics_host",
+}
+
+LEASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS mailbox_leases (
+    mailbox TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+"""
+
+
+class MailboxConfig:
+    """A mailbox from the config file and the arguments it overrides"""
+
+    def __init__(self, name: str, settings: dict):
+        self.name = name
+        self.settings = settings
+        # Set when one of the mailbox's folders gets a new email (with IDLE)
+        self.new_mail = threading.Event()
+
+    def __repr__(self):
+        return f"MailboxConfig(name={self.name})"
+
+
+def load_config(path: str | Path) -> list[MailboxConfig]:
+    """Read the mailboxes from a JSON config file.
+
+    The file has a list of mailboxes and optionally defaults that apply to all of them:
+    {"defaults": {"llm_model": "..."}, "mailboxes": [{"name": "support", "imap_username": "...", ...}]}
+    Keys are the names of the command line options (with underscores or dashes).
+    Mailboxes without a state_file get their own next to --state-file.
+    """
+    with open(path) as file:
+        config = json.load(file)
+    known_args = args.names() - PROCESS_ARGS
+
+    def normalize(settings: dict, where: str) -> dict:
+        settings = {key.replace("-", "_"): value for key, value in settings.items()}
+        unknown = set(settings) - known_args - {"name"}
+        if unknown:
+            raise ValueError(f"Unknown settings in {where}: {', '.join(sorted(unknown))}")
+        return settings
+
+    defaults = normalize(config.get("defaults", {}), "defaults")
+    mailboxes = []
+    for number, entry in enumerate(config.get("mailboxes", []), start=1):
+        settings = {**defaults, **normalize(entry, f"mailbox {number}")}
+        name = str(settings.pop("name", None) or settings.get("imap_username") or number)
+        if any(mailbox.name == name for mailbox in mailboxes):
+            raise ValueError(f"There is more than one mailbox named {name}")
+        missing = [arg for arg in REQUIRED_ARGS if settings.get(arg, getattr(args, arg)) is None]
+        if missing:
+            raise ValueError(f"Mailbox {name} is missing {', '.join(missing)}")
+        if "state_file" not in settings:
+            state_file = Path(args.state_file)
+            settings["state_file"] = str(
+                state_file.with_name(f"{state_file.stem}-{name}{state_file.suffix}")
+            )
+        # Like with a single mailbox, the bot's address is the IMAP username
+        settings.setdefault("bot_email", settings.get("imap_username", args.imap_username))
+        mailboxes.append(MailboxConfig(name, settings))
+    if not mailboxes:
+        raise ValueError(f"No mailboxes in {path}")
+    return mailboxes
+
+
+class LeaseStore:
+    """Which process is checking which mailbox"""
+
+    def __init__(self, store: StateStore):
+        self.store = store
+        self.store.ensure_schema(LEASE_SCHEMA)
+
+    def acquire(self, mailbox: str, owner: str) -> bool:
+        """Take (or renew) the lease on the mailbox, unless another owner has it"""
+        now = time.time()
+        # A single statement, so it's atomic even with several processes using the file
+        self.store.execute(
+            "INSERT INTO mailbox_leases (mailbox, owner, expires) VALUES (?, ?, ?) "
+            "ON CONFLICT(mailbox) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+            "WHERE mailbox_leases.owner = excluded.owner OR mailbox_leases.expires < ?",
+            (mailbox, owner, now + LEASE_SECONDS, now),
+        )
+        rows = self.store.execute("SELECT owner FROM mailbox_leases WHERE mailbox = ?", (mailbox,))
+        return bool(rows) and rows[0][0] == owner
+
+    def renew(self, owner: str):
+        """Renew all the leases the owner holds"""
+        self.store.execute(
+            "UPDATE mailbox_leases SET expires = ? WHERE owner = ?", (time.time() + LEASE_SECONDS, owner)
+        )
+
+    def held(self, owner: str) -> set[str]:
+        rows = self.store.execute(
+            "SELECT mailbox FROM mailbox_leases WHERE owner = ? AND expires >= ?", (owner, time.time())
+        )
+        return {row[0] for row in rows}
+
+    def release(self, owner: str):
+        self.store.execute("DELETE FROM mailbox_leases WHERE owner = ?", (owner,))
+
+
+def check_mailbox(mailbox: MailboxConfig):
+    """Check a mailbox once with its settings. Runs on the shared worker pool"""
+    with override(mailbox.settings):
+        logger.debug(f"Checking mailbox {mailbox.name}")
+        responding.fetch_and_process_emails(
+            look_for_subject=args.subject_key,
+            alias=args.alias,
+            system_prompt=args.system_prompt,
+        )
+
+
+def start_watchers(mailbox: MailboxConfig) -> list[idle.FolderWatcher]:
+    """Start watching the mailbox's folders with IDLE (if it's enabled for the mailbox)"""
+    with override(mailbox.settings):
+        if not args.idle:
+            return []
+        poll_interval = args.watch_interval if args.watch_interval else idle.FALLBACK_POLL_INTERVAL
+        # The watchers copy the context, so they connect with the mailbox's account
+        watchers = [
+            idle.FolderWatcher(folder, mailbox.new_mail, poll_interval)
+            for folder in (args.folder if args.folder else ["INBOX"])
+        ]
+    for watcher in watchers:
+        watcher.start()
+    return watchers
+
+
+def interval(mailbox: MailboxConfig) -> float:
+    """Seconds between checks of the mailbox. IDLE mailboxes are checked when new_mail is set
+    or when a reply that was put off is ready
+    """
+    with override(mailbox.settings):
+        if args.idle:
+            ready = jobs.get_queue().next_ready()
+            return math.inf if ready is None else ready
+        return args.watch_interval if args.watch_interval else DEFAULT_INTERVAL
+
+
+def run(mailboxes: list[MailboxConfig], owner: str | None = None, max_mailboxes: int | None = None):
+    """Check the mailboxes forever, each on its own schedule, on a pool of --mailbox-workers threads.
+    Only mailboxes this owner has the lease for are checked, and at most max_mailboxes of them.
+    """
+    owner = owner or f"{socket.gethostname()}-{os.getpid()}"
+    leases = LeaseStore(get_store())
+    max_mailboxes = max_mailboxes or len(mailboxes)
+    for mailbox in mailboxes:
+        with override(mailbox.settings):
+            # Set up the LLM client and tools once instead of for every reply
+            llm.prepare()
+    next_check = {mailbox.name: 0.0 for mailbox in mailboxes}
+    running: dict[Future, MailboxConfig] = {}
+    watchers: dict[str, list[idle.FolderWatcher]] = {}
+    last_renewal = time.monotonic()
+    logger.info(f"Serving {len(mailboxes)} mailboxes as {owner}")
+    try:
+        with ThreadPoolExecutor(
+            max_workers=max(args.mailbox_workers, 1), thread_name_prefix="mailbox"
+        ) as executor:
+            while True:
+                now = time.monotonic()
+                if now - last_renewal > LEASE_SECONDS / 3:
+                    leases.renew(owner)
+                    last_renewal = now
+                held = leases.held(owner)
+                busy = {mailbox.name for mailbox in running.values()}
+                for mailbox in mailboxes:
+                    if mailbox.name in busy:
+                        continue
+                    if now < next_check[mailbox.name] and not mailbox.new_mail.is_set():
+                        continue
+                    if mailbox.name not in held and (
+                        len(held) >= max_mailboxes or not leases.acquire(mailbox.name, owner)
+                    ):
+                        # Another process has it, so try again later in case that process stops
+                        next_check[mailbox.name] = now + LEASE_SECONDS / 3
+                        continue
+                    held.add(mailbox.name)
+                    if mailbox.name not in watchers:
+                        watchers[mailbox.name] = start_watchers(mailbox)
+                    mailbox.new_mail.clear()
+                    running[executor.submit(check_mailbox, mailbox)] = mailbox
+                if not running:
+                    time.sleep(TICK_SECONDS)
+                    continue
+                done, _ = wait(running, timeout=TICK_SECONDS, return_when=FIRST_COMPLETED)
+                for future in done:
+                    mailbox = running.pop(future)
+                    next_check[mailbox.name] = time.monotonic() + interval(mailbox)
+                    try:
+                        future.result()
+                    except Exception:
+                        # One mailbox failing shouldn't stop the others
+                        logger.exception(f"Failed to check mailbox {mailbox.name}. Trying again later")
+    finally:
+        for mailbox_watchers in watchers.values():
+            for watcher in mailbox_watchers:
+                watcher.stop()
+        leases.release(owner)
+
+
+def run_worker(config_path: str, number: int, max_mailboxes: int):
+    """Entry point of a worker process"""
+    if args.metrics_port:
+        # Each process has its own metrics
+        metrics.serve(args.metrics_host, args.metrics_port + number)
+    run(
+        load_config(config_path),
+        owner=f"{socket.gethostname()}-{os.getpid()}-{number}",
+        max_mailboxes=max_mailboxes,
+    )
+
+
+def serve(config_path: str):
+    """Serve the mailboxes in the config file, in worker processes if --processes is more than 1"""
+    mailboxes = load_config(config_path)
+    if args.processes <= 1:
+        if args.metrics_port:
+            metrics.serve(args.metrics_host, args.metrics_port)
+        run(mailboxes)
+        return
+    # Each process takes its share of the mailboxes. If one stops, it's restarted and its
+    # leases run out so the mailboxes can be taken again
+    share = math.ceil(len(mailboxes) / args.processes)
+    # spawn instead of fork since there can already be threads (like loguru's)
+    context = multiprocessing.get_context("spawn")
+    processes = {}
+    logger.info(f"Serving {len(mailboxes)} mailboxes with {args.processes} processes")
+    try:
+        while True:
+            for number in range(args.processes):
+                process = processes.get(number)
+                if process is None or not process.is_alive():
+                    if process is not None:
+                        logger.warning(f"Worker process {number} stopped ({process.exitcode}). Restarting it")
+                    process = context.Process(
+                        target=run_worker, args=(config_path, number, share), name=f"worker-{number}"
+                    )
+                    process.start()
+                    processes[number] = process
+            time.sleep(LEASE_SECONDS / 3)
+    finally:
+        for process in processes.values():
+            process.terminate()
@@ -0,0 +1,187 @@
+import smtplib
+import socket
+import threading
+import time
+from ssl import SSLError
+from typing import TYPE_CHECKING
+
+from llmail.utils import logger
+from llmail.utils.cli_args import args
+
+if TYPE_CHECKING:
+    import yagmail
+
+# If the connection hasn't been used for this long, NOOP is sent to check that it's still alive
+KEEPALIVE_SECONDS = 30
+# Errors that mean the connection has to be re-established before trying again
+RECONNECT_ERRORS = (smtplib.SMTPServerDisconnected, socket.timeout, TimeoutError, ConnectionError)
+
+
+class NotSent(Exception):
+    """The connection failed before the server was given the email, so it definitely wasn't sent"""
+
+
+# Errors from send that mean the email wasn't sent. After any other error it might have been,
+# such as when the connection is lost after the email was handed over
+NOT_SENT_ERRORS = (NotSent, smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused)
+
+
+class Mailer:
+    """An SMTP session that is kept open between replies (and cycles).
+    Whether the server wants implicit TLS or STARTTLS is figured out once and then remembered.
+    """
+
+    def __init__(self, username: str, password: str, host: str, port: int, alias: str = None):
+        self.username = username
+        self.password = password
+        self.host = host
+        self.port = port
+        self.alias = alias
+        # None until the first connection figures out which one works
+        self.starttls: bool | None = None
+        self._yag: "yagmail.SMTP | None" = None
+        self._last_used = 0.0
+        # smtplib connections aren't thread-safe
+        self._lock = threading.Lock()
+
+    def _make_yag(self, starttls: bool) -> "yagmail.SMTP":
+        # yagmail is only imported once a reply is sent
+        import yagmail
+
+        yag = yagmail.SMTP(
+            user={self.username: self.alias} if self.alias else self.username,
+            password=self.password,
+            host=self.host,
+            port=self.port,
+            # The defaults are implicit TLS (smtp_ssl=True)
+            **({"smtp_starttls": True, "smtp_ssl": False} if starttls else {}),
+        )
+        yag.login()
+        return yag
+
+    def _connect(self):
+        if self.starttls is None:
+            try:
+                self._yag = self._make_yag(starttls=False)
+                self.starttls = False
+            except SSLError as e:
+                if "WRONG_VERSION_NUMBER" not in str(e):
+                    raise e
+                logger.info("SSL error occurred. Trying to connect with starttls=True instead.")
+                self._yag = self._make_yag(starttls=True)
+                self.starttls = True
+        else:
+            self._yag = self._make_yag(starttls=self.starttls)
+        logger.debug(f"Connected to {self.host} (STARTTLS: {self.starttls})")
+
+    def _ensure_connected(self):
+        if self._yag is not None and not self._yag.is_closed:
+            if time.monotonic() - self._last_used < KEEPALIVE_SECONDS:
+                return
+            try:
+                status, _ = self._yag.smtp.noop()
+                if status == 250:
+                    return
+            except RECONNECT_ERRORS + (smtplib.SMTPException, OSError):
+                pass
+            logger.debug("SMTP connection was closed. Reconnecting...")
+            self.disconnect()
+        self._connect()
+
+    def send(self, **kwargs):
+        """Send an email. Takes the same arguments as yagmail.SMTP.send.
+        Errors in NOT_SENT_ERRORS mean the email wasn't sent. It's only tried again on a new connection
+        when that's certain, so an email is never sent twice
+        """
+        with self._lock:
+            # Try once more on a new connection if the server dropped this one
+            for attempt in range(2):
+                try:
+                    self._ensure_connected()
+                    recipients, msg_string = self._yag.prepare_send(**kwargs)
+                except NOT_SENT_ERRORS:
+                    # Kept as they are so SMTP replies (like a 4xx for a sending limit) can be told apart
+                    raise
+                except Exception as e:
+                    # Nothing was given to the server yet, whatever went wrong (DNS, TLS, the network...)
+                    raise NotSent(f"Couldn't connect to {self.host} ({e!r})") from e
+                try:
+                    result = self._deliver(recipients, msg_string)
+                    self._last_used = time.monotonic()
+                    return result
+                except smtplib.SMTPResponseException as e:
+                    # 421 means the server is closing the connection
+                    if e.smtp_code != 421 or attempt == 1:
+                        raise e
+                    logger.info(f"SMTP server closed the connection ({e.smtp_error}). Reconnecting...")
+                except NotSent as e:
+                    if attempt == 1:
+                        raise e
+                    logger.info(f"{e}. Reconnecting...")
+                except RECONNECT_ERRORS:
+                    # Lost while the email was being handed over, so it might have been sent
+                    self.disconnect()
+                    raise
+                self.disconnect()
+
+    def _deliver(self, recipients: list[str], msg_string: str) -> dict:
+        """smtplib's sendmail in steps, so a connection lost before DATA (NotSent) can be told apart
+        from one lost during it (raised as it is since the email might have been sent)
+        """
+        smtp = self._yag.smtp
+        try:
+            smtp.ehlo_or_helo_if_needed()
+            code, response = smtp.mail(self._yag.user)
+            if code != 250:
+                self._reset(code)
+                raise smtplib.SMTPSenderRefused(code, response, self._yag.user)
+            refused = {}
+            for recipient in recipients:
+                code, response = smtp.rcpt(recipient)
+                if code not in (250, 251):
+                    refused[recipient] = (code, response)
+            if len(refused) == len(recipients):
+                self._reset(code)
+                raise smtplib.SMTPRecipientsRefused(refused)
+        except (smtplib.SMTPServerDisconnected, OSError) as e:
+            # socket.timeout, TimeoutError, ConnectionError and SSL errors are all OSErrors
+            raise NotSent(f"Lost the SMTP connection ({e})") from e
+        code, response = smtp.data(msg_string)
+        if code != 250:
+            self._reset(code)
+            raise smtplib.SMTPDataError(code, response)
+        return refused
+
+    def _reset(self, code: int):
+        """Get ready for the next email after the server refused one (like sendmail does)"""
+        if code == 421:
+            self._yag.smtp.close()
+            return
+        try:
+            self._yag.smtp.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    def disconnect(self):
+        if self._yag is not None:
+            self._yag.close()
+        self._yag = None
+
+
+_mailers: dict[tuple, Mailer] = {}
+_mailers_lock = threading.Lock()
+
+
+def get_mailer(alias: str = None) -> Mailer:
+    """Get the (shared) mailer for the configured SMTP account"""
+    key = (args.smtp_host, args.smtp_port, args.smtp_username, alias)
+    with _mailers_lock:
+        if key not in _mailers:
+            _mailers[key] = Mailer(
+                username=args.smtp_username,
+                password=args.smtp_password,
+                host=args.smtp_host,
+                port=int(args.smtp_port),
+                alias=alias,
+            )
+        return _mailers[key]
@@ -0,0 +1,104 @@
+import sqlite3
+import threading
+from pathlib import Path
+
+from llmail.utils.cli_args import args
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS folder_state (
+    folder TEXT PRIMARY KEY,
+    uidvalidity INTEGER,
+    last_uid INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS folder_status (
+    folder TEXT PRIMARY KEY,
+    uidvalidity INTEGER,
+    uidnext INTEGER,
+    messages INTEGER,
+    highestmodseq INTEGER
+);
+"""
+STATUS_ITEMS = ("UIDVALIDITY", "UIDNEXT", "MESSAGES", "HIGHESTMODSEQ")
+
+
+class StateStore:
+    """Small SQLite database for state that should survive restarts (like the last UID seen in each folder)"""
+
+    def __init__(self, path: str | Path):
+        self.path = str(path)
+        if self.path != ":memory:":
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        # The connection is shared between threads, so access to it is serialized with a lock
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self.ensure_schema(SCHEMA)
+
+    def ensure_schema(self, schema: str):
+        """Create tables (and indexes) if they don't already exist"""
+        with self._lock, self._connection:
+            self._connection.executescript(schema)
+
+    def add_column(self, table: str, column: str, definition: str):
+        """Add a column to a table that was created by an older version, if it doesn't have it"""
+        with self._lock, self._connection:
+            columns = {row[1] for row in self._connection.execute(f"PRAGMA table_info({table})")}
+            if column not in columns:
+                self._connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def execute(self, query: str, parameters: tuple | dict = ()) -> list[tuple]:
+        """Run a single statement in its own transaction and return all resulting rows"""
+        with self._lock, self._connection:
+            return self._connection.execute(query, parameters).fetchall()
+
+    def executemany(self, query: str, parameters: list[tuple | dict]):
+        """Run a statement once for every set of parameters in a single transaction"""
+        with self._lock, self._connection:
+            self._connection.executemany(query, parameters)
+
+    def get_folder_state(self, folder: str) -> tuple[int | None, int]:
+        """Return the UIDVALIDITY and the last seen UID for the folder. (None, 0) if the folder hasn't been synced"""
+        rows = self.execute(
+            "SELECT uidvalidity, last_uid FROM folder_state WHERE folder = ?", (folder,)
+        )
+        return rows[0] if rows else (None, 0)
+
+    def set_folder_state(self, folder: str, uidvalidity: int, last_uid: int):
+        """Record the UIDVALIDITY and the highest UID that has been processed for the folder"""
+        self.execute(
+            "INSERT INTO folder_state (folder, uidvalidity, last_uid) VALUES (?, ?, ?) "
+            "ON CONFLICT(folder) DO UPDATE SET uidvalidity = excluded.uidvalidity, last_uid = excluded.last_uid",
+            (folder, uidvalidity, last_uid),
+        )
+
+    def get_folder_status(self, folder: str) -> dict[str, int] | None:
+        """Return the STATUS values the folder had when it was last scanned. None if they weren't recorded"""
+        rows = self.execute(
+            f"SELECT {', '.join(STATUS_ITEMS)} FROM folder_status WHERE folder = ?", (folder,)
+        )
+        if not rows:
+            return None
+        return {item: value for item, value in zip(STATUS_ITEMS, rows[0]) if value is not None}
+
+    def set_folder_status(self, folder: str, status: dict[str, int]):
+        """Record the STATUS values (UIDVALIDITY, UIDNEXT, MESSAGES and HIGHESTMODSEQ) of a scanned folder"""
+        self.execute(
+            f"INSERT OR REPLACE INTO folder_status (folder, {', '.join(STATUS_ITEMS)}) VALUES (?, ?, ?, ?, ?)",
+            (folder, *(status.get(item) for item in STATUS_ITEMS)),
+        )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+_stores: dict[str, StateStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(path: str | Path | None = None) -> StateStore:
+    """Get the (shared) state store for the path, defaulting to --state-file"""
+    path = str(path if path is not None else args.state_file)
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = StateStore(path)
+        return _stores[path]
@@ -0,0 +1,132 @@
+from email import message_from_bytes
+from email.message import Message
+from enum import Enum
+
+from imapclient import IMAPClient
+
+from llmail.utils import logger
+from llmail.utils.cli_args import args
+from llmail.utils.message_index import get_index
+from llmail.utils.tracking import get_top_level_email
+from llmail.utils.utils import fetch_in_batches
+
+GMAIL_THREAD_PREFIX = "X-GM-THRID:"
+
+
+class Backend(str, Enum):
+    """Ways of finding out which thread an email is in, from best to worst"""
+
+    GMAIL = "gmail"  # X-GM-THRID is fetched alongside the headers
+    THREAD_REFERENCES = "thread"  # One THREAD=REFERENCES command per folder
+    HEADERS = "headers"  # The first entry in the References header
+
+
+def get_backend(client: IMAPClient) -> Backend:
+    """Pick the best threading backend the server supports (IMAPClient caches the capabilities)"""
+    if client.has_capability("X-GM-EXT-1"):
+        return Backend.GMAIL
+    if client.has_capability("THREAD=REFERENCES"):
+        return Backend.THREAD_REFERENCES
+    return Backend.HEADERS
+
+
+def fetch_items(backend: Backend) -> list[str]:
+    """Extra FETCH data items the backend needs"""
+    return ["X-GM-THRID"] if backend == Backend.GMAIL else []
+
+
+def get_thread_keys(
+    client: IMAPClient,
+    folder: str,
+    backend: Backend,
+    emails: dict[int, tuple[Message, str, dict]],
+    criteria: list,
+) -> dict[int, str]:
+    """Return the key of the thread each email is in.
+
+    emails maps UIDs to (headers, Message-ID, FETCH data). criteria is the SEARCH criteria for the
+    emails that can be part of threads, which THREAD=REFERENCES uses to thread the whole folder at once.
+    """
+    if not emails:
+        return {}
+    match backend:
+        case Backend.GMAIL:
+            keys = {}
+            for msg_id, (message, message_id, data) in emails.items():
+                thread_id = data.get(b"X-GM-THRID")
+                keys[msg_id] = (
+                    f"{GMAIL_THREAD_PREFIX}{thread_id}"
+                    if thread_id is not None
+                    else get_top_level_email(message, message_id)
+                )
+            return keys
+        case Backend.THREAD_REFERENCES:
+            return get_thread_keys_from_thread_command(client, folder, emails, criteria)
+        case Backend.HEADERS:
+            return {
+                msg_id: get_top_level_email(message, message_id)
+                for msg_id, (message, message_id, _) in emails.items()
+            }
+        case _:
+            raise ValueError(f"Unknown threading backend {backend}")
+
+
+def get_thread_keys_from_thread_command(
+    client: IMAPClient, folder: str, emails: dict[int, tuple[Message, str, dict]], criteria: list
+) -> dict[int, str]:
+    """Group the emails with a single THREAD=REFERENCES command.
+    The key is the top-level email of the root of the server's thread, so emails with trimmed
+    References still end up in the right thread.
+    """
+    root_of = {}
+    for thread in client.thread("REFERENCES", criteria):
+        msg_ids = flatten_thread(thread)
+        for msg_id in msg_ids:
+            # If the real root is missing, the first email that is there is used
+            root_of[msg_id] = msg_ids[0]
+
+    root_keys = {}
+    index = get_index()
+    missing_roots = []
+    for root in {root_of.get(msg_id, msg_id) for msg_id in emails}:
+        if root in emails:
+            message, message_id, _ = emails[root]
+            root_keys[root] = get_top_level_email(message, message_id)
+        elif (thread_key := index.get_thread_key(folder, root)) is not None:
+            root_keys[root] = thread_key
+        else:
+            missing_roots.append(root)
+    # Roots that were seen before the index existed
+    for root, data in fetch_in_batches(
+        client, missing_roots, ["RFC822.HEADER"], args.fetch_batch_size
+    ):
+        message = message_from_bytes(data[b"RFC822.HEADER"])
+        root_keys[root] = get_top_level_email(message, message.get("Message-ID") or root)
+
+    keys = {}
+    for msg_id, (message, message_id, _) in emails.items():
+        root = root_of.get(msg_id, msg_id)
+        keys[msg_id] = root_keys.get(root) or get_top_level_email(message, message_id)
+    logger.opt(lazy=True).debug(
+        "Grouped {} emails into {} threads with THREAD", lambda: len(emails), lambda: len(set(keys.values()))
+    )
+    return keys
+
+
+def flatten_thread(thread: tuple) -> list[int]:
+    """Turn a thread from a THREAD response (nested tuples of UIDs) into a list of UIDs, root first"""
+    msg_ids = []
+    for item in thread:
+        if isinstance(item, tuple):
+            msg_ids.extend(flatten_thread(item))
+        else:
+            msg_ids.append(item)
+    return msg_ids
+
+
+def search_criteria(thread_key: str) -> list:
+    """SEARCH criteria for the emails in a thread"""
+    if thread_key.startswith(GMAIL_THREAD_PREFIX):
+        return ["X-GM-THRID", int(thread_key.removeprefix(GMAIL_THREAD_PREFIX))]
+    # The top-level email or any email that references it
+    return ["OR", "HEADER", "Message-ID", thread_key, "HEADER", "References", thread_key]
@@ -0,0 +1,111 @@
+"""
+Caching the results of the assistant's tools (web pages, searches) between conversations.
+Several people often ask about the same page or topic, so each result is kept for a while (depending on
+the tool). If the same call is already running in another conversation, it waits for that one instead
+of making the request again.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Callable
+
+from llmail.utils import logger
+from llmail.utils.toolkits import wrap_toolkit
+
+if TYPE_CHECKING:
+    from phi.tools.toolkit import Toolkit
+
+# How long (in seconds) to keep results for each toolkit. Searches go out of date faster than pages
+TOOL_TTLS = {
+    "WebsiteTools": 60 * 60,
+    "DuckDuckGo": 15 * 60,
+    "ExaTools": 60 * 60,
+}
+DEFAULT_TTL = 15 * 60
+
+
+class _Call:
+    """A call that is running, which other threads with the same arguments can wait for"""
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+
+
+class ToolCache:
+    """Bounded LRU cache of tool results with a TTL per entry and request coalescing"""
+
+    def __init__(self, size: int):
+        self.size = max(size, 1)
+        self.hits = 0
+        self.misses = 0
+        self._results: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._running: dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+    def get_or_call(self, key: str, ttl: float, call: Callable[[], Any]) -> Any:
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                self._results.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            running = self._running.get(key)
+            if running is None:
+                running = self._running[key] = _Call()
+                owner = True
+                self.misses += 1
+            else:
+                owner = False
+                self.hits += 1
+        if not owner:
+            running.done.wait()
+            if running.error is not None:
+                raise running.error
+            return running.result
+
+        try:
+            running.result = call()
+        except BaseException as e:
+            # Errors aren't cached, but everyone waiting for this call gets it
+            running.error = e
+            raise
+        else:
+            with self._lock:
+                self._results[key] = (time.monotonic() + ttl, running.result)
+                self._results.move_to_end(key)
+                while len(self._results) > self.size:
+                    self._results.popitem(last=False)
+            return running.result
+        finally:
+            with self._lock:
+                del self._running[key]
+            running.done.set()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._results)}
+
+
+def cache_function(entrypoint: Callable, name: str, ttl: float, cache: ToolCache) -> Callable:
+    """Wrap a tool function so its results are cached by its arguments"""
+
+    def cached(*call_args, **kwargs):
+        key = json.dumps([name, call_args, kwargs], sort_keys=True, default=str)
+        logger.debug("Calling {} through the tool cache", name)
+        return cache.get_or_call(key, ttl, lambda: entrypoint(*call_args, **kwargs))
+
+    return cached
+
+
+def cache_toolkit(toolkit: "Toolkit", cache: ToolCache) -> "Toolkit":
+    """Make every function of the toolkit go through the cache. The toolkit is changed in place"""
+    ttl = TOOL_TTLS.get(type(toolkit).__name__, DEFAULT_TTL)
+    return wrap_toolkit(
+        toolkit, lambda entrypoint, name: cache_function(entrypoint, name, ttl, cache), "is_cached"
+    )
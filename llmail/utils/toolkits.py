@@ -0,0 +1,21 @@
+import functools
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from phi.tools.toolkit import Toolkit
+
+
+def wrap_toolkit(toolkit: "Toolkit", wrap: Callable[[Callable, str], Callable], marker: str) -> "Toolkit":
+    """Replace every function of the toolkit with wrap(function, "Toolkit.function").
+    marker is set on the wrappers so wrapping the same toolkit again does nothing. The toolkit is changed in place
+    """
+    toolkit_name = type(toolkit).__name__
+    for name, function in toolkit.functions.items():
+        entrypoint = function.entrypoint
+        if entrypoint is None or getattr(entrypoint, marker, False):
+            continue
+        # functools.wraps keeps the signature and docstring, which phidata uses to describe the tool
+        wrapped = functools.wraps(entrypoint)(wrap(entrypoint, f"{toolkit_name}.{name}"))
+        setattr(wrapped, marker, True)
+        function.entrypoint = wrapped
+    return toolkit
@@ -1,3 +1,4 @@
+import bisect
 import imaplib
 from email import message_from_bytes
 from email.message import Message
@@ -7,8 +8,10 @@ from email.utils import getaddresses, parsedate_to_datetime
 
 from imapclient import IMAPClient
 
-from llmail.utils.cli_args import args, bot_email
-from llmail.utils import logger
+from llmail.utils.cli_args import args
+from llmail.utils import jwz, logger
+from llmail.utils.connection import list_folder_names
+from llmail.utils.message_index import get_index
 from llmail.utils.utils import get_plain_email_content, make_tz_aware
 
 
@@ -16,38 +19,90 @@ class EmailThread:
     def __init__(self, initial_email):
         self.initial_email = initial_email
         self.replies = []
+        # Message-IDs of every email in the thread so checking for duplicates doesn't go through the replies
+        self.message_ids = {initial_email.message_id}
+        self._tree = None
 
     def add_reply(self, reply_email):
         # If the message_id of the reply email is not in the list of messages add it
         # Also, don't do it if the email is the inital/top-level email itself
-        if (
-            reply_email.message_id not in [email.message_id for email in self.replies]
-            and reply_email.message_id != self.initial_email.message_id
-        ):
+        if reply_email.message_id not in self.message_ids:
             logger.debug(
-                f"Reply sent by {reply_email.sender} at {reply_email.timestamp} does not exist in thread. Adding it to thread for email {self.initial_email.message_id}"
+                "Reply sent by {} at {} does not exist in thread. Adding it to thread for email {}",
+                reply_email.sender,
+                reply_email.timestamp,
+                self.initial_email.message_id,
             )
-            self.replies.append(reply_email)
-            self.sort_replies()
+            self.message_ids.add(reply_email.message_id)
+            # The replies are already sorted so it only has to be inserted in the right place
+            bisect.insort(self.replies, reply_email, key=lambda x: x.timestamp)
+            # The tree has to be rebuilt with the new email
+            self._tree = None
         else:
-            logger.debug(f"Reply email {reply_email} already exists in thread")
+            logger.debug("Reply email {} already exists in thread", reply_email)
 
     @property
     def user_replies(self):
         """Return the replies that are from the user"""
-        return [reply for reply in self.replies if reply.sender != bot_email]
+        return [reply for reply in self.replies if reply.sender != args.bot_email]
 
     def sort_replies(self):
+        # add_reply keeps the replies sorted, so this is only needed if replies is changed directly
         self.replies = sorted(self.replies, key=lambda x: x.timestamp)
-        # Honestly, it might be better to sort by the message_id. This also goes for the get_thread_history function
-        # However, this **significantly** reduces complexity so for now, it's fine
+
+    @property
+    def emails(self):
+        return [self.initial_email, *self.replies]
+
+    @property
+    def tree(self) -> dict[str, jwz.Container]:
+        """Parent/child tree of the emails in the thread (built when it's needed)"""
+        if self._tree is None:
+            self._tree = jwz.build_tree(self.emails)
+        return self._tree
+
+    def latest_user_email(self):
+        """Return the newest email that isn't from the bot"""
+        user_emails = [email for email in self.emails if email.sender != args.bot_email]
+        return max(user_emails, key=lambda x: x.timestamp) if user_emails else None
+
+    def is_answered(self, email) -> bool:
+        """Check if the bot has replied to the email"""
+        container = self.tree.get(str(email.message_id))
+        return container is not None and any(
+            child.email is not None and child.email.sender == args.bot_email
+            for child in container.children
+        )
+
+    def branch(self, email=None) -> list:
+        """Return the emails leading to the email (the newest user email by default), oldest first.
+        Emails on other branches of the conversation (such as forks) aren't included.
+        """
+        email = email if email is not None else self.latest_user_email()
+        if email is None:
+            return []
+        return jwz.branch(self.tree, email.message_id)
 
     def __repr__(self):
         return f"EmailThread(initial_email={self.initial_email}, replies={self.replies})"
 
 
 class Email:
-    def __init__(self, imap_id, message_id, subject, sender, timestamp, body, references):
+    # Threads can have hundreds of emails and there can be thousands of threads, so no __dict__
+    __slots__ = (
+        "imap_id",
+        "message_id",
+        "subject",
+        "sender",
+        "timestamp",
+        "body",
+        "references",
+        "in_reply_to",
+    )
+
+    def __init__(
+        self, imap_id, message_id, subject, sender, timestamp, body, references, in_reply_to=None
+    ):
         self.imap_id = imap_id
         self.message_id = message_id
         self.subject = subject
@@ -55,6 +110,7 @@ class Email:
         self.timestamp = timestamp
         self.body = body
         self.references = references
+        self.in_reply_to = in_reply_to
 
     def __repr__(self):
         # return f"Email(imap_id={self.imap_id}, message_id={self.message_id}, subject={self.subject}, sender={self.sender}, timestamp={self.timestamp})"
@@ -74,7 +130,7 @@ def is_uid_user_email(client, msg_id, sender):
     headers = message_from_bytes(headers_bytes)
     timestamp = headers.get("Date")
     logger.debug(
-        f"Checking if email with UID {msg_id} from {sender} sent on {timestamp} is most recent user email"
+        "Checking if email with UID {} from {} sent on {} is most recent user email", msg_id, sender, timestamp
     )
     return sender != args.imap_username
 
@@ -85,44 +141,41 @@ def get_thread_history(
     """Fetch the entire thread history for the specified message ID."""
     # Might be better to use "is"
     if isinstance(message_identifier, EmailThread):
+        # Only the branch of the conversation that leads to the newest user email, in reply order
         thread_history = []
-        thread_history.append(
-            {
-                "sender": message_identifier.initial_email.sender,
-                "content": message_identifier.initial_email.body,
-            }
-        )
-        for email in message_identifier.replies:
+        for email in message_identifier.branch():
             thread_history.append(
                 {
                     "sender": email.sender,
                     "content": email.body,
                     "timestamp": email.timestamp,
+                    # Used to tell which emails a summary of the thread covers
+                    "message_id": email.message_id,
                 }
             )
         return thread_history
     elif isinstance(message_identifier, int) or isinstance(message_identifier, str):
         client.select_folder("INBOX")
+        thread_history = []
         if isinstance(message_identifier, str):
             message_id = message_identifier
+            # This leaves the folder the email is in selected
             msg_id = get_uid_from_message_id(client, message_id)
-            logger.debug(
-                f"Getting thread history from Message-ID {message_id} with IMAP UID {msg_id}"
-            )
+            logger.debug("Getting thread history from Message-ID {} with IMAP UID {}", message_id, msg_id)
+            msg_data = client.fetch([msg_id], ["RFC822"])
         else:
             msg_id = message_identifier
-            logger.debug(f"Getting thread history from IMAP UID {msg_id}")
-        thread_history = []
-        for folder in client.list_folders():
-            try:
-                client.select_folder(folder[2])
-            # If the error is imaplib.IMAP4.error: select failed:...
-            except imaplib.IMAP4.error:
-                logger.debug(f"Failed to select folder {folder[2]}. Skipping...")
-                continue
-            msg_data = client.fetch([msg_id], ["RFC822"])
-            if msg_data:
-                break
+            logger.debug("Getting thread history from IMAP UID {}", msg_id)
+            for folder in list_folder_names(client):
+                try:
+                    client.select_folder(folder)
+                # If the error is imaplib.IMAP4.error: select failed:...
+                except imaplib.IMAP4.error:
+                    logger.debug(f"Failed to select folder {folder}. Skipping...")
+                    continue
+                msg_data = client.fetch([msg_id], ["RFC822"])
+                if msg_data:
+                    break
         raw_message = msg_data[msg_id][b"RFC822"]
         message = message_from_bytes(raw_message)
         thread_history.append(
@@ -136,20 +189,23 @@ def get_thread_history(
         # Fetch previous emails in the thread if available
         while message.get("In-Reply-To"):
             prev_message_id = message.get("In-Reply-To")
+            # Uses the local index, so this is usually not a search through every folder
             prev_msg_id = get_uid_from_message_id(client, prev_message_id)
+            if prev_msg_id is None:
+                break
             prev_msg_data = client.fetch([prev_msg_id], ["RFC822"])
             prev_raw_message = prev_msg_data[prev_msg_id][b"RFC822"]
             prev_message = message_from_bytes(prev_raw_message)
             thread_history.append(
                 {
-                    "sender": get_sender(message)["email"],
-                    "content": get_plain_email_content(message),
-                    "timestamp": make_tz_aware(parsedate_to_datetime(message.get("Date"))),
+                    "sender": get_sender(prev_message)["email"],
+                    "content": get_plain_email_content(prev_message),
+                    "timestamp": make_tz_aware(parsedate_to_datetime(prev_message.get("Date"))),
                 }
             )
             message = prev_message
-        # Sort the thread history by timestamp
-        thread_history = sorted(thread_history, key=lambda x: x["timestamp"])
+        # The In-Reply-To chain was followed from the newest email, so reversing it puts it in reply order
+        thread_history.reverse()
         return thread_history
     else:
         raise TypeError("Invalid type for message. Must be an int, str, or EmailThread object.")
@@ -162,18 +218,10 @@ def get_sender(message: Message) -> dict:
     return {"name": sender_name, "email": sender_email}
 
 
-def get_top_level_email(client, msg_id, message_id=None):
-    """Get the top-level email in the thread for the specified message ID (IMAP)"""
-    message_id = msg_id if message_id is None else message_id
-    msg_data = client.fetch([msg_id], ["RFC822.HEADER"])
-    headers_bytes = msg_data[msg_id][b"RFC822.HEADER"]
-
-    # Parse the headers using the email library
-    msg = message_from_bytes(headers_bytes)
-    headers = dict(msg.items())
-
+def get_top_level_email(message: Message, message_id: str) -> str:
+    """Get the top-level email in the thread from the (already fetched) headers of an email"""
     # Extract the References header and split it into individual message IDs
-    references_header = headers.get("References", "")
+    references_header = message.get("References", "")
     references_ids = [m_id.strip() for m_id in references_header.split() if m_id.strip()]
 
     # Extract the first message ID, which represents the top-level email in the thread
@@ -183,37 +231,59 @@ def get_top_level_email(client, msg_id, message_id=None):
 
 
 def is_newer_reference(client, message_id) -> bool:
-    """Do a search through all folders to see if any message references message_id. If so, return True."""
-    for folder in client.list_folders():
+    """Check if any message references message_id. If so, return True.
+    The local index is checked first. Only emails it doesn't know about need a search through all folders.
+    """
+    index = get_index()
+    if index.has_reply(message_id):
+        return True
+    # The index has every email with the subject that was seen, including replies to it
+    if index.is_known(message_id):
+        logger.debug("No newer references found for email {}", message_id)
+        return False
+    for folder in list_folder_names(client):
         try:
-            client.select_folder(folder[2])
+            client.select_folder(folder)
         # If the error is imaplib.IMAP4.error: select failed:...
         except imaplib.IMAP4.error:
-            logger.debug(f"Failed to select folder {folder[2]}. Skipping...")
+            logger.debug(f"Failed to select folder {folder}. Skipping...")
             continue
         search_result = client.search(["HEADER", "In-Reply-To", message_id])
         if search_result:
             return True
-    logger.debug(f"No newer references found for email {message_id}")
+    logger.debug("No newer references found for email {}", message_id)
     return False
 
 
 def get_uid_from_message_id(imap_client, message_id):
-    """Get the UID of a message using its Message-ID."""
+    """Get the UID of a message using its Message-ID. The folder it's in is left selected."""
+    index = get_index()
+    for folder, uid in index.locate(message_id):
+        try:
+            imap_client.select_folder(folder)
+        except imaplib.IMAP4.error:
+            logger.debug(f"Failed to select folder {folder}. Skipping...")
+            continue
+        logger.debug("UID of message with Message-ID {} is {} (from the index)", message_id, uid)
+        return uid
     # In some cases, it might not be in Inbox
     # For example, for me, I think when the bot sends an email it was in [Gmail]/All Mail
-    for folder in imap_client.list_folders():
+    for folder in list_folder_names(imap_client):
         try:
-            imap_client.select_folder(folder[2])
+            imap_client.select_folder(folder)
         # If the error is imaplib.IMAP4.error: select failed:...
         except imaplib.IMAP4.error:
-            logger.debug(f"Failed to select folder {folder[2]}. Skipping...")
+            logger.debug(f"Failed to select folder {folder}. Skipping...")
             continue
         search_result = imap_client.search(["HEADER", "Message-ID", message_id])
         if search_result:
             uid = search_result[0]  # Assuming search_result is a list of UIDs
+            msg_data = imap_client.fetch([uid], ["ENVELOPE", "RFC822.HEADER"])[uid]
+            message = message_from_bytes(msg_data[b"RFC822.HEADER"])
+            # Remember where it is for next time
+            index.add(folder, uid, message, get_sender(message)["email"])
             logger.info(
-                f"UID of message with Message-ID {message_id} is {uid}. Email subject: {imap_client.fetch([uid], ['ENVELOPE'])[uid][b'ENVELOPE'].subject}"
+                f"UID of message with Message-ID {message_id} is {uid}. Email subject: {msg_data[b'ENVELOPE'].subject}"
             )
             return uid
     logger.warning(
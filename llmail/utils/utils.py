@@ -1,7 +1,10 @@
+import re
 from datetime import timezone
 from email.message import Message
+from typing import Iterator
 
 import html2text
+from imapclient import IMAPClient
 
 from llmail.utils import logger
 
@@ -12,32 +15,132 @@ def make_tz_aware(timestamp):
     return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt
 
 
+def fetch_in_batches(
+    client: IMAPClient, msg_ids: list[int], data: list[str], batch_size: int = 100
+) -> Iterator[tuple[int, dict]]:
+    """Fetch the data items for the UIDs with one FETCH command per batch of batch_size UIDs.
+    Yields (UID, data) pairs. UIDs that no longer exist (such as deleted emails) are skipped.
+    """
+    batch_size = max(batch_size, 1)
+    for i in range(0, len(msg_ids), batch_size):
+        batch = msg_ids[i : i + batch_size]
+        response = client.fetch(batch, data)
+        for msg_id in batch:
+            if msg_id in response:
+                yield msg_id, response[msg_id]
+
+
 def get_plain_email_content(message: Message | str) -> str:
     """Get the content of the email message. If a  message object is provided, it will be parsed
     Otherwise, it is assumed that the content is already a string and will be converted to markdown.
     """
     if isinstance(message, str):
-        return html2text.html2text(message)
-    else:
-        if message.is_multipart():
-            for part in message.walk():
-                content_type = part.get_content_type()
-                try:
-                    body = part.get_payload(decode=True)
-                except UnicodeDecodeError:
-                    logger.debug("UnicodeDecodeError occurred. Trying to get payload as string.")
-                    body = str(part.get_payload())
-                if content_type == "text/plain":
-                    markdown = html2text.html2text(str(body.decode("unicode_escape"))).strip()
-                    # logger.debug(f"Converted to markdown: {markdown}")
-                    # if len(markdown) < 5:
-                    #     logger.warning(
-                    #         f"Content is less than 5 characters | Content: {markdown}"
-                    #     )
-                    return markdown
-        else:
-            logger.debug("Message is not multipart. Getting payload as string.")
-            body = message.get_payload(decode=True).decode()
-            # if len(body) < 5:
-            #     logger.warning(f"Content is less than 5 characters | Content: {body}")
-            return html2text.html2text(str(body.decode("unicode_escape")))
+        return clean_text(message, "text/html")
+    part = get_text_part(message)
+    if part is None:
+        logger.debug("Message has no text part")
+        return ""
+    try:
+        body = part.get_payload(decode=True) or b""
+    except UnicodeDecodeError:
+        logger.debug("UnicodeDecodeError occurred. Trying to get payload as string.")
+        return clean_text(str(part.get_payload()), part.get_content_type())
+    return clean_text(decode_text(body, part.get_content_charset()), part.get_content_type())
+
+
+def get_text_part(message: Message) -> Message | None:
+    """Pick the part with the text of the email. text/plain is preferred, unless it's empty
+    (some emails only have a placeholder like "view in browser" in the plain part, but that can't be detected)
+    """
+    parts = {}
+    for part in message.walk():
+        if part.is_multipart() or part.get_content_disposition() == "attachment":
+            continue
+        content_type = part.get_content_type()
+        if content_type in ("text/plain", "text/html") and content_type not in parts:
+            parts[content_type] = part
+    plain = parts.get("text/plain")
+    if plain is not None and (plain.get_payload(decode=True) or b"").strip():
+        return plain
+    return parts.get("text/html", plain)
+
+
+def decode_text(body: bytes, charset: str | None) -> str:
+    """Decode the bytes of a part with its charset (UTF-8 if it's missing or unknown)"""
+    try:
+        return body.decode(charset or "utf-8", errors="replace")
+    except LookupError:
+        logger.debug(f"Unknown charset {charset}. Decoding as UTF-8")
+        return body.decode("utf-8", errors="replace")
+
+
+# "On Mon, Jan 1, 2024 at 12:00 PM Someone <someone@example.com> wrote:" (can be wrapped over two lines)
+ATTRIBUTION_PATTERN = re.compile(r"^On\b.{0,300}\bwrote:$", re.DOTALL)
+# Lines that start the quoted email in Outlook and similar clients
+ORIGINAL_MESSAGE_PATTERN = re.compile(r"^(-{2,} ?Original Message ?-{2,}|_{10,})$", re.IGNORECASE)
+# Outlook also quotes with just the headers of the previous email
+QUOTED_HEADERS_PATTERN = re.compile(r"^From: .+\n(Sent|Date): .+$", re.IGNORECASE)
+# The standard signature delimiter (RFC 3676). Only the exact line counts, since a bare "--" is
+# also used as a separator in the text itself
+SIGNATURE_DELIMITER = "-- "
+# Added by mobile clients
+SIGNATURE_PATTERN = re.compile(r"^(Sent from my .+|Get Outlook for .+)$")
+
+
+def strip_quoted_reply(text: str) -> str:
+    r"""Remove the quoted email at the bottom of a reply, along with the line introducing it.
+    Quotes with replies between them (inline replies) are kept since the replies don't make sense without them.
+    The whole thread is already in the history, so the quoted email would only be repeated.
+
+    >>> strip_quoted_reply("Thanks!\n\nOn Mon, 1 Jan 2024, Bob <bob@example.com> wrote:\n> Hi")
+    'Thanks!'
+    >>> strip_quoted_reply("Can you check this?\nOn second thought, here is what my boss wrote:")
+    'Can you check this?\nOn second thought, here is what my boss wrote:'
+    """
+    lines = text.splitlines()
+    end = len(lines)
+    # Everything after an "Original Message" line is the previous email
+    for i in range(1, len(lines)):
+        if ORIGINAL_MESSAGE_PATTERN.match(lines[i].strip()) or QUOTED_HEADERS_PATTERN.match(
+            "\n".join(line.strip() for line in lines[i : i + 2])
+        ):
+            end = i
+            break
+    quoted = end < len(lines)
+    # Remove the trailing quoted lines (and blank lines between them)
+    while end > 0 and (lines[end - 1].lstrip().startswith(">") or not lines[end - 1].strip()):
+        quoted = quoted or lines[end - 1].lstrip().startswith(">")
+        end -= 1
+    # The attribution line might be wrapped, so the last two lines are checked together too.
+    # Without a quote after it, a line like "On second thought, ... wrote:" is part of the email
+    for length in (1, 2) if quoted else ():
+        attribution = " ".join(line.strip() for line in lines[max(end - length, 0) : end])
+        if end - length >= 0 and ATTRIBUTION_PATTERN.match(attribution):
+            end -= length
+            break
+    stripped = "\n".join(lines[:end]).rstrip()
+    # If there's nothing but the quote (like a forward), keep it
+    return stripped if stripped else text
+
+
+def strip_signature(text: str) -> str:
+    """Remove the signature from the end of the email, if it's marked with a delimiter"""
+    lines = text.splitlines()
+    # Only the last few lines are checked so a "-- " in the middle of the email doesn't remove most of it
+    for i in range(len(lines) - 1, max(len(lines) - 10, 0) - 1, -1):
+        if i > 0 and (lines[i] == SIGNATURE_DELIMITER or SIGNATURE_PATTERN.match(lines[i].rstrip())):
+            return "\n".join(lines[:i]).rstrip()
+    return text
+
+
+def clean_text(text: str, content_type: str = "text/plain") -> str:
+    """Turn the text of an email into what's sent to the LLM.
+    HTML is converted to markdown and the quoted reply and signature are removed.
+    """
+    if content_type == "text/html":
+        # Without a body width, html2text doesn't wrap lines (which would also split attribution lines)
+        text = html2text.html2text(text, bodywidth=0)
+    text = text.replace("\r\n", "\n")
+    # A signature before the quoted email (top-posting) is at the end once the quote is removed.
+    # Stripping it only once keeps the text above a second delimiter-like line
+    return strip_signature(strip_quoted_reply(text)).strip()